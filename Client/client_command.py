@@ -1,24 +1,57 @@
 import cmd
 import getpass
+import glob
 import os
+import posixpath
 import shutil
+import socket
 import sys
 
+from Client.transfer_scheduler import TransferScheduler, plan_batches
 from utils import receive_file, send_file
-from utils import request_parser as rp
+from utils.AES_handler import data_encryption
+from utils.archive import receive_archive, send_archive
 from utils.auth import authorize
+from utils.compression import DEFAULT_CODEC
+from utils.control_channel import ControlChannel
+from utils.data_channel import DataDialer
 from utils.ftp_status_code import FTPStatusCode as FTPStatus
-from utils.path_tools import process_path, validate_path
-from utils.send_file import get_file_info, create_transmit_socket
+from utils.hashing import DEFAULT_HASH_ALGORITHM, hash_prefix, new_hasher
+from utils.mux import MUX_TRANSPORT
+from utils.path_tools import is_relative_inside, process_path, validate_path, walk_tree
+from utils.serializers import SERIALIZERS
+from utils.send_file import get_file_info, manifest_entry
 from utils.standard_query import StandardQuery
+from utils.tls import tls
+from utils.transfer_journal import read_journal, remove_journal, resume_offset, write_journal
+from utils.tuning import tune_control_socket, tuning
 
 current_local_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
-
-def login_handler(user_socket) -> (str, str):
+DEFAULT_CODECS = ["zlib", "none"]
+DEFAULT_ENCODINGS = ["binary", "json"]
+DEFAULT_HASH_ALGORITHMS = ["tree-blake2b", "blake2b", "md5"]
+DEFAULT_ARCHIVE_COMPRESSIONS = ["none"]
+DEFAULT_DATA_CODECS = ["none"]
+MKDIR_PIPELINE = 512  # Most mkdir requests in flight at once when creating a directory tree
+
+
+def negotiate_handler(control_channel, codecs, encodings) -> None:
+    """Agree with the server on how the control connection is encoded."""
+    query = StandardQuery(auth_token="", command="negotiate", current_dir="",
+                          data={"codecs": codecs, "encodings": encodings})
+    request_id = query.serialize_and_send(control_channel)
+    response = control_channel.recv_response(request_id)
+    if response["accept"]:
+        # The server already answers this way; our queries follow suit.
+        control_channel.codec = response["data"]["codec"]
+        control_channel.accepted_codec = response["data"]["codec"]
+        control_channel.serializer = SERIALIZERS[response["data"].get("encoding", "json")]
+
+
+def login_handler(control_channel) -> (str, str):
     username = input("username: ")
     password = getpass.getpass()
-    data = authorize(username, password, user_socket)
+    data = authorize(username, password, control_channel)
     if data:
         auth_token = data['auth_token']
         access_path = data['access_path']
@@ -33,29 +66,57 @@ class FTPClient(cmd.Cmd):
     intro = 'Welcome to the FTP client. Type help or ? to list commands.'
     prompt = '(ftp) '
 
-    def __init__(self, user_socket, server_addrs):
+    def __init__(self, user_socket, server_addrs, codecs=None, encodings=None, hash_algorithms=None, mux=False,
+                 archive_compressions=None, data_codecs=None):
         super().__init__()
         self.user_socket = user_socket
-        auth_token, access_path = login_handler(self.user_socket)
+        self.codecs = codecs or DEFAULT_CODECS
+        self.encodings = encodings or DEFAULT_ENCODINGS
+        self.hash_algorithms = hash_algorithms or DEFAULT_HASH_ALGORITHMS
+        self.archive_compressions = archive_compressions or DEFAULT_ARCHIVE_COMPRESSIONS
+        self.data_codecs = data_codecs or DEFAULT_DATA_CODECS
+        self.mux = mux
+        self.channel = ControlChannel(user_socket)
+        if mux:
+            # Stream data must be read even while no reply is awaited.
+            self.channel.start_reader()
+        negotiate_handler(self.channel, self.codecs, self.encodings)
+        auth_token, access_path = login_handler(self.channel)
         self.auth_token = auth_token
         self.access_path = access_path
         self.server_addr = str(server_addrs)
 
     def do_login(self, arg):
         """Handle user login."""
-        auth_token, access_path = login_handler(self.user_socket)
+        auth_token, access_path = login_handler(self.channel)
         self.auth_token = auth_token
 
     def do_upload(self, arg):
-        """Upload a file to the server."""
+        """Upload a file, or a directory as a tar stream, to the server."""
         args = arg.split()
         self.upload_file_handler(args)
 
     def do_download(self, arg):
-        """Download a file from the server."""
+        """Download a file, or a directory as a tar stream, from the server."""
         args = arg.split()
         self.download_file_handler(args)
 
+    def do_put(self, arg):
+        """Upload a file, or with -r a whole directory, to the server."""
+        args = arg.split()
+        if args and args[0] == "-r":
+            self.put_tree_handler(args[1:])
+        else:
+            self.upload_file_handler(args)
+
+    def do_get(self, arg):
+        """Download a file, or with -r a whole directory, from the server."""
+        args = arg.split()
+        if args and args[0] == "-r":
+            self.get_tree_handler(args[1:])
+        else:
+            self.download_file_handler(args)
+
     def do_cd(self, arg):
         """Change the current server directory."""
         args = arg.split()
@@ -112,52 +173,134 @@ class FTPClient(cmd.Cmd):
         self.exit_program()
 
     def do_mkdir(self, arg):
-        """Make a directory on the server."""
+        """Make one or more directories on the server."""
         args = arg.split()
         self.make_dir_handler(args)
 
     def do_rm(self, arg):
-        """Remove a file on the server."""
+        """Remove one or more files on the server."""
         args = arg.split()
         self.remove_file_handler(args)
 
     def do_resume(self, arg):
-        """Resume a download."""
+        """Resume an interrupted upload or download of a local file."""
         args = arg.split()
-        self.resume_download_handler(args)
+        self.resume_handler(args)
+
+    def do_mput(self, arg):
+        """Upload several files (wildcards allowed) in one data stream."""
+        args = arg.split()
+        self.mput_handler(args)
+
+    def do_mget(self, arg):
+        """Download several files in one data stream."""
+        args = arg.split()
+        self.mget_handler(args)
 
     def upload_file_handler(self, arg):
         dir_path = process_path(arg[0], current_local_dir)
+        if validate_path(dir_path, dir_check=True):
+            self.upload_archive_handler(arg, dir_path)
+            return
         if len(arg) > 1:
             if not validate_path(dir_path, file_check=True):
                 print("Invalid path")
 
         file_data = get_file_info(dir_path)
-        transmit_socket, port = create_transmit_socket(self.user_socket.getsockname()[0])
-        file_data["transmit_port"] = port
+        file_data["hash_algorithms"] = self.hash_algorithms
+        file_data["segments"] = tuning.segments
+        file_data["data_codecs"] = self.data_codecs
+        file_data.update(data_encryption.offer(), **self.transport())
         file_name = os.path.basename(file_data["file_path"])
-        StandardQuery(self.auth_token, command="upload", command_args=arg,
-                      current_dir=self.access_path, data=file_data).serialize_and_send(self.user_socket)
-        response = rp.response_parser(self.user_socket.recv(4096))
+        request_id = StandardQuery(self.auth_token, command="upload", command_args=arg,
+                                   current_dir=self.access_path, data=file_data).serialize_and_send(self.channel)
+        response = self.channel.recv_response(request_id)
         if response["accept"]:
-            send_file.send_file(dir_path, transmit_socket, file_data["file_size"], file_name, True)
-            response2 = rp.response_parser(self.user_socket.recv(4096))
-            if response2["accept"]:
-                print("File uploaded successfully.")
-                transmit_socket.close()
-                return
-            else:
-                print("File upload failed.")
-                self.handle_error(response2)
-                transmit_socket.close()
+            hash_algorithm = (response["data"] or {}).get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+            remote_path = (response["data"] or {}).get("file_path")
+            segments = (response["data"] or {}).get("segments", 1)
+            codec = (response["data"] or {}).get("data_codec", DEFAULT_CODEC)
+            key = data_encryption.agreed(response["data"], file_data)
+            transmit_socket = self.data_endpoint(request_id, response["data"])
+            if segments > 1:
+                send_file.send_segments(dir_path, transmit_socket, file_data["file_size"], file_name, segments,
+                                        True, hash_algorithm=hash_algorithm, codec=codec, key=key)
+                self.report_upload(request_id, dir_path)
                 return
+            if remote_path:
+                # Lets 'resume' find the partial upload on the server after an interruption.
+                write_journal(dir_path, {"direction": "upload", "remote_path": remote_path,
+                                         "file_size": file_data["file_size"]})
+            self.finish_upload(request_id, dir_path, transmit_socket, file_data["file_size"], file_name,
+                               new_hasher(hash_algorithm), codec=codec, key=key)
+        else:
+            self.handle_error(response)
+
+    def upload_archive_handler(self, args, dir_path):
+        """Upload the local directory ``dir_path`` as a tar stream, extracted on the server as it arrives."""
+        data = {"archive": True, "file_path": dir_path, "archive_compressions": self.archive_compressions,
+                "hash_algorithms": self.hash_algorithms, **data_encryption.offer(), **self.transport()}
+        request_id = StandardQuery(self.auth_token, command="upload", command_args=args,
+                                   current_dir=self.access_path, data=data).serialize_and_send(self.channel)
+        response = self.channel.recv_response(request_id)
+        if not response["accept"]:
+            self.handle_error(response)
+            return
+        send_archive(dir_path, self.data_endpoint(request_id, response["data"]), response["data"]["archive"], True,
+                     hash_algorithm=response["data"].get("hash_algorithm", DEFAULT_HASH_ALGORITHM),
+                     key=data_encryption.agreed(response["data"], data))
+        response = self.channel.recv_response(request_id)
+        if response["accept"]:
+            print("Directory uploaded successfully.")
         else:
+            print("Directory upload failed.")
             self.handle_error(response)
 
+    def transport(self) -> dict:
+        """Request fields asking for the data of a transfer to travel on the control connection, if enabled."""
+        return {"transport": MUX_TRANSPORT} if self.mux else {}
+
+    def data_endpoint(self, request_id, data, channel=None):
+        """
+        Where the data of the accepted transfer ``request_id`` goes, as announced in the reply ``data``.
+
+        That is its stream on the control connection (``channel``, by default
+        the client's own) if the server agreed to multiplex it, otherwise the
+        server's leased data port.
+        """
+        if data.get("transport") == MUX_TRANSPORT:
+            return (channel or self.channel).mux.open(request_id)
+        return DataDialer(self.server_addr, int(data["transmit_port"]),
+                          bytes.fromhex(data.get("transmit_token", "")))
+
+    def finish_upload(self, request_id, dir_path, transmit_socket, file_size, file_name, hasher, offset=0,
+                      codec=DEFAULT_CODEC, key=None):
+        """
+        Send an accepted upload from ``offset`` on, compressed with ``codec`` and encrypted with ``key``,
+        and wait for the server's verdict.
+        """
+        send_file.send_file(dir_path, transmit_socket, file_size, file_name, True, hasher=hasher, offset=offset,
+                            codec=codec, key=key)
+        transmit_socket.close()
+        self.report_upload(request_id, dir_path)
+
+    def report_upload(self, request_id, dir_path):
+        """Print the server's verdict on an upload it has finished receiving."""
+        response2 = self.channel.recv_response(request_id)
+        if response2["accept"]:
+            remove_journal(dir_path)
+            print("File uploaded successfully.")
+        else:
+            print("File upload failed.")
+            self.handle_error(response2)
+
     def download_file_handler(self, args):
-        StandardQuery(self.auth_token, command="download", command_args=args,
-                      current_dir=self.access_path).serialize_and_send(self.user_socket)
-        response = rp.response_parser(self.user_socket.recv(4096))
+        data = {"hash_algorithms": self.hash_algorithms, "segments": tuning.segments,
+                "archive_compressions": self.archive_compressions, "data_codecs": self.data_codecs,
+                **data_encryption.offer(), **self.transport()}
+        request_id = StandardQuery(self.auth_token, command="download", command_args=args,
+                                   current_dir=self.access_path, data=data).serialize_and_send(self.channel)
+        response = self.channel.recv_response(request_id)
         dir_path = current_local_dir
         if len(args) > 1:
             dir_path = process_path(args[1], current_local_dir)
@@ -165,18 +308,40 @@ class FTPClient(cmd.Cmd):
                 print("Invalid path")
                 return
         if response["accept"]:
-            transmit_port = int(response["data"]["transmit_port"])
+            endpoint = self.data_endpoint(request_id, response["data"])
+            key = data_encryption.agreed(response["data"], data)
+            if "archive" in response["data"]:
+                # A directory, sent as a tar stream.
+                transmit_result, error = receive_archive(
+                    self.server_addr, dir_path, None, response["data"]["archive"],
+                    hash_algorithm=response["data"].get("hash_algorithm", DEFAULT_HASH_ALGORITHM), listener=endpoint,
+                    key=key)
+                if transmit_result:
+                    print("Directory downloaded successfully")
+                else:
+                    print(f"Directory download failed: {error}")
+                return
             filename = os.path.basename(response["data"]["file_path"])
             filesize = int(response["data"]["file_size"])
             transmit_buffer_size = int(response["data"]["buffer_size"])
-            checksum = response["data"]["checksum"]
+            checksum = response["data"].get("checksum")
+            hash_algorithm = response["data"].get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+            segments = response["data"].get("segments", 1)
             print(self.server_addr)
-            transmit_result = receive_file.retrieve_file(self.server_addr, dir_path, transmit_port, filename, filesize,
-                                                         transmit_buffer_size, checksum)
+            if segments > 1:
+                transmit_result, error = receive_file.retrieve_segments(
+                    self.server_addr, dir_path, None, filename, filesize, transmit_buffer_size, segments,
+                    hash_algorithm=hash_algorithm, listener=endpoint, key=key)
+            else:
+                transmit_result, error = receive_file.retrieve_file(
+                    self.server_addr, dir_path, None, filename, filesize, transmit_buffer_size, checksum,
+                    hash_algorithm=hash_algorithm,
+                    journal={"direction": "download", "remote_path": response["data"]["file_path"]},
+                    listener=endpoint, key=key)
             if transmit_result:
                 print("File downloaded successfully")
             else:
-                print("File download failed.")
+                print(f"File download failed: {error}")
         else:
             self.handle_error(response)
 
@@ -185,9 +350,9 @@ class FTPClient(cmd.Cmd):
         terminal_width = shutil.get_terminal_size().columns
         query = StandardQuery(self.auth_token, "list", self.access_path, command_args=args,
                               data={"terminal_width": terminal_width})
-        query.serialize_and_send(self.user_socket)
+        request_id = query.serialize_and_send(self.channel)
         print("Server dir list:\n")
-        self.handle_response('', )
+        self.handle_response(request_id, '')
 
     def local_list_handler(self, args):
         dir_path = process_path(current_local_dir, current_local_dir)
@@ -230,8 +395,8 @@ class FTPClient(cmd.Cmd):
     def change_dir_handler(self, args):
         """Change the current server directory."""
         query = StandardQuery(self.auth_token, "cd", self.access_path, command_args=args)
-        query.serialize_and_send(self.user_socket)
-        response = rp.response_parser(self.user_socket.recv(4096))
+        request_id = query.serialize_and_send(self.channel)
+        response = self.channel.recv_response(request_id)
         if response["accept"]:
             self.access_path = response["data"]["current_directory"]
             print("Changed directory successfully.")
@@ -241,18 +406,20 @@ class FTPClient(cmd.Cmd):
     def rename_handler(self, args):
         """Rename a file on the server."""
         query = StandardQuery(self.auth_token, "rename", self.access_path, command_args=args)
-        query.serialize_and_send(self.user_socket)
-        response = rp.response_parser(self.user_socket.recv(4096))
+        request_id = query.serialize_and_send(self.channel)
+        response = self.channel.recv_response(request_id)
         if response["accept"]:
             print("Renamed successfully.")
         else:
             self.handle_error(response)
 
-    def handle_response(self, field: str):
+    def handle_response(self, request_id: int, field: str):
         """Handle the server's response to a command."""
-        raw_response = self.user_socket.recv(4096)
-        if raw_response:
-            response = rp.response_parser(raw_response)
+        try:
+            response = self.channel.recv_response(request_id)
+        except ConnectionError:
+            response = None
+        if response:
             if response["accept"]:
                 if field:
                     print(response["data"][field])
@@ -264,14 +431,11 @@ class FTPClient(cmd.Cmd):
             print("Failed to get response. Check your connection.")
 
     def make_dir_handler(self, args):
-        """Make a directory on the server."""
-        query = StandardQuery(self.auth_token, "mkdir", self.access_path, command_args=args)
-        query.serialize_and_send(self.user_socket)
-        response = rp.response_parser(self.user_socket.recv(4096))
-        if response["accept"]:
-            print("Directory created successfully.")
-        else:
-            self.handle_error(response)
+        """Make one or more directories on the server."""
+        if len(args) == 0:
+            print("Syntax Error.\nUsage: mkdir <dir_name> [<dir_name> ...]")
+            return
+        self.batch_handler("mkdir", args, "Directory created successfully.")
 
     def remove_dir_handler(self, args):
         """Remove a directory on the server."""
@@ -282,30 +446,326 @@ class FTPClient(cmd.Cmd):
             else:
                 data = {"method": "n"}  # n Represents normal remove directory
             query = StandardQuery(self.auth_token, "rmdir", self.access_path, command_args=args, data=data)
-            query.serialize_and_send(self.user_socket)
-            response = rp.response_parser(self.user_socket.recv(4096))
+            request_id = query.serialize_and_send(self.channel)
+            response = self.channel.recv_response(request_id)
             if response["accept"]:
                 print("Directory removed successfully.")
             else:
                 self.handle_error(response)
 
     def remove_file_handler(self, args):
-        """Remove a file on the server."""
+        """Remove one or more files on the server."""
+        if len(args) == 0:
+            print("Syntax Error.\nUsage: rm <filename> [<filename> ...]")
+            return
         if input("Are you sure you want to remove this file? [y/N]: ") == "y":
-            query = StandardQuery(self.auth_token, "rm", self.access_path, command_args=args)
-            query.serialize_and_send(self.user_socket)
-            response = rp.response_parser(self.user_socket.recv(4096))
+            self.batch_handler("rm", args, "File removed successfully.")
+
+    def batch_handler(self, command, names, success_message, data=None):
+        """Run a single-argument command for every name, pipelining the requests in one round trip."""
+        queries = [StandardQuery(self.auth_token, command, self.access_path, command_args=[name], data=data)
+                   for name in names]
+        for name, response in zip(names, self.channel.pipeline(queries)):
+            prefix = f"{name}: " if len(names) > 1 else ""
             if response["accept"]:
-                print("File removed successfully.")
+                print(prefix + success_message)
             else:
+                print(prefix, end="")
                 self.handle_error(response)
 
-    def resume_download_handler(self, args):
-        """Resume a download."""
-        pass  # Implement as needed
+    def resume_handler(self, args):
+        """Resume an interrupted transfer of a local file from its sidecar journal."""
+        if len(args) != 1:
+            print("Syntax Error.\nUsage: resume <local file>")
+            return
+        local_path = process_path(args[0], current_local_dir)
+        journal = read_journal(local_path)
+        if journal is None:
+            print("There is no interrupted transfer of this file to resume.")
+            return
+        if journal["direction"] == "upload":
+            self.resume_upload(local_path, journal)
+        else:
+            self.resume_download(local_path, journal)
+
+    def resume_download(self, local_path, journal):
+        if not os.path.isfile(local_path):
+            print("The partial file is gone; download it again.")
+            return
+        hash_algorithm = journal["hash_algorithm"]
+        offset = resume_offset(local_path, journal)
+        with open(local_path, "rb") as f:
+            hasher = hash_prefix(f, hash_algorithm, offset)
+        data = {"direction": "download", "file_size": journal["file_size"], "offset": offset,
+                "hash_algorithm": hash_algorithm, "prefix_checksum": hasher.copy().hexdigest(),
+                "data_codecs": self.data_codecs, **data_encryption.offer(), **self.transport()}
+        request_id = StandardQuery(self.auth_token, command="resume", command_args=[journal["remote_path"]],
+                                   current_dir=self.access_path, data=data).serialize_and_send(self.channel)
+        response = self.channel.recv_response(request_id)
+        if not response["accept"]:
+            self.handle_error(response)
+            return
+        print(f"Resuming download at byte {offset}.")
+        transmit_result, error = receive_file.retrieve_file(
+            self.server_addr, os.path.dirname(local_path), None,
+            os.path.basename(local_path), journal["file_size"], int(response["data"]["buffer_size"]),
+            response["data"].get("checksum"), hash_algorithm=hash_algorithm, hasher=hasher, offset=offset,
+            journal=journal, listener=self.data_endpoint(request_id, response["data"]),
+            key=data_encryption.agreed(response["data"], data))
+        if transmit_result:
+            print("File downloaded successfully")
+        else:
+            print(f"File download failed: {error}")
+
+    def resume_upload(self, local_path, journal):
+        file_data = get_file_info(local_path)
+        if file_data["file_size"] != journal["file_size"]:
+            print("The file changed since the upload started; upload it again.")
+            return
+        file_data.update(direction="upload", hash_algorithms=self.hash_algorithms, data_codecs=self.data_codecs,
+                         **data_encryption.offer(), **self.transport())
+        request_id = StandardQuery(self.auth_token, command="resume", command_args=[journal["remote_path"]],
+                                   current_dir=self.access_path, data=file_data).serialize_and_send(self.channel)
+        response = self.channel.recv_response(request_id)
+        if not response["accept"]:
+            self.handle_error(response)
+            return
+        transmit_socket = self.data_endpoint(request_id, response["data"])
+        offset = int(response["data"]["offset"])
+        with open(local_path, "rb") as f:
+            hasher = hash_prefix(f, response["data"]["hash_algorithm"], offset)
+        if hasher.copy().hexdigest() != response["data"]["prefix_checksum"]:
+            # A data connection closed without any data makes the server give up on this attempt.
+            connection, addr = transmit_socket.accept()
+            connection.close()
+            self.channel.recv_response(request_id)
+            print("The partial file on the server does not match this file; upload it again.")
+            return
+        print(f"Resuming upload at byte {offset}.")
+        self.finish_upload(request_id, local_path, transmit_socket, file_data["file_size"],
+                           os.path.basename(local_path), hasher, offset,
+                           response["data"].get("data_codec", DEFAULT_CODEC),
+                           data_encryption.agreed(response["data"], file_data))
+
+    def mput_handler(self, args):
+        """Upload many files to the current server directory, back to back in one data stream."""
+        if len(args) == 0:
+            print("Syntax Error.\nUsage: mput <local file> [<local file> ...]")
+            return
+        files, names = [], set()
+        for pattern in args:
+            local_path = process_path(pattern, current_local_dir)
+            for path in sorted(glob.glob(local_path)) or [local_path]:
+                name = os.path.basename(path)
+                if name in names:
+                    print(f"{path}: skipped, another file of the batch has the same name")
+                    continue
+                files.append((path, name))
+                names.add(name)
+
+        refusal, errors = self.upload_batch(self.channel, self.access_path, files)
+        if refusal:
+            self.handle_error(refusal)
+            return
+        for name, error in errors.items():
+            print(f"{name}: {error}")
+        if errors:
+            print(f"{len(errors)} of {len(files)} files failed to upload.")
+        else:
+            print(f"{len(files)} files uploaded successfully.")
+
+    def upload_batch(self, channel, remote_dir, files, progress=None):
+        """
+        Upload ``files``, pairs of local path and name, into ``remote_dir`` as one mput batch over ``channel``.
+
+        Names may contain '/' to place a file in a subdirectory, which must
+        already exist on the server.
+
+        Returns:
+            Tuple of (the server's refusal of the batch or None, error of every failed file by name)
+        """
+        hash_algorithm = self.hash_algorithms[0]
+        file_paths, manifest, errors = [], [], {}
+        for path, name in files:
+            try:
+                manifest.append(manifest_entry(path, name, hash_algorithm))
+            except (OSError, ValueError) as e:
+                errors[name] = getattr(e, "strerror", None) or str(e)
+                continue
+            file_paths.append(path)
+        if not manifest:
+            return None, errors
+
+        data = {"files": manifest, "hash_algorithm": hash_algorithm, "hash_algorithms": self.hash_algorithms,
+                "buffer_size": tuning.max_chunk_size, "data_codecs": self.data_codecs, **data_encryption.offer(),
+                **self.transport()}
+        request_id = StandardQuery(self.auth_token, command="mput", current_dir=remote_dir,
+                                   data=data).serialize_and_send(channel)
+        response = channel.recv_response(request_id)
+        if not response["accept"]:
+            errors.update((entry["path"], self.error_message(response)) for entry in manifest)
+            return response, errors
+        agreed = response["data"].get("hash_algorithm", DEFAULT_HASH_ALGORITHM)
+        if agreed != hash_algorithm:
+            manifest = [{key: value for key, value in entry.items() if key != "checksum"} for entry in manifest]
+        send_file.send_batch(file_paths, manifest, self.data_endpoint(request_id, response["data"], channel),
+                             progress is None, hash_algorithm=agreed, progress=progress,
+                             codec=response["data"].get("data_codec", DEFAULT_CODEC),
+                             key=data_encryption.agreed(response["data"], data))
+        response = channel.recv_response(request_id)
+        if isinstance(response["data"], dict) and not response["accept"]:
+            errors.update(response["data"])
+        elif not response["accept"]:
+            errors.update((entry["path"], self.error_message(response)) for entry in manifest)
+        return None, errors
+
+    def mget_handler(self, args):
+        """Download many files to the current local directory, back to back in one data stream."""
+        if len(args) == 0:
+            print("Syntax Error.\nUsage: mget <filename> [<filename> ...]")
+            return
+        refusal, checksums, errors = self.download_batch(self.channel, self.access_path, args, current_local_dir)
+        if refusal:
+            self.handle_error(refusal)
+            return
+        for path, error in errors.items():
+            print(f"{path}: {error}")
+        print(f"{len(checksums)} of {len(args)} files downloaded successfully.")
+
+    def download_batch(self, channel, remote_dir, names, local_dir, keep_paths=False, progress=None):
+        """
+        Download the files ``names`` of ``remote_dir`` into ``local_dir`` as one mget batch over ``channel``.
+
+        With ``keep_paths`` each file keeps its relative name, '/' and all,
+        below ``local_dir``; the subdirectories must already exist.
+
+        Returns:
+            Tuple of (the server's refusal of the batch or None, checksum of every downloaded file,
+            error of every failed file)
+        """
+        data = {"hash_algorithms": self.hash_algorithms, "data_codecs": self.data_codecs, **data_encryption.offer(),
+                **self.transport()}
+        if keep_paths:
+            data["keep_paths"] = True
+        request_id = StandardQuery(self.auth_token, command="mget", command_args=names, current_dir=remote_dir,
+                                   data=data).serialize_and_send(channel)
+        response = channel.recv_response(request_id)
+        if not response["accept"]:
+            if isinstance(response["data"], dict):
+                return response, {}, dict(response["data"])
+            return response, {}, {name: self.error_message(response) for name in names}
+        key = data_encryption.agreed(response["data"], data)
+        data = response["data"]
+        checksums, errors = receive_file.retrieve_batch(
+            self.server_addr, local_dir, None, data["files"], int(data["buffer_size"]), progress is None,
+            hash_algorithm=data.get("hash_algorithm", DEFAULT_HASH_ALGORITHM),
+            listener=self.data_endpoint(request_id, data, channel), progress=progress, key=key)
+        return None, checksums, {**data.get("missing", {}), **errors}
+
+    def transfer_channel(self):
+        """
+        A control channel for one worker of a directory transfer, and the function that releases it.
+
+        Multiplexed transfers already run side by side on the client's own
+        connection; otherwise every worker logs its own connection in with
+        the session's token, since the server handles one connection's
+        requests one at a time.
+        """
+        if self.mux:
+            return self.channel, lambda: None
+        connection = socket.create_connection(self.user_socket.getpeername())
+        try:
+            tune_control_socket(connection)
+            connection = tls.wrap_client(connection, self.server_addr)
+            channel = ControlChannel(connection)
+            negotiate_handler(channel, self.codecs, self.encodings)
+        except (OSError, ConnectionError):
+            connection.close()
+            raise
+        return channel, connection.close
+
+    def put_tree_handler(self, args):
+        """Upload a local directory and everything below it into the current (or given) server directory."""
+        if len(args) not in (1, 2):
+            print("Syntax Error.\nUsage: put -r <local dir> [<server dir>]")
+            return
+        local_root = process_path(args[0], current_local_dir)
+        if not validate_path(local_root, dir_check=True):
+            print(f"Path: {local_root} is not a directory.")
+            return
+        remote_parent = posixpath.join(self.access_path, args[1]) if len(args) > 1 else self.access_path
+        remote_root = posixpath.normpath(posixpath.join(remote_parent, os.path.basename(local_root)))
+        dirs, files = walk_tree(local_root)
+
+        # Only the deepest directories need asking for; each one brings its parents along.
+        parents = {posixpath.dirname(path) for path in dirs}
+        leaves = [path for path in dirs if path not in parents]
+        paths = [remote_root] + [posixpath.join(remote_root, path) for path in leaves]
+        for i in range(0, len(paths), MKDIR_PIPELINE):
+            queries = [StandardQuery(self.auth_token, "mkdir", self.access_path, command_args=[path],
+                                     data={"parents": True}) for path in paths[i:i + MKDIR_PIPELINE]]
+            for path, response in zip(paths[i:i + MKDIR_PIPELINE], self.channel.pipeline(queries)):
+                if not response["accept"]:
+                    print(f"{path}: ", end="")
+                    self.handle_error(response)
+                    return
+
+        scheduler = TransferScheduler(self.transfer_channel, tuning.transfers, sum(size for path, size in files),
+                                      f"Uploading {len(files)} files")
+        errors = scheduler.run(
+            plan_batches(files, tuning.large_first),
+            lambda channel, batch, progress: self.upload_batch(
+                channel, remote_root, [(os.path.join(local_root, path), path) for path, size in batch], progress)[1])
+        for path, error in sorted(errors.items()):
+            print(f"{path}: {error}")
+        print(f"{len(files) - len(errors)} of {len(files)} files uploaded to {remote_root}.")
+
+    def get_tree_handler(self, args):
+        """Download a server directory and everything below it into the current (or given) local directory."""
+        if len(args) not in (1, 2):
+            print("Syntax Error.\nUsage: get -r <server dir> [<local dir>]")
+            return
+        local_parent = process_path(args[1], current_local_dir) if len(args) > 1 else current_local_dir
+        if not validate_path(local_parent, dir_check=True):
+            print(f"Path: {local_parent} is not a directory.")
+            return
+        request_id = StandardQuery(self.auth_token, "list", self.access_path, command_args=args[:1],
+                                   data={"recursive": True}).serialize_and_send(self.channel)
+        response = self.channel.recv_response(request_id)
+        if not response["accept"]:
+            self.handle_error(response)
+            return
+        remote_root = response["data"]["path"]
+        local_root = os.path.join(local_parent, posixpath.basename(remote_root))
+        files = [(path, size) for path, size in response["data"]["files"]]
+        try:
+            os.makedirs(local_root, exist_ok=True)
+            for path in response["data"]["dirs"]:
+                if is_relative_inside(path):
+                    os.makedirs(os.path.join(local_root, path), exist_ok=True)
+        except OSError as e:
+            print(f"Cannot create local directory: {e}")
+            return
+
+        scheduler = TransferScheduler(self.transfer_channel, tuning.transfers, sum(size for path, size in files),
+                                      f"Downloading {len(files)} files")
+        errors = scheduler.run(
+            plan_batches(files, tuning.large_first),
+            lambda channel, batch, progress: self.download_batch(
+                channel, remote_root, [path for path, size in batch], local_root, True, progress)[2])
+        for path, error in sorted(errors.items()):
+            print(f"{path}: {error}")
+        print(f"{len(files) - len(errors)} of {len(files)} files downloaded to {local_root}.")
 
     def handle_error(self, response):
         """Handle errors based on the server's response status code."""
+        print(self.error_message(response))
+        if response["data"]:
+            print(response["data"])
+
+    @staticmethod
+    def error_message(response) -> str:
+        """What the status code of a refused request means."""
         status_code = response["status_code"]
         error_messages = {
             FTPStatus.PATH_NOT_DIRECTORY: "Path is not a directory.",
@@ -314,11 +774,10 @@ class FTPClient(cmd.Cmd):
             FTPStatus.SYNTAX_ERROR_IN_PARAMETERS: "Syntax error.",
             FTPStatus.FILE_EXISTS_ERROR: "File exists.",
             FTPStatus.LOCAL_ERROR_IN_PROCESSING: "Unknown error.",
+            FTPStatus.REQUESTED_ACTION_NOT_TAKEN_FILE_UNAVAILABLE: "Requested action not taken.",
             FTPStatus.NOT_LOGGED_IN: "You are not logged in.\nPlease log in with 'login' command.",
         }
-        print(error_messages.get(status_code, "An unknown error occurred."))
-        if response["data"]:
-            print(response["data"])
+        return error_messages.get(status_code, "An unknown error occurred.")
 
     def help_full(self):
         """Display help information."""
@@ -0,0 +1,95 @@
+import queue
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from tqdm import tqdm
+
+BATCH_FILES = 255  # Most files sent in one batch; an mget names them as command arguments, at most 255 a query
+BATCH_BYTES = 64 * 1024 * 1024  # A batch is closed once its files add up to this; a larger file goes alone
+
+
+def plan_batches(files: List[Tuple[str, int]], large_first: bool = False, batch_files: int = BATCH_FILES,
+                 batch_bytes: int = BATCH_BYTES) -> List[List[Tuple[str, int]]]:
+    """
+    Group (path, size) pairs into batches of at most ``batch_files`` files or ``batch_bytes`` bytes.
+
+    Small files share a batch so they share a data stream; large files end
+    up alone, so they can run beside everything else. With ``large_first``
+    the batches are built from the largest file down, so the longest
+    transfers start first rather than trailing at the end.
+    """
+    if large_first:
+        files = sorted(files, key=lambda item: item[1], reverse=True)
+    batches, batch, batch_size = [], [], 0
+    for path, size in files:
+        if batch and (len(batch) >= batch_files or batch_size + size > batch_bytes):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append((path, size))
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class TransferScheduler:
+    """
+    Runs the batches of a directory transfer a few at a time under one progress bar.
+
+    Each of ``transfers`` workers takes its own control channel from
+    ``open_channel``, which returns the channel and a function that releases
+    it, and runs batches from a shared queue until none are left. The
+    batch function gets the worker's channel, the batch and the shared
+    progress bar, and returns the error of every file of the batch that
+    failed; an exception fails the whole batch without stopping the others.
+    """
+
+    def __init__(self, open_channel: Callable, transfers: int, total_bytes: int, description: str):
+        self.open_channel = open_channel
+        self.transfers = max(1, transfers)
+        self.progress = tqdm(total=total_bytes, desc=description, unit="B", unit_scale=True, unit_divisor=1024)
+        self.errors = {}
+        self.open_error = None
+        self.lock = threading.Lock()
+
+    def run(self, batches: List[List[Tuple[str, int]]], transfer: Callable) -> Dict[str, str]:
+        """Run every batch through ``transfer`` and return the errors of all failed files, keyed by path."""
+        pending = queue.Queue()
+        for batch in batches:
+            pending.put(batch)
+        workers = [threading.Thread(target=self.work, args=(pending, transfer), name=f"ftp-transfer-{i}",
+                                    daemon=True)
+                   for i in range(min(self.transfers, len(batches)))]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            self.progress.close()
+        # Only left over if no worker could open a connection.
+        while not pending.empty():
+            self.errors.update((path, self.open_error) for path, size in pending.get_nowait())
+        return self.errors
+
+    def work(self, pending: queue.Queue, transfer: Callable):
+        try:
+            channel, release = self.open_channel()
+        except (OSError, ConnectionError) as e:
+            # The other workers carry on with the batches.
+            self.open_error = f"Cannot open a connection: {e}"
+            return
+        try:
+            while True:
+                try:
+                    batch = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    errors = transfer(channel, batch, self.progress)
+                except Exception as e:
+                    errors = {path: str(e) for path, size in batch}
+                with self.lock:
+                    self.errors.update(errors)
+        finally:
+            release()
@@ -0,0 +1,108 @@
+import asyncio
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from Server.logging_config import server_logger
+from Server.server_command import execute_request, is_multiplexed_transfer
+from utils.command_codes import commands_code_dict
+from utils.control_channel import ControlChannel
+from utils.framing import read_frame
+from utils.request_parser import request_parser
+from utils.tls import tls
+from utils.tuning import tune_control_socket
+
+COMMAND_THREADS = 16  # Short blocking work: bcrypt, rmtree, listing, renames
+TRANSFER_THREADS = 8  # Long blocking work: hashing and copying file data
+TRANSFER_COMMANDS = {commands_code_dict[name] for name in ("upload", "download", "resume", "mput", "mget")}
+
+
+class AsyncConnectionAdapter:
+    """
+    Blocking, socket-like facade over an asyncio stream.
+
+    The command handlers in server_command only need ``sendall`` and
+    ``getsockname``; they run on executor threads and hand their writes back
+    to the event loop, waiting for the drain so a slow client still applies
+    backpressure to the handler.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self.writer = writer
+        self.loop = loop
+
+    async def _write(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def sendall(self, data: bytes):
+        asyncio.run_coroutine_threadsafe(self._write(data), self.loop).result()
+
+    def getsockname(self):
+        return self.writer.get_extra_info("sockname")
+
+    def getpeername(self):
+        return self.writer.get_extra_info("peername")
+
+
+class AsyncServer:
+    """Serve every control connection from one event loop."""
+
+    def __init__(self, sock: socket.socket, command_threads: int = COMMAND_THREADS,
+                 transfer_threads: int = TRANSFER_THREADS):
+        self.sock = sock
+        self.command_executor = ThreadPoolExecutor(max_workers=command_threads, thread_name_prefix="ftp-command")
+        self.transfer_executor = ThreadPoolExecutor(max_workers=transfer_threads, thread_name_prefix="ftp-transfer")
+
+    async def serve(self):
+        # With TLS the event loop completes each handshake before handing the connection over.
+        server = await asyncio.start_server(self.handle_connection, sock=self.sock, ssl=tls.context)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.command_executor.shutdown(wait=False, cancel_futures=True)
+            self.transfer_executor.shutdown(wait=False, cancel_futures=True)
+
+    def select_executor(self, user_request: dict) -> ThreadPoolExecutor:
+        if user_request.get("command") in TRANSFER_COMMANDS:
+            return self.transfer_executor
+        return self.command_executor
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        addr = writer.get_extra_info("peername")
+        channel = ControlChannel(AsyncConnectionAdapter(writer, loop))
+        server_logger.info(f"[+] User connected: {addr}")
+        tune_control_socket(writer.get_extra_info("socket"))
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                if channel.mux.dispatch(frame):
+                    continue
+
+                request_id, flags, data = channel.decode(frame)
+                user_request = request_parser(data, flags)
+                if is_multiplexed_transfer(user_request):
+                    # Not awaited: this loop delivers the transfer's data and window updates.
+                    loop.run_in_executor(self.transfer_executor, execute_request, user_request,
+                                         channel.reply_to(request_id), addr)
+                    continue
+                # Commands of one connection run one at a time, like the threaded server.
+                await loop.run_in_executor(self.select_executor(user_request), execute_request, user_request,
+                                           channel.reply_to(request_id), addr)
+        except ConnectionResetError:
+            server_logger.info(f"[-] Connection reset by {addr}")
+        except Exception as e:
+            server_logger.info(f"Error handling connection from {addr}: {e}")
+        finally:
+            channel.mux.close()
+            writer.close()
+
+
+def serve_forever(sock: socket.socket, command_threads: int = COMMAND_THREADS,
+                  transfer_threads: int = TRANSFER_THREADS):
+    """Run the asyncio server on an already bound and listening socket until interrupted."""
+    sock.setblocking(False)
+    asyncio.run(AsyncServer(sock, command_threads, transfer_threads).serve())
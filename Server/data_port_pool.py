@@ -0,0 +1,167 @@
+import hmac
+import secrets
+import socket
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from Server.logging_config import server_logger
+from utils.data_channel import TOKEN_SIZE, recv_exact
+from utils.tls import tls
+from utils.tuning import MAX_SEGMENTS, tune_data_socket
+
+LEASE_WAIT = 10.0  # Seconds a transfer waits for a free data port
+LEASE_TIMEOUT = 120.0  # Seconds after which a lease that never saw its connections is reclaimed
+TOKEN_TIMEOUT = 5.0  # Seconds a new data connection gets to present its token
+
+
+def parse_port_range(value: str) -> range:
+    """Parse '50000-50099' or a single '50000' from the command line."""
+    first, _, last = str(value).partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+class Lease:
+    """
+    A data port leased to one transfer, standing in for its listening socket.
+
+    ``accept`` only returns connections that open with the lease's one-time
+    token, after the TLS handshake if the server has TLS; anything else that
+    reaches the port is closed. Once the expected
+    number of connections has been accepted, or on ``close``, the port goes
+    back to the pool.
+    """
+
+    def __init__(self, pool: "DataPortPool", sock: socket.socket, connections: int, owned: bool):
+        self.pool = pool
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        self.token = secrets.token_bytes(TOKEN_SIZE)
+        self.connections = connections
+        self.owned = owned  # Bound for this lease alone rather than taken from the pool
+        self.accepted = 0
+        self.timeout = None
+        self.expires = time.monotonic() + LEASE_TIMEOUT
+        self.lock = threading.Lock()
+        self.released = False
+
+    def settimeout(self, timeout: Optional[float]):
+        self.timeout = timeout
+
+    def accept(self):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout("Timed out waiting for the data connection")
+            self.sock.settimeout(remaining)
+            conn, addr = self.sock.accept()
+            try:
+                conn.settimeout(TOKEN_TIMEOUT)
+                conn = tls.wrap_server(conn)
+                token = recv_exact(conn, TOKEN_SIZE)
+            except (OSError, ConnectionError):
+                conn.close()
+                continue
+            if not hmac.compare_digest(token, self.token):
+                server_logger.warning(f"Rejected data connection from {addr} on port {self.port}: wrong token")
+                conn.close()
+                continue
+            conn.settimeout(self.timeout)
+            with self.lock:
+                self.accepted += 1
+                done = self.accepted >= self.connections
+            if done:
+                self.close()
+            return conn, addr
+
+    def close(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.pool.release(self)
+
+
+class DataPortPool:
+    """
+    Listening data ports bound once at startup and leased to one transfer at a time.
+
+    Without a configured range every lease binds a port the kernel picks
+    and closes it afterwards. Worker processes each bind their own share of
+    the range, so a port is only ever accepted on by one process.
+    """
+
+    def __init__(self):
+        self.free = deque()
+        self.leases = set()
+        self.size = 0  # Ports bound; none means every lease binds its own
+        self.condition = threading.Condition()
+
+    def bind(self, ip: str, ports: range, part: int = 0, parts: int = 1):
+        for port in list(ports)[part::parts]:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tune_data_socket(sock)
+            try:
+                sock.bind((ip, port))
+                # A segmented transfer connects once per segment, all at once.
+                sock.listen(MAX_SEGMENTS)
+            except OSError as e:
+                server_logger.warning(f"Data port {port} is not available: {e}")
+                sock.close()
+                continue
+            self.free.append(sock)
+            self.size += 1
+        server_logger.info(f"{self.size} data ports ready")
+
+    def lease(self, ip: str, connections: int = 1, wait: float = LEASE_WAIT) -> Lease:
+        """
+        Lease a listening data port for a transfer of ``connections`` data connections.
+
+        Raises:
+            OSError: If no port became free within ``wait`` seconds
+        """
+        with self.condition:
+            if not self.size:
+                return self._lease_ephemeral(ip, connections)
+            deadline = time.monotonic() + wait
+            while not self.free:
+                self._reclaim_expired()
+                remaining = deadline - time.monotonic()
+                if self.free:
+                    break
+                if remaining <= 0:
+                    raise OSError("No free data port")
+                self.condition.wait(min(remaining, 1.0))
+            lease = Lease(self, self.free.popleft(), connections, owned=False)
+            self.leases.add(lease)
+            return lease
+
+    def _lease_ephemeral(self, ip: str, connections: int) -> Lease:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tune_data_socket(sock)
+        sock.bind((ip, 0))
+        sock.listen(MAX_SEGMENTS)
+        return Lease(self, sock, connections, owned=True)
+
+    def _reclaim_expired(self):
+        # Leases whose transfer never connected nor closed them, e.g. after a handler crashed.
+        now = time.monotonic()
+        for lease in [lease for lease in self.leases if lease.accepted == 0 and lease.expires < now]:
+            server_logger.warning(f"Reclaiming data port {lease.port} from an abandoned transfer")
+            lease.close()
+
+    def release(self, lease: Lease):
+        if lease.owned:
+            lease.sock.close()
+            return
+        with self.condition:
+            self.leases.discard(lease)
+            self.free.append(lease.sock)
+            self.condition.notify()
+
+
+# Shared by every transfer in the process.
+data_port_pool = DataPortPool()
@@ -1,32 +1,64 @@
 import datetime
+import functools
 import json
 import os
 import sqlite3 as sql3
+import threading
+import time
+from typing import Optional
 
 from Server.logging_config import server_logger
+from Server.session_cache import SESSION_LIFETIME, session_cache
 from utils.auth import password_hash, check_password
 
+STATEMENT_CACHE_SIZE = 64  # Prepared statements each connection keeps, looked up by their SQL text
+BUSY_TIMEOUT = 5.0  # Seconds a connection waits for another one's write lock before giving up
+
+# Every thread's open connections, by database path; each thread keeps its own for as long as it lives.
+_thread_connections = threading.local()
+
+_server_db = None
+_server_db_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def find_database_path(config_path: str = "config.json") -> Optional[str]:
+    """
+    The database path named in the config file, looked up once per process.
+
+    The config file is searched for anywhere below the project directory,
+    then relative to the working directory.
+    """
+    for root, dirs, files in os.walk(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))):
+        if os.path.basename(config_path) in files:
+            config_path = os.path.join(root, config_path)
+    try:
+        with open(config_path, "r") as f:
+            return os.path.abspath(json.load(f)["database_path"])
+    except FileNotFoundError:
+        print("Config file not found")
+    except json.decoder.JSONDecodeError:
+        print("Config file format is incorrect")
+    except KeyError:
+        print("Config file format is incorrect")
+    return None
+
 
 class ServerDB:
+    """
+    Queries against the user database.
+
+    Building one only resolves the database path; the tables are created
+    by ``create_tables``, run once with manage.py's migrate command. The
+    server shares one instance, from ``server_db``, among all handlers.
+    """
+
+    TABLES = ("Permission", "Users", "LoggedIn")
+
     def __init__(self, debug_flag: bool = False, config_path: str = "config.json") -> None:
         self.logger = server_logger
-        if not debug_flag:
-            self.logger.disabled = True
-        try:
-            for root, dirs, files in os.walk(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))):
-                if os.path.basename(config_path) in files:
-                    config_path = os.path.join(root, config_path)
-
-            with open(os.path.relpath(config_path), "r") as f:
-                self.DBPATH = os.path.relpath(json.load(f)["database_path"])
-        except FileNotFoundError:
-            print("Config file not found")
-        except json.decoder.JSONDecodeError:
-            print("Config file format is incorrect")
-        except KeyError:
-            print("Config file format is incorrect")
+        self.DBPATH = find_database_path(config_path)
         self.debug_flag = debug_flag
-        self.create_tables()
 
     def create_tables(self):
         query = """
@@ -60,7 +92,11 @@ class ServerDB:
             ON UPDATE CASCADE
         );"""
 
-        with self.__getConnection() as con:
+        # The schema is set up on a connection of its own, so the foreign_keys pragma stays with it.
+        con = self.__connect()
+        if con is None:
+            return
+        with con:
             try:
                 for q in query.strip().split(";"):
                     if q.strip():
@@ -70,14 +106,62 @@ class ServerDB:
                 self.logger.info("Database tables created or verified.")
             except sql3.Error as e:
                 self.logger.info(f"Error creating tables: {e}")
+        con.close()
 
-    def __getConnection(self):
+    def missing_tables(self) -> list:
+        """The tables ``create_tables`` makes that the database does not have yet."""
+        query = """SELECT name FROM sqlite_master WHERE type = 'table';"""
+        con = self.__connect()
+        if con is None:
+            return list(self.TABLES)
         try:
-            return sql3.connect(self.DBPATH)
+            existing = {row[0] for row in con.execute(query)}
+        except sql3.Error as e:
+            self.logger.info(f"Error reading the database schema: {e}")
+            existing = set()
+        finally:
+            con.close()
+        return [table for table in self.TABLES if table not in existing]
+
+    def __connect(self):
+        """
+        Open a new connection to the database, in WAL mode.
+
+        With WAL, readers never wait for a writer and a writer only waits
+        for another writer; synchronous=NORMAL then syncs on checkpoints
+        rather than on every commit, which cannot corrupt the database.
+        """
+        if self.DBPATH is None:
+            return None
+        try:
+            con = sql3.connect(self.DBPATH, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
+            con.execute("PRAGMA journal_mode = WAL;")
+            con.execute("PRAGMA synchronous = NORMAL;")
+            return con
         except sql3.Error as e:
             self.logger.info(f"Error connecting to database: {e}")
             return None
 
+    def __getConnection(self):
+        """
+        This thread's connection to the database, opened on its first query and reused for every later one.
+
+        sqlite3 connections may not be shared between threads, so every
+        connection handler gets its own; reusing it keeps the prepared
+        statements of its earlier queries. A connection is never used
+        across a fork: a worker process opens its own.
+        """
+        connections = getattr(_thread_connections, "by_path", None)
+        if connections is None or _thread_connections.pid != os.getpid():
+            connections = _thread_connections.by_path = {}
+            _thread_connections.pid = os.getpid()
+        con = connections.get(self.DBPATH)
+        if con is None:
+            con = self.__connect()
+            if con is not None:
+                connections[self.DBPATH] = con
+        return con
+
     def validate_user(self, username: str, password: str) -> bool:
         query = """SELECT password FROM Users WHERE username = ?;"""
         with  self.__getConnection() as con:
@@ -237,7 +321,13 @@ class ServerDB:
                 self.logger.info(f"Error fetching permission by name {name}: {e}")
                 return None
 
-    def add_user_logged_in(self, user_id: int, auth_key: str):
+    def add_user_logged_in(self, user_id: int, auth_key: str, user: Optional[dict] = None):
+        """
+        Log the user in under ``auth_key``, replacing any earlier login.
+
+        ``user``, as returned by ``get_user_by_username``, is written through
+        to the session cache, so the user's commands need no query.
+        """
         query = """INSERT INTO LoggedIn (userID, authKey,login_datetime) VALUES (?, ?,?);"""
         try:
             with  self.__getConnection() as con:
@@ -246,11 +336,18 @@ class ServerDB:
                 con.execute(query, (user_id, auth_key, str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))))
                 con.commit()
         except sql3.IntegrityError:
-            con.close()
             self.remove_user_logged_in(user_id)
-            self.add_user_logged_in(user_id, auth_key)
+            self.add_user_logged_in(user_id, auth_key, user)
+            return
         except sql3.Error as e:
             self.logger.info(f"Error adding logged in user ID '{user_id}': {e}")
+            return
+        if user is None:
+            session_cache.invalidate_user(user_id)
+        else:
+            session_cache.put(auth_key, {"id": user_id, "username": user["username"], "role": user["role"],
+                                         "access_path": user["access_path"],
+                                         "expires": time.time() + SESSION_LIFETIME})
 
     def get_user_by_login_key(self, auth_key: str) -> dict:
         query = """SELECT u.username, u.role, u.permName,u.accessPath, p.read, p.write
@@ -301,6 +398,7 @@ class ServerDB:
 
     def remove_user_logged_in(self, user_id: int):
         query = """DELETE FROM LoggedIn WHERE userID = ?;"""
+        session_cache.invalidate_user(user_id)
         with  self.__getConnection() as con:
             if con is None:
                 return
@@ -315,44 +413,72 @@ class ServerDB:
 
     def remove_user(self, username: str):
         query = """DELETE FROM Users WHERE username = ?;"""
+        user_id = self.get_userid_by_username(username)
         with  self.__getConnection() as con:
             if con is None:
                 return
             try:
                 con.execute(query, (username,))
                 con.commit()
+                if user_id is not None:
+                    session_cache.invalidate_user(user_id)
                 self.logger.info(f"User '{username}' logged out.")
                 return
             except sql3.Error as e:
                 self.logger.info(f"Error logging out user ID '{username}': {e}")
                 return
 
-    def check_user_login_by_auth_key(self, auth_key: str) -> bool:
-        query = """SELECT u.id,l.login_datetime
+    def get_session(self, auth_key: str) -> Optional[dict]:
+        """
+        The session of a valid ``auth_key``, as kept by the session cache, or None.
+
+        Answered from the cache when it can be; otherwise the login is looked
+        up and cached. An expired login is removed.
+        """
+        session = session_cache.get(auth_key)
+        if session is not None:
+            return session
+        query = """SELECT u.id, u.username, u.role, u.accessPath, l.login_datetime
                    FROM Users u
                    JOIN LoggedIn l ON l.userID = u.id
-                   LEFT JOIN Permission p ON u.permName = p.name
                    WHERE l.authKey = ?;"""
         with self.__getConnection() as con:
             if con is None:
-                return False
+                return None
             try:
                 cur = con.execute(query, (auth_key,))
                 check = cur.fetchone()
             except sql3.Error as e:
                 self.logger.info(f"Error checking login by auth key {auth_key}: {e}")
-                return False
-        if check:
-            login_time = datetime.datetime.fromisoformat(check[1])
-            if datetime.datetime.now() - login_time <= datetime.timedelta(minutes=15):
-                return True
-            else:
-                self.remove_user_logged_in(int(check[0]))
-        return False
+                return None
+        if check is None:
+            return None
+        expires = datetime.datetime.fromisoformat(check[4]).timestamp() + SESSION_LIFETIME
+        if time.time() > expires:
+            self.remove_user_logged_in(int(check[0]))
+            return None
+        session = {"id": int(check[0]), "username": check[1], "role": check[2], "access_path": check[3],
+                   "expires": expires}
+        session_cache.put(auth_key, session)
+        return session
+
+    def check_user_login_by_auth_key(self, auth_key: str) -> bool:
+        return self.get_session(auth_key) is not None
+
+
+def server_db() -> ServerDB:
+    """The database every handler in this process queries, built on first use; the server builds it at startup."""
+    global _server_db
+    if _server_db is None:
+        with _server_db_lock:
+            if _server_db is None:
+                _server_db = ServerDB()
+    return _server_db
 
 
 def main():
     db = ServerDB()
+    db.create_tables()
     db.add_permission("restricted", True, False)
     db.add_user("ehsan", "123456", "user", access_path="/home/ehsan/Desktop")
     db.add_user("mohammad", "12345678", "admin", access_path="/home")
@@ -2,34 +2,41 @@ import os
 from shutil import rmtree
 from socket import socket
 
-from Server.db_manage import ServerDB
+from Server.data_port_pool import data_port_pool
+from Server.db_manage import server_db
 from Server.logging_config import server_logger
+from utils.AES_handler import data_encryption
+from utils.archive import choose_archive_compression, receive_archive, send_archive
 from utils.auth import generate_user_auth_hash
+from utils.checksum_cache import checksum_cache, file_key
 from utils.command_codes import code_command_dict
+from utils.compression import COMPRESSION_THRESHOLD, DEFAULT_CODEC, choose_codec
 from utils.ftp_status_code import FTPStatusCode as FTPSTATUS
-from utils.path_tools import process_path, validate_path
-from utils.receive_file import retrieve_file
+from utils.hashing import DEFAULT_HASH_ALGORITHM, choose_hash_algorithm, hash_prefix, new_hasher
+from utils.mux import MUX_TRANSPORT, MuxStream
+from utils.path_tools import is_relative_inside, process_path, validate_path, walk_tree
+from utils.serializers import SERIALIZERS, choose_encoding
+from utils.receive_file import retrieve_batch, retrieve_file, retrieve_segments
 from utils.request_parser import request_parser
-from utils.send_file import get_file_info, create_transmit_socket
-from utils.send_file import send_file
+from utils.send_file import get_file_info, manifest_entry, send_batch, send_file, send_segments
 from utils.standard_response import StandardResponse
+from utils.transfer_journal import read_journal, resume_offset
+from utils.tuning import choose_segments, tuning
 
 # Global variables
 loggedInUsers = []
 command_list = [
     "login", "upload", "download", "mkdir", "rmdir",
     "cd", "resume", "rename", "list", "help.txt", "quit",
-    "exit", "dir", "ls", "rm"
+    "exit", "dir", "ls", "rm", "mput", "mget"
 ]
 
 # Change the current working directory to the server start path
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 
-def user_request_process(data, conn):
+def user_request_process(user_request, conn):
     """Process the user request and return command, arguments, and current directory."""
-    user_request = request_parser(data)
-
     command = code_command_dict.get(user_request["command"])
     if command is None:
         send_command_not_implemented(conn)
@@ -41,8 +48,9 @@ def user_request_process(data, conn):
 
     if command == "login":
         return command, args, None, None
-    db = ServerDB()
-    if not db.check_user_login_by_auth_key(auth_key):
+    if command == "negotiate":
+        return command, args, None, data
+    if not server_db().check_user_login_by_auth_key(auth_key):
         send_logged_in_error(conn)
         return None, None, None, None
 
@@ -53,28 +61,66 @@ def user_request_process(data, conn):
     return command, args, user_current_directory, data
 
 
-def command_parser(data, conn, addr):
+def command_parser(data, conn, addr, flags=0):
     """Parse and execute the command received from the user."""
+    execute_request(request_parser(data, flags), conn, addr)
+
+
+def is_multiplexed_transfer(user_request) -> bool:
+    """
+    True for a transfer whose data travels on the control connection.
+
+    It must run beside the connection's reader rather than in its place,
+    since the reader is what delivers the transfer's data.
+    """
+    return (code_command_dict.get(user_request.get("command")) in ("upload", "download", "resume", "mput", "mget")
+            and (user_request.get("data") or {}).get("transport") == MUX_TRANSPORT)
+
+
+def open_data_endpoint(request_data, conn, connections=1):
+    """
+    Where the data connections of a transfer come from.
+
+    A transfer asked for with the "mux" transport gets a stream on the
+    control connection, keyed by its request id; any other transfer leases
+    a data port for ``connections`` connections.
+    """
+    if (request_data or {}).get("transport") == MUX_TRANSPORT:
+        return conn.channel.mux.open(conn.request_id)
+    return data_port_pool.lease(conn.getsockname()[0], connections)
+
+
+def data_endpoint_info(endpoint) -> dict:
+    """The reply fields that tell the client how to reach ``endpoint``."""
+    if isinstance(endpoint, MuxStream):
+        return {"transport": MUX_TRANSPORT}
+    return {"transmit_port": endpoint.port, "transmit_token": endpoint.token.hex()}
+
+
+def execute_request(user_request, conn, addr):
+    """Execute an already parsed user request."""
     server_logger.info(f"Received command from {addr}")
-    command, args, user_current_directory, data = user_request_process(data, conn)
+    command, args, user_current_directory, data = user_request_process(user_request, conn)
     if not command:
         server_logger.warning(f"Invalid command received from {addr}")
         return
     try:
         command_handlers = {
             "login": lambda: login_handler(args, conn, addr),
+            "negotiate": lambda: negotiate_handler(data, conn),
             "upload": lambda: upload_handler(args, data, user_current_directory,addr, conn),
-            "download": lambda: download_handler(args, user_current_directory, conn),
+            "download": lambda: download_handler(args, user_current_directory, data, conn),
             "cd": lambda: change_dir_handler(args, user_current_directory, conn),
             "pwd": lambda: handle_dir_command(user_current_directory, conn),
             "rename": lambda: rename_handler(args, user_current_directory, conn),
             "list": lambda: list_handler(args, user_current_directory, data, conn),
             "ls": lambda: list_handler(args, user_current_directory, data, conn),
-            "mkdir": lambda: mkdir_handler(args, user_current_directory, conn),
+            "mkdir": lambda: mkdir_handler(args, user_current_directory, data, conn),
             "rmdir": lambda: rmdir_handler(args, user_current_directory, data, conn),
             "rm": lambda: remove_file_handler(args, user_current_directory, conn),
-            "resume": lambda:
-            "pass",
+            "resume": lambda: resume_handler(args, user_current_directory, data, addr, conn),
+            "mput": lambda: mput_handler(data, user_current_directory, addr, conn),
+            "mget": lambda: mget_handler(args, user_current_directory, data, conn),
         }
 
         handler = command_handlers.get(command, lambda: send_command_not_implemented(conn))
@@ -100,18 +146,25 @@ def send_syntax_error(conn):
     StandardResponse(accept=False, status_code=FTPSTATUS.SYNTAX_ERROR_IN_PARAMETERS).serialize_and_send(conn)
 
 
-def download_handler(args, user_current_directory, conn):
+def download_handler(args, user_current_directory, data, conn):
     """Handle the download request."""
     try:
         dir_path = process_path(args["0"], user_current_directory)
-        file_data = get_file_info(dir_path)
-        server_logger.info(f"create transmit socket on {conn.getsockname()[0]}")
-        transmit_socket, port = create_transmit_socket(conn.getsockname()[0])
-        file_data["transmit_port"] = port
-        file_name = os.path.basename(file_data["file_path"])
-        StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK, data=file_data).serialize_and_send(conn)
-        send_file(dir_path, transmit_socket, file_data["file_size"], file_name, False)
-        transmit_socket.close()
+        hash_algorithm = choose_hash_algorithm((data or {}).get("hash_algorithms"))
+        key = data_encryption.choose(data)
+        if os.path.isdir(dir_path) and "archive_compressions" in (data or {}):
+            send_archive_download(dir_path, data, hash_algorithm, conn, key)
+            return
+        file_data = get_file_info(dir_path, hash_algorithm)
+        file_data["data_codec"] = choose_codec((data or {}).get("data_codecs"))
+        file_data.update(data_encryption.reply(key))
+        if (data or {}).get("transport") == MUX_TRANSPORT:
+            # One connection already carries everything; splitting the file over it gains nothing.
+            file_data["transport"] = MUX_TRANSPORT
+            file_data["segments"] = 1
+        else:
+            file_data["segments"] = choose_segments(file_data["file_size"], (data or {}).get("segments", 1))
+        send_download(dir_path, file_data, hash_algorithm, conn, key=key)
     except PermissionError:
         StandardResponse(accept=False, status_code=FTPSTATUS.PERMISSION_DENIED).serialize_and_send(conn)
     except KeyError:
@@ -121,6 +174,53 @@ def download_handler(args, user_current_directory, conn):
             conn)
 
 
+def send_download(dir_path, file_data, hash_algorithm, conn, hasher=None, offset=0, key=None):
+    """
+    Open the data endpoint, announce it with ``file_data`` and send the file from ``offset``, encrypted with ``key``.
+
+    With more than one ``file_data["segments"]`` the file is sent over that many connections instead.
+    """
+    segments = file_data.get("segments", 1)
+    transmit_socket = open_data_endpoint(file_data, conn, segments)
+    file_data.update(data_endpoint_info(transmit_socket))
+    server_logger.info(f"Sending {dir_path} through {file_data.get('transmit_port', MUX_TRANSPORT)}")
+    file_name = os.path.basename(file_data["file_path"])
+    checksum = file_data.get("checksum")
+    codec = file_data.get("data_codec", DEFAULT_CODEC)
+    try:
+        StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK, data=file_data).serialize_and_send(conn)
+        if segments > 1:
+            # Every segment is verified on its own; there is no whole-file digest to cache.
+            send_segments(dir_path, transmit_socket, file_data["file_size"], file_name, segments, False,
+                          hash_algorithm=hash_algorithm, codec=codec, key=key)
+        elif checksum:
+            send_file(dir_path, transmit_socket, file_data["file_size"], file_name, False, checksum=checksum,
+                      offset=offset, codec=codec, key=key)
+        else:
+            # Hash while sending, and keep the result for the next download of the same file.
+            cache_key = file_key(dir_path)
+            hasher = hasher or new_hasher(hash_algorithm)
+            if send_file(dir_path, transmit_socket, file_data["file_size"], file_name, False, hasher=hasher,
+                         offset=offset, codec=codec, key=key):
+                checksum_cache.put(dir_path, hasher.hexdigest(), cache_key, hash_algorithm)
+    finally:
+        transmit_socket.close()
+
+
+def send_archive_download(dir_path, data, hash_algorithm, conn, key=None):
+    """Send the directory ``dir_path`` as a tar stream produced on the fly, encrypted with ``key``."""
+    compression = choose_archive_compression(data.get("archive_compressions"))
+    endpoint = open_data_endpoint(data, conn)
+    server_logger.info(f"Sending directory {dir_path} as a {compression} archive")
+    try:
+        StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK,
+                         data={"archive": compression, "file_path": dir_path, "hash_algorithm": hash_algorithm,
+                               **data_encryption.reply(key), **data_endpoint_info(endpoint)}).serialize_and_send(conn)
+        send_archive(dir_path, endpoint, compression, False, hash_algorithm=hash_algorithm, key=key)
+    finally:
+        endpoint.close()
+
+
 def upload_handler(args, data, user_current_directory,addr, conn):
     """Handle the upload request"""
     file_name = ""
@@ -131,29 +231,38 @@ def upload_handler(args, data, user_current_directory,addr, conn):
             if not validate_path(dir_path, dir_check=True):
                 raise NotADirectoryError
 
+        key = data_encryption.choose(data)
+        if data.get("archive"):
+            receive_archive_upload(addr, dir_path, data, conn, key)
+            return
+
         file_name = os.path.basename(data["file_path"])
         server_logger.info(f"Upload request for file: {file_name} to directory: {dir_path}")
 
-        StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK).serialize_and_send(conn)
-        server_logger.info(f"Start reciving from {addr[0]}:{data["transmit_port"]}")
-        rec_result = retrieve_file(
-            addr[0],
-            dir_path,
-            data["transmit_port"],
-            file_name,
-            data["file_size"],
-            data["buffer_size"],
-            data["checksum"],
-            False
-        )
-        
-        if rec_result:
-            server_logger.info(f"Successful upload of file: {file_name}")
-            StandardResponse(accept=True, status_code=FTPSTATUS.REQUESTED_FILE_ACTION_OK).serialize_and_send(conn)
-        else:
-            server_logger.warning(f"Failed upload of file: {file_name}")
-            StandardResponse(accept=False,
-                             status_code=FTPSTATUS.REQUESTED_ACTION_NOT_TAKEN_FILE_UNAVAILABLE).serialize_and_send(conn)
+        hash_algorithm = choose_hash_algorithm(data.get("hash_algorithms"))
+        # A checksum the client already knew is only useful if it was made with the agreed algorithm.
+        checksum = None
+        if data.get("hash_algorithm", DEFAULT_HASH_ALGORITHM) == hash_algorithm:
+            checksum = data.get("checksum")
+        segments = 1
+        if data.get("transport") != MUX_TRANSPORT:
+            segments = choose_segments(data["file_size"], data.get("segments", 1))
+        # The client connects to a leased data port of ours and proves with the token which transfer it is,
+        # or sends the data on the control connection.
+        endpoint = open_data_endpoint(data, conn, segments)
+        try:
+            StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK,
+                             data={"hash_algorithm": hash_algorithm, "file_path": os.path.join(dir_path, file_name),
+                                   "segments": segments, "data_codec": choose_codec(data.get("data_codecs")),
+                                   **data_encryption.reply(key),
+                                   **data_endpoint_info(endpoint)}).serialize_and_send(conn)
+            if segments > 1:
+                receive_upload_segments(addr, dir_path, file_name, data, hash_algorithm, segments, endpoint, conn,
+                                        key)
+            else:
+                receive_upload(addr, dir_path, file_name, data, hash_algorithm, endpoint, conn, checksum, key=key)
+        finally:
+            endpoint.close()
 
     except PermissionError:
         server_logger.error(f"Permission denied for file upload: {file_name}")
@@ -173,6 +282,260 @@ def upload_handler(args, data, user_current_directory,addr, conn):
             conn)
 
 
+def receive_upload(addr, dir_path, file_name, data, hash_algorithm, endpoint, conn, checksum=None, hasher=None,
+                   offset=0, key=None):
+    """
+    Receive an accepted upload through ``endpoint`` from ``offset`` on, decrypting it with ``key``,
+    and report the outcome to the client.
+    """
+    server_logger.info(f"Start reciving from {addr[0]}")
+    hasher = hasher or new_hasher(hash_algorithm)
+    rec_result, error = retrieve_file(
+        addr[0],
+        dir_path,
+        None,
+        file_name,
+        data["file_size"],
+        data["buffer_size"],
+        checksum,
+        False,
+        hash_algorithm=hash_algorithm,
+        hasher=hasher,
+        offset=offset,
+        journal={"direction": "upload"},
+        listener=endpoint,
+        key=key
+    )
+
+    if rec_result:
+        server_logger.info(f"Successful upload of file: {file_name}")
+        # The upload was hashed as it was written; downloads of it need not hash it again.
+        checksum_cache.put(os.path.join(dir_path, file_name), hasher.hexdigest(), algorithm=hash_algorithm)
+        StandardResponse(accept=True, status_code=FTPSTATUS.REQUESTED_FILE_ACTION_OK).serialize_and_send(conn)
+    else:
+        server_logger.warning(f"Failed upload of file: {file_name}: {error}")
+        StandardResponse(accept=False, status_code=FTPSTATUS.REQUESTED_ACTION_NOT_TAKEN_FILE_UNAVAILABLE,
+                         data=error).serialize_and_send(conn)
+
+
+def receive_archive_upload(addr, dir_path, data, conn, key=None):
+    """Extract a directory uploaded as a tar stream into ``dir_path`` as it arrives and report the outcome."""
+    compression = choose_archive_compression(data.get("archive_compressions"))
+    hash_algorithm = choose_hash_algorithm(data.get("hash_algorithms"))
+    name = os.path.basename(data["file_path"])
+    server_logger.info(f"Archive upload of directory: {name} to directory: {dir_path}")
+    endpoint = open_data_endpoint(data, conn)
+    try:
+        StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK,
+                         data={"archive": compression, "hash_algorithm": hash_algorithm,
+                               **data_encryption.reply(key), **data_endpoint_info(endpoint)}).serialize_and_send(conn)
+        rec_result, error = receive_archive(addr[0], dir_path, None, compression, False,
+                                            hash_algorithm=hash_algorithm, listener=endpoint, key=key)
+    finally:
+        endpoint.close()
+
+    if rec_result:
+        server_logger.info(f"Successful upload of directory: {name}")
+        StandardResponse(accept=True, status_code=FTPSTATUS.REQUESTED_FILE_ACTION_OK).serialize_and_send(conn)
+    else:
+        server_logger.warning(f"Failed upload of directory: {name}: {error}")
+        StandardResponse(accept=False, status_code=FTPSTATUS.REQUESTED_ACTION_NOT_TAKEN_FILE_UNAVAILABLE,
+                         data=error).serialize_and_send(conn)
+
+
+def receive_upload_segments(addr, dir_path, file_name, data, hash_algorithm, segments, lease, conn, key=None):
+    """Receive an accepted upload over ``segments`` data connections and report the outcome to the client."""
+    server_logger.info(f"Start reciving {segments} segments from {addr[0]} on data port {lease.port}")
+    rec_result, error = retrieve_segments(addr[0], dir_path, lease.port, file_name, data["file_size"],
+                                          data["buffer_size"], segments, False, hash_algorithm=hash_algorithm,
+                                          listener=lease, key=key)
+    if rec_result:
+        server_logger.info(f"Successful upload of file: {file_name}")
+        StandardResponse(accept=True, status_code=FTPSTATUS.REQUESTED_FILE_ACTION_OK).serialize_and_send(conn)
+    else:
+        server_logger.warning(f"Failed upload of file: {file_name}: {error}")
+        StandardResponse(accept=False, status_code=FTPSTATUS.REQUESTED_ACTION_NOT_TAKEN_FILE_UNAVAILABLE,
+                         data=error).serialize_and_send(conn)
+
+
+def resume_handler(args, user_current_directory, data, addr, conn):
+    """
+    Continue an interrupted transfer after the bytes the receiving side already holds.
+
+    For a download the client sends the length of its partial file and a
+    digest of it, which must match the same prefix of the file here. For
+    an upload the roles swap: the server reports its partial file and the
+    client checks it. Either way the sender carries on hashing from the
+    verified prefix, so the usual trailer still covers the whole file.
+    """
+    try:
+        path = process_path(args["0"], user_current_directory)
+        if data["direction"] == "upload":
+            resume_upload(path, data, addr, conn)
+        else:
+            resume_download(path, data, conn)
+    except PermissionError:
+        StandardResponse(accept=False, status_code=FTPSTATUS.PERMISSION_DENIED).serialize_and_send(conn)
+    except (KeyError, ValueError):
+        StandardResponse(accept=False, status_code=FTPSTATUS.SYNTAX_ERROR_IN_PARAMETERS).serialize_and_send(conn)
+    except FileNotFoundError:
+        StandardResponse(accept=False, status_code=FTPSTATUS.FILE_UNAVAILABLE).serialize_and_send(conn)
+    except Exception as e:
+        server_logger.exception(f"Unexpected error while resuming a transfer: {e}")
+        StandardResponse(accept=False, status_code=FTPSTATUS.LOCAL_ERROR_IN_PROCESSING, data=str(e)).serialize_and_send(
+            conn)
+
+
+def resume_download(path, data, conn):
+    hash_algorithm = data["hash_algorithm"]
+    key = data_encryption.choose(data)
+    offset = int(data["offset"])
+    file_data = get_file_info(path, hash_algorithm)
+    if file_data["file_size"] != data["file_size"] or not 0 <= offset <= file_data["file_size"]:
+        StandardResponse(accept=False, status_code=FTPSTATUS.REQUESTED_ACTION_NOT_TAKEN_FILE_UNAVAILABLE,
+                         data="The file changed since the download started").serialize_and_send(conn)
+        return
+    with open(path, "rb") as f:
+        hasher = hash_prefix(f, hash_algorithm, offset)
+    if hasher.copy().hexdigest() != data["prefix_checksum"]:
+        StandardResponse(accept=False, status_code=FTPSTATUS.REQUESTED_ACTION_NOT_TAKEN_FILE_UNAVAILABLE,
+                         data="The partial file does not match the file on the server").serialize_and_send(conn)
+        return
+    server_logger.info(f"Resuming download of {path} at byte {offset}")
+    file_data["offset"] = offset
+    file_data["data_codec"] = choose_codec(data.get("data_codecs"))
+    file_data.update(data_encryption.reply(key))
+    if data.get("transport") == MUX_TRANSPORT:
+        file_data["transport"] = MUX_TRANSPORT
+    send_download(path, file_data, hash_algorithm, conn, hasher, offset, key)
+
+
+def resume_upload(path, data, addr, conn):
+    journal = read_journal(path)
+    if journal is None or journal.get("file_size") != data["file_size"]:
+        StandardResponse(accept=False, status_code=FTPSTATUS.REQUESTED_ACTION_NOT_TAKEN_FILE_UNAVAILABLE,
+                         data="There is no interrupted upload of this file to resume").serialize_and_send(conn)
+        return
+    hash_algorithm = choose_hash_algorithm(data.get("hash_algorithms"))
+    key = data_encryption.choose(data)
+    offset = resume_offset(path, journal)
+    with open(path, "rb") as f:
+        hasher = hash_prefix(f, hash_algorithm, offset)
+    server_logger.info(f"Resuming upload of {path} at byte {offset}")
+    endpoint = open_data_endpoint(data, conn)
+    try:
+        StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK,
+                         data={"hash_algorithm": hash_algorithm, "file_path": path, "offset": offset,
+                               "prefix_checksum": hasher.copy().hexdigest(),
+                               "data_codec": choose_codec(data.get("data_codecs")),
+                               **data_encryption.reply(key), **data_endpoint_info(endpoint)}).serialize_and_send(conn)
+        receive_upload(addr, os.path.dirname(path), os.path.basename(path), data, hash_algorithm, endpoint, conn,
+                       hasher=hasher, offset=offset, key=key)
+    finally:
+        endpoint.close()
+
+
+def mput_handler(data, user_current_directory, addr, conn):
+    """
+    Receive many files into the current directory over one data stream.
+
+    ``data["files"]`` is the manifest (path, size, mode and optionally
+    checksum of every file); the files arrive in that order and each is
+    written and verified as its stream comes in. The final reply lists the
+    files that failed.
+    """
+    try:
+        manifest = data["files"]
+        if not manifest or not all(is_relative_inside(entry["path"]) for entry in manifest):
+            raise KeyError("files")
+        hash_algorithm = choose_hash_algorithm(data.get("hash_algorithms"))
+        if data.get("hash_algorithm", DEFAULT_HASH_ALGORITHM) != hash_algorithm:
+            # Checksums the client already knew were made with another algorithm.
+            manifest = [{key: value for key, value in entry.items() if key != "checksum"} for entry in manifest]
+        key = data_encryption.choose(data)
+        server_logger.info(f"Batch upload of {len(manifest)} files to directory: {user_current_directory}")
+        endpoint = open_data_endpoint(data, conn)
+        try:
+            StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK,
+                             data={"hash_algorithm": hash_algorithm,
+                                   "data_codec": choose_codec(data.get("data_codecs")), **data_encryption.reply(key),
+                                   **data_endpoint_info(endpoint)}).serialize_and_send(conn)
+            checksums, errors = retrieve_batch(addr[0], user_current_directory, None, manifest, data["buffer_size"],
+                                               False, hash_algorithm=hash_algorithm, listener=endpoint, key=key)
+        finally:
+            endpoint.close()
+        for path, checksum in checksums.items():
+            checksum_cache.put(os.path.join(user_current_directory, path), checksum, algorithm=hash_algorithm)
+
+        if errors:
+            server_logger.warning(f"Batch upload: {len(errors)} of {len(manifest)} files failed")
+            StandardResponse(accept=False, status_code=FTPSTATUS.REQUESTED_ACTION_NOT_TAKEN_FILE_UNAVAILABLE,
+                             data=errors).serialize_and_send(conn)
+        else:
+            StandardResponse(accept=True, status_code=FTPSTATUS.REQUESTED_FILE_ACTION_OK).serialize_and_send(conn)
+
+    except PermissionError:
+        StandardResponse(accept=False, status_code=FTPSTATUS.PERMISSION_DENIED).serialize_and_send(conn)
+    except (KeyError, TypeError):
+        server_logger.error("Invalid batch upload parameters")
+        StandardResponse(accept=False, status_code=FTPSTATUS.SYNTAX_ERROR_IN_PARAMETERS).serialize_and_send(conn)
+    except Exception as e:
+        server_logger.exception(f"Unexpected error during batch upload: {e}")
+        StandardResponse(accept=False, status_code=FTPSTATUS.LOCAL_ERROR_IN_PROCESSING, data=str(e)).serialize_and_send(
+            conn)
+
+
+def mget_handler(args, user_current_directory, data, conn):
+    """
+    Send many files over one data stream.
+
+    The reply carries the manifest of the files that can be sent, and the
+    error of each one that cannot; the files then follow in manifest order.
+    Files are listed by base name, or with the "keep_paths" option by the
+    relative path they were asked for, so a directory tree can be rebuilt.
+    """
+    try:
+        hash_algorithm = choose_hash_algorithm((data or {}).get("hash_algorithms"))
+        keep_paths = (data or {}).get("keep_paths", False)
+        manifest, file_paths, missing, names = [], [], {}, set()
+        for name in args.values():
+            path = process_path(name, user_current_directory)
+            if keep_paths and not is_relative_inside(name):
+                missing[name] = "Path leaves the current directory"
+                continue
+            entry_name = name if keep_paths else os.path.basename(path)
+            if entry_name in names:
+                missing[name] = "Another file of the batch has the same name"
+                continue
+            try:
+                manifest.append(manifest_entry(path, entry_name, hash_algorithm))
+                file_paths.append(path)
+                names.add(entry_name)
+            except (OSError, ValueError) as e:
+                missing[name] = getattr(e, "strerror", None) or str(e)
+        if not manifest:
+            StandardResponse(accept=False, status_code=FTPSTATUS.FILE_UNAVAILABLE, data=missing).serialize_and_send(
+                conn)
+            return
+
+        codec = choose_codec((data or {}).get("data_codecs"))
+        key = data_encryption.choose(data)
+        endpoint = open_data_endpoint(data, conn)
+        try:
+            StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK,
+                             data={"hash_algorithm": hash_algorithm, "files": manifest, "missing": missing,
+                                   "buffer_size": tuning.max_chunk_size, "data_codec": codec,
+                                   **data_encryption.reply(key),
+                                   **data_endpoint_info(endpoint)}).serialize_and_send(conn)
+            send_batch(file_paths, manifest, endpoint, False, hash_algorithm=hash_algorithm, codec=codec, key=key)
+        finally:
+            endpoint.close()
+    except Exception as e:
+        server_logger.exception(f"Unexpected error during batch download: {e}")
+        StandardResponse(accept=False, status_code=FTPSTATUS.LOCAL_ERROR_IN_PROCESSING, data=str(e)).serialize_and_send(
+            conn)
+
+
 def rmdir_handler(args, user_current_directory, data, conn):
     """Remove a directory."""
     try:
@@ -226,12 +589,12 @@ def login_handler(args: dict, conn: socket, addr):
     try:
         username = args["0"].split('@')[0]
         password = args["0"].split('@')[1]
-        db = ServerDB()
+        db = server_db()
         user_valid = db.validate_user(username, password)
         if user_valid:
             user_auth_key = generate_user_auth_hash(username, addr)
             user = db.get_user_by_username(username)
-            db.add_user_logged_in(user["id"], user_auth_key)
+            db.add_user_logged_in(user["id"], user_auth_key, user)
             StandardResponse(accept=True, status_code=FTPSTATUS.USER_LOGGED_IN,
                              data={"access_path": user["access_path"], "auth_token": user_auth_key}).serialize_and_send(
                 conn)
@@ -244,18 +607,43 @@ def login_handler(args: dict, conn: socket, addr):
             conn)
 
 
+def negotiate_handler(request_data, conn):
+    """Agree on the connection options the client offered, in the client's order of preference."""
+    try:
+        codec = choose_codec(request_data["codecs"])
+        encoding = choose_encoding(request_data.get("encodings"))
+        # The client may compress its requests as soon as it reads the reply.
+        conn.channel.accepted_codec = codec
+        StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK,
+                         data={"codec": codec, "compression_threshold": COMPRESSION_THRESHOLD,
+                               "encoding": encoding}).serialize_and_send(conn)
+        # Only replies sent after the agreement use it; every frame names its own codec and encoding anyway.
+        conn.channel.codec = codec
+        conn.channel.serializer = SERIALIZERS[encoding]
+    except (KeyError, TypeError, AttributeError):
+        StandardResponse(accept=False, status_code=FTPSTATUS.SYNTAX_ERROR_IN_PARAMETERS).serialize_and_send(conn)
+
+
 def list_handler(args: dict[str: str], user_current_dir: str, request_data, conn: socket):
     """List files in the specified directory."""
     if not args:
         args = {"0": user_current_dir}
 
     dir_path = process_path(args["0"], user_current_dir)
-    user_terminal_width = request_data["terminal_width"]
 
     if not os.path.isdir(dir_path):
         StandardResponse(accept=False, status_code=FTPSTATUS.PATH_NOT_DIRECTORY).serialize_and_send(conn)
         return
 
+    if (request_data or {}).get("recursive"):
+        # The whole tree in one reply, for a recursive download to plan its transfers from.
+        dirs, files = walk_tree(dir_path)
+        StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK,
+                         data={"path": dir_path, "dirs": dirs, "files": files}).serialize_and_send(conn)
+        return
+
+    user_terminal_width = request_data["terminal_width"]
+
     ls = os.listdir(dir_path)
     ls.sort()
     terminal_width = user_terminal_width
@@ -274,11 +662,12 @@ def list_handler(args: dict[str: str], user_current_dir: str, request_data, conn
     StandardResponse(accept=True, status_code=FTPSTATUS.COMMAND_OK, data=body).serialize_and_send(conn)
 
 
-def mkdir_handler(args, user_current_directory, conn):
-    """Make a directory."""
+def mkdir_handler(args, user_current_directory, data, conn):
+    """Make a directory; with the "parents" option, make any missing parents too and accept an existing one."""
     try:
-
-        if len(args["0"]) > 1:
+        if (data or {}).get("parents"):
+            os.makedirs(process_path(args["0"], user_current_directory), exist_ok=True)
+        elif len(args["0"]) > 1:
             dirs = str(args["0"]).strip().split("/")
             new_dir = user_current_directory
             for dir in dirs:
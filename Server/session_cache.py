@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+SESSION_LIFETIME = 15 * 60  # Seconds a login stays valid
+DEFAULT_MAX_SESSIONS = 1024
+DEFAULT_MAX_AGE = 60.0  # Seconds a cached session is trusted before it is checked against the database again
+
+
+class SessionCache:
+    """
+    Logged-in sessions by auth token, so authenticated commands need no database query.
+
+    Each session is a dict of the user's "id", "username", "role",
+    "access_path" and the epoch second it "expires" at. It is written
+    through on login and dropped when the user logs in again, is logged
+    out or removed through this process. Other processes (workers, the
+    manage script) change the database behind its back, so an entry is
+    only trusted for ``max_age`` seconds; after that the next command
+    looks the token up again. The least recently used of
+    ``max_entries`` sessions are kept.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_SESSIONS, max_age: float = DEFAULT_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()  # auth token -> (session, trusted until)
+        self.tokens = {}  # user id -> auth token; a login replaces the user's earlier one
+        self.lock = threading.Lock()
+
+    def get(self, auth_key: str) -> Optional[dict]:
+        """The session of ``auth_key`` if it is cached, still valid and recently checked; otherwise None."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(auth_key)
+            if entry is None:
+                return None
+            session, trusted_until = entry
+            if now > trusted_until or now > session["expires"]:
+                self._forget(auth_key)
+                return None
+            self.entries.move_to_end(auth_key)
+            return session
+
+    def put(self, auth_key: str, session: dict):
+        """Cache ``session`` for ``auth_key``, replacing any other token of the same user."""
+        trusted_until = time.time() + self.max_age
+        with self.lock:
+            self._forget(self.tokens.get(session["id"]))
+            self._forget(auth_key)
+            self.entries[auth_key] = (session, trusted_until)
+            self.tokens[session["id"]] = auth_key
+            while len(self.entries) > self.max_entries:
+                self._forget(next(iter(self.entries)))
+
+    def invalidate_user(self, user_id: int):
+        """Drop the cached session of ``user_id``, e.g. on logout or when the user is removed."""
+        with self.lock:
+            self._forget(self.tokens.get(user_id))
+
+    def _forget(self, auth_key: Optional[str]):
+        entry = self.entries.pop(auth_key, None)
+        if entry is not None and self.tokens.get(entry[0]["id"]) == auth_key:
+            del self.tokens[entry[0]["id"]]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens.clear()
+
+
+# Shared by every connection handler in the process.
+session_cache = SessionCache()
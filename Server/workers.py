@@ -0,0 +1,123 @@
+import os
+import signal
+import socket
+import time
+from typing import Callable
+
+from Server.logging_config import server_logger
+
+RESTART_DELAY = 1.0  # Seconds to wait before replacing a worker that died
+LISTEN_BACKLOG = 128
+
+REUSE_PORT_SUPPORTED = hasattr(socket, "SO_REUSEPORT")
+
+
+def create_listening_socket(ip: str, port: int, reuse_port: bool, listen: bool = True) -> socket.socket:
+    """Create a TCP socket bound to ``ip:port``, optionally sharing the port with sibling processes."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((ip, port))
+    if listen:
+        sock.listen(LISTEN_BACKLOG)
+    return sock
+
+
+class WorkerSupervisor:
+    """
+    Fork worker processes that accept control connections on one shared port.
+
+    With SO_REUSEPORT every worker binds its own listening socket and the
+    kernel balances new connections between them. Without it the supervisor
+    binds a single listening socket and the workers inherit it. Workers keep
+    no session state of their own: logins live in the ``LoggedIn`` table, so a
+    reconnect is valid whichever worker accepts it.
+    """
+
+    def __init__(self, ip: str, port: int, workers: int, run_worker: Callable[[socket.socket, int], None],
+                 reuse_port: bool = REUSE_PORT_SUPPORTED):
+        if not hasattr(os, "fork"):
+            raise OSError("Worker processes require os.fork, which is not available on this platform")
+        self.ip = str(ip)
+        self.port = int(port)
+        self.workers = int(workers)
+        self.run_worker = run_worker
+        self.reuse_port = reuse_port
+        self.sock = None
+        self.children = {}  # pid -> worker index
+
+    def bind_socket(self):
+        """Bind the shared port, moving to the next one if it is taken, like Server.bind_socket."""
+        while True:
+            try:
+                # In SO_REUSEPORT mode this socket only reserves the port; it never listens.
+                self.sock = create_listening_socket(self.ip, self.port, self.reuse_port, listen=not self.reuse_port)
+                break
+            except OSError:
+                self.port += 1
+
+    def worker_socket(self) -> socket.socket:
+        if self.reuse_port:
+            self.sock.close()
+            return create_listening_socket(self.ip, self.port, reuse_port=True)
+        return self.sock
+
+    def spawn_worker(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                server_logger.info(f"Worker {index} started with pid {os.getpid()}")
+                self.run_worker(self.worker_socket(), index)
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                server_logger.exception(f"Worker {index} crashed: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.children[pid] = index
+
+    def handle_sigterm(self, signum, frame):
+        raise KeyboardInterrupt
+
+    def start(self):
+        self.bind_socket()
+        server_logger.info(f"Server running on {self.ip}:{self.port} with {self.workers} workers "
+                           f"({'SO_REUSEPORT' if self.reuse_port else 'shared listening socket'})")
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        for index in range(self.workers):
+            self.spawn_worker(index)
+
+    def supervise(self):
+        """Wait for workers and replace any that exit until the supervisor is stopped."""
+        try:
+            while True:
+                pid, status = os.wait()
+                index = self.children.pop(pid, None)
+                if index is None:
+                    continue
+                server_logger.info(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)},"
+                                   f" restarting")
+                time.sleep(RESTART_DELAY)
+                self.spawn_worker(index)
+        except KeyboardInterrupt:
+            server_logger.info("Server stopped.")
+            self.shutdown()
+
+    def shutdown(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self.children.pop(pid, None)
+        if self.sock:
+            self.sock.close()
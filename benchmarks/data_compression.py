@@ -0,0 +1,98 @@
+"""
+Effective throughput of a file transfer with every data codec, over a link of limited bandwidth.
+
+The file is sent with send_stream through a local socket pair whose
+sending side is throttled to --link-rate bytes per second (0 for no
+limit), and received with receive_stream, the way transfers do it.
+Effective throughput is file bytes delivered per second; on a link slower
+than the compressor, compressible data gains about its compression ratio.
+
+Usage: python -m benchmarks.data_compression [--size BYTES] [--link-rate BYTES] [--file PATH]
+"""
+import argparse
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+
+from utils.compression import CODECS
+from utils.hashing import new_hasher
+from utils.receive_file import receive_stream
+from utils.send_file import send_stream
+from utils.tuning import DEFAULT_RECEIVE_BUFFER, parse_bytes
+
+
+class ThrottledConnection:
+    """The sending end of the socket pair, limited to ``rate`` bytes per second; counts the bytes on the wire."""
+
+    def __init__(self, sock: socket.socket, rate: int):
+        self.sock = sock
+        self.rate = rate
+        self.sent = 0
+        self.started = time.perf_counter()
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.sent += len(data)
+        if self.rate:
+            delay = self.sent / self.rate - (time.perf_counter() - self.started)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def bench(path: str, codec: str, rate: int):
+    """Send the file once; return (seconds, bytes on the wire)."""
+    size = os.path.getsize(path)
+    sender, receiver = socket.socketpair()
+    with sender, receiver, open(os.devnull, "wb") as sink:
+        thread = threading.Thread(target=receive_stream, args=(receiver, sink, size, DEFAULT_RECEIVE_BUFFER))
+        thread.start()
+        connection = ThrottledConnection(sender, rate)
+        with open(path, "rb") as f:
+            send_stream(connection, f, size, hasher=new_hasher(), codec=codec)
+        thread.join()
+        return time.perf_counter() - connection.started, connection.sent
+
+
+def write_samples(directory: str, size: int) -> dict:
+    """A CSV-like log, which compresses well, and random bytes, which do not."""
+    rng = random.Random(1)
+    log_path = os.path.join(directory, "access.csv")
+    with open(log_path, "w") as f:
+        written, line = 0, 0
+        while written < size:
+            row = (f"{line},2026-10-18T12:{line % 60:02d}:00,INFO,user{rng.randint(0, 500)},"
+                   f"GET /api/v1/items/{rng.randint(0, 99999)},200,{rng.random():.4f}\n")
+            written += f.write(row)
+            line += 1
+    random_path = os.path.join(directory, "random.bin")
+    with open(random_path, "wb") as f:
+        f.write(os.urandom(size))
+    return {"csv log": log_path, "random": random_path}
+
+
+def main(size: int, rate: int, file_path: str = None):
+    with tempfile.TemporaryDirectory() as directory:
+        samples = {os.path.basename(file_path): file_path} if file_path else write_samples(directory, size)
+        print(f"{'data':<16}{'codec':<8}{'wire MiB':>10}{'ratio':>8}{'MiB/s':>10}{'gain':>8}")
+        for name, path in samples.items():
+            size = os.path.getsize(path)
+            baseline = None
+            for codec in CODECS:
+                seconds, wire = bench(path, codec, rate)
+                throughput = size / seconds
+                baseline = baseline or throughput
+                print(f"{name:<16}{codec:<8}{wire / 1024 ** 2:>10.1f}{size / wire:>8.2f}"
+                      f"{throughput / 1024 ** 2:>10.1f}{throughput / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=parse_bytes, default="32M", help="Bytes per sample file (K/M/G suffixes allowed)")
+    parser.add_argument("--link-rate", type=parse_bytes, default="12M",
+                        help="Bytes per second the link carries, 0 for no limit (default: 12M, about 100 Mbit/s)")
+    parser.add_argument("--file", help="Send this file instead of the generated samples")
+    args = parser.parse_args()
+    main(args.size, args.link_rate, args.file)
@@ -0,0 +1,108 @@
+"""
+Cost of encrypting the data channel: transfer throughput with and without a data key.
+
+A file is sent with send_stream over a loopback TCP connection and
+received with receive_stream, the way transfers do it: once in plaintext
+(zero-copy sendfile) and once encrypted and authenticated chunk by chunk.
+The cipher alone is also timed per chunk size, next to AES_encryptor,
+which builds a new AES object for every message it encrypts.
+
+Usage: python -m benchmarks.data_encryption [--size BYTES] [--repeat N]
+"""
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from utils.AES_handler import AES_encryptor, SEALED_CHUNK_SIZE, StreamCipher
+from utils.hashing import new_hasher
+from utils.receive_file import receive_stream
+from utils.send_file import send_stream
+from utils.tuning import DEFAULT_RECEIVE_BUFFER, parse_bytes
+
+CHUNK_SIZES = [16 * 1024, 256 * 1024, SEALED_CHUNK_SIZE]
+
+
+def connected_pair():
+    """Both ends of a loopback TCP connection."""
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        client = socket.create_connection(server.getsockname())
+        connection, addr = server.accept()
+    return client, connection
+
+
+def bench_transfer(path: str, key, repeat: int) -> float:
+    """Best seconds to send the file over loopback TCP."""
+    size = os.path.getsize(path)
+    best = float("inf")
+    for _ in range(repeat):
+        sender, receiver = connected_pair()
+        with sender, receiver, open(os.devnull, "wb") as sink, open(path, "rb") as f:
+            thread = threading.Thread(target=receive_stream,
+                                      args=(receiver, sink, size, DEFAULT_RECEIVE_BUFFER),
+                                      kwargs={"key": key})
+            started = time.perf_counter()
+            thread.start()
+            send_stream(sender, f, size, hasher=new_hasher(), key=key)
+            thread.join()
+            best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_cipher(data: bytes, chunk_size: int) -> dict:
+    """Seconds to encrypt ``data`` in chunks of ``chunk_size``, per way of doing it."""
+    key = os.urandom(32)
+    view = memoryview(data)
+    chunks = [view[i:i + chunk_size] for i in range(0, len(view), chunk_size)]
+    results = {}
+
+    cipher = StreamCipher(key)
+    started = time.perf_counter()
+    for chunk in chunks:
+        cipher.seal(chunk)
+    results["StreamCipher.seal"] = time.perf_counter() - started
+
+    sealer = StreamCipher(key)
+    sealed = [sealer.seal(chunk) for chunk in chunks]
+    opener = StreamCipher(key, sealer.salt)
+    started = time.perf_counter()
+    for payload in sealed:
+        opener.open(memoryview(payload))
+    results["StreamCipher.open"] = time.perf_counter() - started
+
+    encryptor = AES_encryptor(32)
+    started = time.perf_counter()
+    for chunk in chunks:
+        encryptor.encrypt_data(bytes(chunk))
+    results["AES_encryptor"] = time.perf_counter() - started
+    return results
+
+
+def main(size: int, repeat: int):
+    mib = size / 1024 ** 2
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "payload.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        key = os.urandom(32)
+        plain = bench_transfer(path, None, repeat)
+        encrypted = bench_transfer(path, key, repeat)
+    print(f"{'transfer':<28}{'MiB/s':>10}")
+    print(f"{'plaintext':<28}{mib / plain:>10.1f}")
+    print(f"{'encrypted':<28}{mib / encrypted:>10.1f}   ({encrypted / plain:.2f}x the time)")
+
+    data = os.urandom(min(size, 64 * 1024 ** 2))
+    print(f"\n{'cipher':<28}{'chunk':>10}{'MiB/s':>10}")
+    for chunk_size in CHUNK_SIZES:
+        for name, seconds in bench_cipher(data, chunk_size).items():
+            print(f"{name:<28}{chunk_size // 1024:>9}K{len(data) / 1024 ** 2 / seconds:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=parse_bytes, default="128M", help="Bytes per transfer (K/M/G suffixes allowed)")
+    parser.add_argument("--repeat", type=int, default=3, help="Transfers per mode; the best one counts")
+    args = parser.parse_args()
+    main(args.size, args.repeat)
@@ -0,0 +1,42 @@
+"""
+Throughput of every transfer hash algorithm on a large in-memory file.
+
+The data is fed in receive-buffer sized pieces, the way transfers feed it.
+
+Usage: python -m benchmarks.hashes [--size BYTES] [--update-size BYTES]
+"""
+import argparse
+import os
+import time
+
+from utils.hashing import HASH_ALGORITHMS, new_hasher
+from utils.tuning import DEFAULT_RECEIVE_BUFFER, parse_bytes
+
+
+def bench(name: str, data: memoryview, update_size: int) -> float:
+    """Best of three runs, in bytes per second."""
+    best = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        hasher = new_hasher(name)
+        for offset in range(0, len(data), update_size):
+            hasher.update(data[offset:offset + update_size])
+        hasher.hexdigest()
+        best = min(best, time.perf_counter() - started)
+    return len(data) / best
+
+
+def main(size: int, update_size: int):
+    data = memoryview(os.urandom(size))
+    print(f"{'algorithm':<16}{'MiB/s':>10}")
+    for name in HASH_ALGORITHMS:
+        print(f"{name:<16}{bench(name, data, update_size) / 1024 ** 2:>10.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=parse_bytes, default="512M", help="Bytes hashed per run (K/M/G suffixes allowed)")
+    parser.add_argument("--update-size", type=parse_bytes, default=DEFAULT_RECEIVE_BUFFER,
+                        help="Bytes passed to each update call")
+    args = parser.parse_args()
+    main(args.size, args.update_size)
@@ -0,0 +1,56 @@
+"""
+Encode/decode cost per control message for every serializer.
+
+Usage: python -m benchmarks.serializers [--number N]
+"""
+import argparse
+import timeit
+
+from utils.serializers import SERIALIZERS
+from utils.standard_query import StandardQuery
+from utils.standard_response import StandardResponse
+
+AUTH_TOKEN = "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+CURRENT_DIR = "/home/ftp/projects/build-artifacts"
+
+QUERIES = {
+    "cd": lambda: StandardQuery(AUTH_TOKEN, "cd", CURRENT_DIR, command_args=["nightly"]),
+    "rename": lambda: StandardQuery(AUTH_TOKEN, "rename", CURRENT_DIR, command_args=["old.tar", "new.tar"]),
+    "upload": lambda: StandardQuery(AUTH_TOKEN, "upload", CURRENT_DIR, command_args=["dist.tar", "releases"],
+                                    data={"file_path": "/home/user/dist.tar", "file_size": 734003200,
+                                          "buffer_size": 4096, "checksum": "d41d8cd98f00b204e9800998ecf8427e",
+                                          "transmit_port": 40123}),
+}
+RESPONSES = {
+    "accept": StandardResponse(accept=True, status_code=200),
+    "cd": StandardResponse(accept=True, status_code=721, data={"current_directory": CURRENT_DIR + "/nightly"}),
+    "list": StandardResponse(accept=True, status_code=200,
+                             data="".join(f"artifact-{i:05d}.tar  " for i in range(400))),
+}
+
+
+def bench(stmt, number: int) -> float:
+    """Best of five runs, in microseconds per call."""
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number * 1e6
+
+
+def main(number: int):
+    print(f"{'message':<18}{'format':<8}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, make_query in QUERIES.items():
+        for serializer in SERIALIZERS.values():
+            payload = serializer.encode_query(make_query())
+            encode = bench(lambda: serializer.encode_query(make_query()), number)
+            decode = bench(lambda: serializer.decode_query(payload), number)
+            print(f"{'query ' + name:<18}{serializer.name:<8}{len(payload):>8}{encode:>12.2f}{decode:>12.2f}")
+    for name, response in RESPONSES.items():
+        for serializer in SERIALIZERS.values():
+            payload = serializer.encode_response(response)
+            encode = bench(lambda: serializer.encode_response(response), number)
+            decode = bench(lambda: serializer.decode_response(payload), number)
+            print(f"{'response ' + name:<18}{serializer.name:<8}{len(payload):>8}{encode:>12.2f}{decode:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="Calls per timing run")
+    main(parser.parse_args().number)
@@ -0,0 +1,109 @@
+"""
+TLS handshakes per second on loopback, full versus resumed from a session ticket.
+
+A server thread completes the handshake on every connection it accepts
+and answers with one byte, so the client also reads the session tickets
+that TLS 1.3 sends after the handshake. The client opens connections one
+after the other: once with a full handshake each, and once offering the
+session of a long-lived control connection, the way data connections do.
+A self-signed certificate is made with the openssl command unless --cert
+and --key are given.
+
+Usage: python -m benchmarks.tls_handshake [--connections N] [--cert PATH --key PATH]
+"""
+import argparse
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from utils.tls import TLSSettings
+from utils.tuning import tune_control_socket
+
+
+def make_certificate(directory: str):
+    """A self-signed certificate for 127.0.0.1; returns (certificate path, key path)."""
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-keyout", key_path, "-out", cert_path, "-subj", "/CN=127.0.0.1",
+                    "-addext", "subjectAltName=IP:127.0.0.1"], check=True, capture_output=True)
+    return cert_path, key_path
+
+
+def handle(server: TLSSettings, connection: socket.socket):
+    """Handshake, answer and wait for the client to hang up."""
+    try:
+        tune_control_socket(connection)
+        with server.wrap_server(connection) as connection:
+            connection.sendall(b"\0")
+            while connection.recv(4096):
+                pass
+    except OSError:
+        pass
+
+
+def serve(server: TLSSettings, listener: socket.socket):
+    while True:
+        try:
+            connection, addr = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=handle, args=(server, connection), daemon=True).start()
+
+
+def connect(client: TLSSettings, address, resume: bool, control: bool = False) -> bool:
+    """Open one connection, read the server's byte and close it; returns whether the session was resumed."""
+    sock = socket.create_connection(address)
+    tune_control_socket(sock)
+    if resume:
+        connection = client.wrap_client(sock, address[0], control=control)
+    else:
+        connection = client.context.wrap_socket(sock, server_hostname=address[0])
+    with connection:
+        connection.recv(1)
+        return connection.session_reused
+
+
+def bench(client: TLSSettings, address, connections: int, resume: bool):
+    """Return (handshakes per second, connections that resumed)."""
+    resumed = 0
+    started = time.perf_counter()
+    for _ in range(connections):
+        resumed += connect(client, address, resume)
+    return connections / (time.perf_counter() - started), resumed
+
+
+def main(connections: int, cert_path: str = None, key_path: str = None):
+    with tempfile.TemporaryDirectory() as directory:
+        if cert_path is None:
+            cert_path, key_path = make_certificate(directory)
+        server = TLSSettings()
+        server.configure_server(cert_path, key_path)
+        client = TLSSettings()
+        client.configure_client(cert_path)
+
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+            threading.Thread(target=serve, args=(server, listener), daemon=True).start()
+            address = listener.getsockname()
+            control = socket.create_connection(address)
+            tune_control_socket(control)
+            with client.wrap_client(control, address[0], control=True) as control:
+                control.recv(1)
+                full, _ = bench(client, address, connections, resume=False)
+                resumed_rate, resumed = bench(client, address, connections, resume=True)
+
+    print(f"{'handshake':<12}{'per second':>12}{'resumed':>10}")
+    print(f"{'full':<12}{full:>12.0f}{0:>10}")
+    print(f"{'resumed':<12}{resumed_rate:>12.0f}{resumed:>10}   ({resumed_rate / full:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=500, help="Connections per mode (default: 500)")
+    parser.add_argument("--cert", help="PEM certificate for 127.0.0.1 (default: a generated self-signed one)")
+    parser.add_argument("--key", help="PEM private key of --cert")
+    args = parser.parse_args()
+    main(args.connections, args.cert, args.key)
@@ -1,26 +1,42 @@
+import argparse
 import socket as s
-import sys
+import ssl
 
-from Client.client_command import FTPClient
+from Client.client_command import (FTPClient, DEFAULT_ARCHIVE_COMPRESSIONS, DEFAULT_CODECS, DEFAULT_DATA_CODECS,
+                                   DEFAULT_ENCODINGS, DEFAULT_HASH_ALGORITHMS)
+from utils.AES_handler import data_encryption
+from utils.archive import ARCHIVE_COMPRESSIONS
+from utils.compression import CODECS
+from utils.hashing import HASH_ALGORITHMS
+from utils.serializers import SERIALIZERS
+from utils.tls import tls
+from utils.tuning import configure, parse_bytes, parse_count, parse_size, tune_control_socket
 
 
-def start_cycle(usr_socket, ip):
+def start_cycle(usr_socket, ip, codecs=None, encodings=None, hash_algorithms=None, mux=False,
+                archive_compressions=None, data_codecs=None):
     """Continuously prompt the user for input and process commands."""
     while True:
         try:
-            FTPClient(usr_socket, ip).cmdloop(intro="[+] You are connected.\nUse 'help' to see commands.")
+            FTPClient(usr_socket, ip, codecs, encodings, hash_algorithms, mux, archive_compressions,
+                      data_codecs).cmdloop(intro="[+] You are connected.\nUse 'help' to see commands.")
         except TimeoutError:
             print("Timeout Error: Check your connection.")
         except Exception as e:
             print(f"An error occurred: {e}")
 
 
-def connect_to_server(ip, port):
+def connect_to_server(ip, port, codecs=None, encodings=None, hash_algorithms=None, mux=False,
+                      archive_compressions=None, data_codecs=None):
     """Establish a connection to the FTP server."""
     try:
         with s.socket(s.AF_INET, s.SOCK_STREAM) as soc:
             soc.connect((str(ip), int(port)))
-            start_cycle(soc, ip)
+            tune_control_socket(soc)
+            with tls.wrap_client(soc, str(ip), control=True) as soc:
+                start_cycle(soc, ip, codecs, encodings, hash_algorithms, mux, archive_compressions, data_codecs)
+    except ssl.SSLError as e:
+        print(f"TLS handshake failed: {e}")
     except ValueError:
         print("Invalid port number. Please enter a valid integer.")
     except ConnectionRefusedError:
@@ -29,12 +45,64 @@ def connect_to_server(ip, port):
         print(f"An error occurred while connecting: {e}")
 
 
-def main(ip="127.0.0.1", port=8021):
-    connect_to_server(ip, port)
+def main(ip="127.0.0.1", port=8021, codecs=None, encodings=None, hash_algorithms=None, mux=False,
+         archive_compressions=None, data_codecs=None):
+    connect_to_server(ip, port, codecs, encodings, hash_algorithms, mux, archive_compressions, data_codecs)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="FTP client")
+    parser.add_argument("ip", nargs="?", default="127.0.0.1", help="Server address (default: 127.0.0.1)")
+    parser.add_argument("port", nargs="?", type=int, default=8021, help="Server port (default: 8021)")
+    parser.add_argument("--codec", dest="codecs", action="append", choices=list(CODECS),
+                        help="Control-channel compression to offer, in order of preference; may be repeated "
+                             f"(default: {' '.join(DEFAULT_CODECS)})")
+    parser.add_argument("--encoding", dest="encodings", action="append", choices=list(SERIALIZERS),
+                        help="Control-message encoding to offer, in order of preference; may be repeated "
+                             f"(default: {' '.join(DEFAULT_ENCODINGS)})")
+    parser.add_argument("--hash", dest="hash_algorithms", action="append", choices=list(HASH_ALGORITHMS),
+                        help="Hash algorithm to offer for verifying transfers, in order of preference; may be "
+                             f"repeated (default: {' '.join(DEFAULT_HASH_ALGORITHMS)})")
+    parser.add_argument("--data-codec", dest="data_codecs", action="append", choices=list(CODECS),
+                        help="File-data compression to offer, in order of preference; may be repeated. Files in "
+                             f"compressed formats are always sent raw (default: {' '.join(DEFAULT_DATA_CODECS)})")
+    parser.add_argument("--archive-compression", dest="archive_compressions", action="append",
+                        choices=list(ARCHIVE_COMPRESSIONS),
+                        help="Compression to offer for directories sent as tar streams, in order of preference; "
+                             f"may be repeated (default: {' '.join(DEFAULT_ARCHIVE_COMPRESSIONS)})")
+    parser.add_argument("--chunk-size", type=parse_size, default="auto",
+                        help="Data chunk size in bytes (K/M suffixes allowed) or 'auto' to ramp it with throughput")
+    parser.add_argument("--socket-buffer", type=parse_bytes, default=None,
+                        help="SO_SNDBUF/SO_RCVBUF for data connections (default: 4M)")
+    parser.add_argument("--segments", type=parse_count, default=1,
+                        help="Data connections to split a large file over (default: 1), or 'auto' for one per 64M "
+                             "of file (at most 8); segmented transfers cannot be resumed")
+    parser.add_argument("--transfers", type=int, default=None,
+                        help="Batches a recursive put/get runs at once, each on its own connection (default: 4)")
+    parser.add_argument("--large-first", action="store_true", default=None,
+                        help="Send the largest files of a recursive put/get first")
+    parser.add_argument("--data-key", metavar="PATH", default=None,
+                        help="Key file shared with the server; encrypts and authenticates the file data of every "
+                             "transfer (default: no encryption)")
+    parser.add_argument("--tls", action="store_true",
+                        help="Connect with TLS, verifying the server's certificate; data connections resume the "
+                             "control connection's TLS session")
+    parser.add_argument("--tls-ca", metavar="PATH", default=None,
+                        help="PEM file of certificates to trust for --tls, e.g. a self-signed server certificate "
+                             "(default: the system's)")
+    parser.add_argument("--mux", action="store_true",
+                        help="Send file data over the control connection instead of opening a data connection "
+                             "per transfer")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        main(sys.argv[1], int(sys.argv[2]))
-    else:
-        main()
+    args = parse_args()
+    configure(chunk_size=args.chunk_size, socket_buffer=args.socket_buffer, segments=args.segments,
+              transfers=args.transfers, large_first=args.large_first)
+    if args.data_key:
+        data_encryption.load(args.data_key)
+    if args.tls or args.tls_ca:
+        tls.configure_client(args.tls_ca)
+    main(args.ip, args.port, args.codecs, args.encodings, args.hash_algorithms, args.mux,
+         args.archive_compressions, args.data_codecs)
@@ -1,6 +1,7 @@
 from cmd import Cmd
 
 from Server.db_manage import ServerDB
+from utils.AES_handler import AES_encryptor
 
 
 class ServerManage(Cmd):
@@ -93,6 +94,42 @@ class ServerManage(Cmd):
         else:
             print("No users found.")
 
+    def do_migrate(self, args):
+        """
+        Create the database tables, or check that they exist.
+
+        Usage: migrate
+
+        Run it once before the first start of the server and after upgrading it;
+        the server only queries the tables.
+        """
+        self.dbConnection.create_tables()
+        missing = self.dbConnection.missing_tables()
+        if missing:
+            print(f"Could not create tables: {', '.join(missing)}")
+        else:
+            print("Database is up to date.")
+
+    def do_data_key(self, args):
+        """
+        Generate a key for encrypting file data on the data channel.
+
+        Usage: data_key [<path>]
+
+        Arguments:
+        <path>   (Optional) Where to write the key file. Defaults to .aes_key.
+
+        Give the same key file to the server and its clients with --data-key.
+        """
+        parsed_arg = args.split()
+        if len(parsed_arg) > 1:
+            print("Wrong number of arguments")
+            print("Usage: data_key [<path>]")
+            return
+        path = parsed_arg[0] if parsed_arg else ".aes_key"
+        AES_encryptor(32).save_key(path)
+        print(f"Data key written to {path}.")
+
     def do_close(self):
         """Exit the command loop."""
         exit(0)
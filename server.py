@@ -1,16 +1,28 @@
+import argparse
 import socket
-import sys
 import threading
 
+from Server import async_server
+from Server.data_port_pool import data_port_pool, parse_port_range
+from Server.db_manage import server_db
 from Server.logging_config import server_logger
-from Server.server_command import command_parser
+from Server.server_command import execute_request, is_multiplexed_transfer
+from Server.session_cache import DEFAULT_MAX_SESSIONS, session_cache
+from Server.workers import WorkerSupervisor
+from utils.AES_handler import data_encryption
+from utils.checksum_cache import DEFAULT_MAX_ENTRIES, checksum_cache
+from utils.control_channel import ControlChannel
+from utils.request_parser import request_parser
+from utils.tls import tls
+from utils.tuning import configure, parse_bytes, parse_count, parse_size, tune_control_socket
 
 
 class Server:
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, sock: socket.socket = None):
         self.port = int(port)
         self.ip = str(ip)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # A worker process receives a socket that is already bound and listening.
+        self.sock = sock or socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     def start(self):
         self.bind_socket()
@@ -40,33 +52,132 @@ class Server:
 
     def handle_connection(self, conn: socket.socket, addr):
         server_logger.info(f"[+] User connected: {addr}")
+        tune_control_socket(conn)
+        try:
+            conn = tls.wrap_server(conn)
+        except OSError as e:
+            server_logger.info(f"TLS handshake with {addr} failed: {e}")
+            conn.close()
+            return
+        channel = ControlChannel(conn)
         with conn:
             while True:
                 try:
-                    data = conn.recv(4096)
-                    if not data:
+                    frame = channel.recv_request()
+                    if frame is None:
                         break
 
-                    command_parser(data, conn, addr)
+                    request_id, flags, data = frame
+                    user_request = request_parser(data, flags)
+                    if is_multiplexed_transfer(user_request):
+                        # This loop must keep reading: it delivers the transfer's data and window updates.
+                        threading.Thread(target=execute_request,
+                                         args=(user_request, channel.reply_to(request_id), addr)).start()
+                    else:
+                        execute_request(user_request, channel.reply_to(request_id), addr)
                 except ConnectionResetError:
                     server_logger.info(f"[-] Connection reset by {addr}")
                     break
                 except Exception as e:
                     server_logger.info(f"Error handling connection from {addr}: {e}")
                     break
+            channel.mux.close()
+
+    def accept_connections_async(self, command_threads: int = async_server.COMMAND_THREADS,
+                                 transfer_threads: int = async_server.TRANSFER_THREADS):
+        try:
+            async_server.serve_forever(self.sock, command_threads, transfer_threads)
+        except KeyboardInterrupt:
+            server_logger.info("Server stopped.")
+        finally:
+            self.shutdown()
 
     def shutdown(self):
         self.sock.close()
 
 
-def main(ip="127.0.0.1", port=8021):
+def serve(server, use_asyncio, command_threads, transfer_threads):
+    if use_asyncio:
+        server.accept_connections_async(command_threads, transfer_threads)
+    else:
+        server.accept_connections()
+
+
+def main(ip="127.0.0.1", port=8021, use_asyncio=False, command_threads=async_server.COMMAND_THREADS,
+         transfer_threads=async_server.TRANSFER_THREADS, workers=0, data_ports=None):
+    # Built before any worker is forked, so every process starts with the database path already resolved.
+    missing = server_db().missing_tables()
+    if missing:
+        server_logger.warning(f"Database tables {', '.join(missing)} are missing; run 'migrate' in manage.py")
+    if workers > 0:
+        def run_worker(sock, index):
+            if data_ports:
+                # Each worker leases only the data ports it bound itself.
+                data_port_pool.bind(ip, data_ports, index, workers)
+            serve(Server(ip, port, sock), use_asyncio, command_threads, transfer_threads)
+
+        supervisor = WorkerSupervisor(ip, port, workers, run_worker)
+        supervisor.start()
+        supervisor.supervise()
+        return
+    if data_ports:
+        data_port_pool.bind(ip, data_ports)
     server = Server(ip, port)
     server.start()
-    server.accept_connections()
+    serve(server, use_asyncio, command_threads, transfer_threads)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="FTP server")
+    parser.add_argument("ip", nargs="?", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("port", nargs="?", type=int, default=8021, help="Port to listen on (default: 8021)")
+    parser.add_argument("--asyncio", dest="use_asyncio", action="store_true",
+                        help="Serve all control connections from one asyncio event loop instead of one thread each")
+    parser.add_argument("--command-threads", type=int, default=async_server.COMMAND_THREADS,
+                        help="Executor threads for blocking command work in asyncio mode")
+    parser.add_argument("--transfer-threads", type=int, default=async_server.TRANSFER_THREADS,
+                        help="Executor threads for file transfers in asyncio mode")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Fork this many worker processes sharing the port (default: run in this process)")
+    parser.add_argument("--chunk-size", type=parse_size, default="auto",
+                        help="Data chunk size in bytes (K/M suffixes allowed) or 'auto' to ramp it with throughput")
+    parser.add_argument("--socket-buffer", type=parse_bytes, default=None,
+                        help="SO_SNDBUF/SO_RCVBUF for data connections (default: 4M)")
+    parser.add_argument("--segments", type=parse_count, default="auto",
+                        help="Data connections to split a large file over, or 'auto' for one per 64M of file "
+                             "(at most 8); caps what clients ask for")
+    parser.add_argument("--checksum-cache", metavar="PATH", default=None,
+                        help="SQLite file to persist file checksums in, e.g. next to the user database "
+                             "(default: keep them in memory only)")
+    parser.add_argument("--checksum-cache-size", type=int, default=DEFAULT_MAX_ENTRIES,
+                        help="Checksums kept in memory (default: %(default)s)")
+    parser.add_argument("--session-cache-size", type=int, default=DEFAULT_MAX_SESSIONS,
+                        help="Logged-in sessions kept in memory, so commands need no database query "
+                             "(default: %(default)s)")
+    parser.add_argument("--data-ports", metavar="START-END", type=parse_port_range, default=None,
+                        help="Bind this range of data ports once and lease them to transfers, e.g. for a "
+                             "firewall (default: a fresh kernel-assigned port per transfer)")
+    parser.add_argument("--data-key", metavar="PATH", default=None,
+                        help="Key file (see 'data_key' in manage.py) to encrypt the file data of clients that "
+                             "offer the same key (default: no encryption)")
+    parser.add_argument("--tls-cert", metavar="PATH", default=None,
+                        help="PEM certificate chain; serves TLS on the control and data connections "
+                             "(default: plain TCP)")
+    parser.add_argument("--tls-key", metavar="PATH", default=None,
+                        help="PEM private key for --tls-cert, if the certificate file does not hold it")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        main(sys.argv[1], int(sys.argv[2]))
-    else:
-        main()
+    args = parse_args()
+    configure(chunk_size=args.chunk_size, socket_buffer=args.socket_buffer, segments=args.segments)
+    checksum_cache.max_entries = args.checksum_cache_size
+    session_cache.max_entries = args.session_cache_size
+    if args.checksum_cache:
+        checksum_cache.persist(args.checksum_cache)
+    if args.data_key:
+        data_encryption.load(args.data_key)
+    if args.tls_cert:
+        tls.configure_server(args.tls_cert, args.tls_key)
+    main(args.ip, args.port, args.use_asyncio, args.command_threads, args.transfer_threads, args.workers,
+         args.data_ports)
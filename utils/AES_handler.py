@@ -1,8 +1,22 @@
+import hashlib
+import hmac
 import marshal
+import struct
+from typing import Optional
 
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 
+from utils.data_channel import recv_into_exact
+
+# Data-channel encryption, as offered by the client: AES-256-CTR over each stream, one HMAC-SHA256 tag per chunk.
+DATA_ENCRYPTION = "aes-256-ctr-hmac-sha256"
+STREAM_SALT_SIZE = 16  # Random bytes opening every encrypted stream; the stream's keys are derived from them
+TRANSFER_NONCE_SIZE = 16  # Random bytes the client picks for every encrypted transfer it asks for
+SEAL_TAG_SIZE = 16  # Truncated HMAC-SHA256 appended to every chunk payload
+SEALED_CHUNK_SIZE = 1024 * 1024  # Most file bytes in one encrypted chunk, so the receiver can hold a whole one
+SEAL_HEADER = struct.Struct("!QB")  # Chunk sequence number and flags, authenticated with the chunk
+
 
 class AES_encryptor(object):
     def __init__(self, key_length: int):
@@ -16,9 +30,9 @@ class AES_encryptor(object):
         return self.key
     def get_iv(self) -> bytes:
         return self.iv
-    def save_key(self):
+    def save_key(self, path: str = ".aes_key"):
         information = {"key_length": self.key_length, "key": self.key, "iv": self.iv}
-        with open(".aes_key", "wb") as key_file:
+        with open(path, "wb") as key_file:
             key_file.write(marshal.dumps(information))
 
     def encrypt_data(self, data: str | bytes) -> (bytes, bytes):
@@ -52,3 +66,197 @@ class AES_decryptor(object):
         cipher = AES.new(self.key, AES.MODE_CFB,self.iv)
         decrypted = cipher.decrypt(ciphertext)
         return decrypted
+
+
+class DataKeyError(Exception):
+    """The two sides cannot agree on encrypting a transfer's data."""
+
+
+def read_data_key(path: str) -> bytes:
+    """
+    Read the data key from a key file written by ``AES_encryptor.save_key``.
+
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If it does not hold an AES key
+    """
+    try:
+        key = AES_decryptor.read_key(path).get_key()
+    except (EOFError, KeyError, TypeError) as e:
+        raise ValueError(f"{path} is not a key file") from e
+    if not isinstance(key, bytes) or len(key) not in AES.key_size:
+        raise ValueError(f"{path} does not hold an AES key")
+    return key
+
+
+def data_key_id(key: bytes) -> str:
+    """A short fingerprint of ``key``, so the peers can tell they hold the same one without revealing it."""
+    return hashlib.blake2b(key, digest_size=8, person=b"ftp-data-key-id").hexdigest()
+
+
+def transfer_key(key: bytes, nonce: bytes) -> bytes:
+    """The key of one transfer's streams: the data key bound to the ``nonce`` its request carried."""
+    return hashlib.blake2b(nonce, key=key, digest_size=32, person=b"ftp-data-xfer").digest()
+
+
+def stream_key(key: Optional[bytes], *context: int) -> Optional[bytes]:
+    """
+    The key of one of several streams of a transfer, bound to where its data belongs.
+
+    ``context`` is what the receiver knows the stream must carry, such as a
+    segment's offset and length or a batch file's position, so a stream
+    sealed for one place fails authentication in any other.
+    """
+    if key is None:
+        return None
+    return hashlib.blake2b(struct.pack(f"!{len(context)}Q", *context), key=key, digest_size=32,
+                           person=b"ftp-data-part").digest()
+
+
+class StreamCipher:
+    """
+    Encrypts or decrypts one data stream.
+
+    The stream's AES-256 and HMAC keys are derived from its transfer's key
+    (see ``transfer_key`` and ``stream_key``) and a random salt sent ahead
+    of the stream, so no two streams share a keystream, and a stream
+    recorded from one transfer or moved within one fails authentication. One CTR cipher runs through the whole stream, each chunk
+    continuing the keystream where the last one ended. Every chunk
+    payload carries a tag over its sequence number, chunk flags and
+    ciphertext, so chunks cannot be altered, dropped, reordered or turned
+    into the end of the stream unnoticed.
+    """
+
+    def __init__(self, key: bytes, salt: Optional[bytes] = None):
+        self.salt = salt or get_random_bytes(STREAM_SALT_SIZE)
+        cipher_key = hashlib.blake2b(self.salt, key=key, digest_size=32, person=b"ftp-data-cipher").digest()
+        self.mac_key = hashlib.blake2b(self.salt, key=key, digest_size=32, person=b"ftp-data-mac").digest()
+        self.cipher = AES.new(cipher_key, AES.MODE_CTR, nonce=b"")
+        self.sequence = 0
+
+    def _tag(self, ciphertext, flags: int) -> bytes:
+        mac = hmac.new(self.mac_key, SEAL_HEADER.pack(self.sequence, flags), "sha256")
+        mac.update(ciphertext)
+        self.sequence += 1
+        return mac.digest()[:SEAL_TAG_SIZE]
+
+    def seal(self, data, flags: int = 0) -> bytearray:
+        """Encrypt the next chunk's payload and append its tag."""
+        sealed = bytearray(len(data) + SEAL_TAG_SIZE)
+        ciphertext = memoryview(sealed)[:len(data)]
+        self.cipher.encrypt(data, output=ciphertext)
+        sealed[len(data):] = self._tag(ciphertext, flags)
+        return sealed
+
+    def open(self, sealed: memoryview, flags: int = 0) -> memoryview:
+        """
+        Check the tag of the next chunk's payload and decrypt it in place.
+
+        Returns:
+            memoryview: The plaintext, at the start of ``sealed``
+
+        Raises:
+            ValueError: If the payload fails authentication
+        """
+        length = len(sealed) - SEAL_TAG_SIZE
+        if length < 0:
+            raise ValueError("Encrypted chunk is too short")
+        ciphertext = sealed[:length]
+        if not hmac.compare_digest(self._tag(ciphertext, flags), sealed[length:]):
+            raise ValueError("Data chunk failed authentication")
+        self.cipher.decrypt(ciphertext, output=ciphertext)
+        return ciphertext
+
+
+def seal_stream(connection, key: Optional[bytes]) -> Optional[StreamCipher]:
+    """Start an encrypted stream: send its salt and return the cipher for its chunks (None without a key)."""
+    if key is None:
+        return None
+    cipher = StreamCipher(key)
+    connection.sendall(cipher.salt)
+    return cipher
+
+
+def unseal_stream(connection, key: Optional[bytes]) -> Optional[StreamCipher]:
+    """Read the salt an encrypted stream starts with and return the cipher for its chunks (None without a key)."""
+    if key is None:
+        return None
+    salt = bytearray(STREAM_SALT_SIZE)
+    recv_into_exact(connection, memoryview(salt), STREAM_SALT_SIZE)
+    return StreamCipher(key, bytes(salt))
+
+
+def recv_sealed(connection, cipher: StreamCipher, length: int, flags: int) -> memoryview:
+    """
+    Receive a chunk payload of ``length`` bytes and decrypt it.
+
+    Raises:
+        ConnectionError: If the payload fails authentication
+    """
+    payload = memoryview(bytearray(length))
+    recv_into_exact(connection, payload, length)
+    try:
+        return cipher.open(payload, flags)
+    except ValueError as e:
+        raise ConnectionError(str(e))
+
+
+class DataEncryption:
+    """
+    This process's data key, loaded once from the command line.
+
+    A client with a key offers encryption with every transfer; a server
+    with one encrypts each transfer whose client offers it, and refuses
+    those that offer it under another key. Without a key nothing is
+    encrypted. Every offer carries a fresh nonce, and the transfer is
+    encrypted under ``transfer_key`` of it, so its streams cannot be
+    replayed into another transfer.
+    """
+
+    def __init__(self):
+        self.key = None
+
+    def load(self, path: str):
+        self.key = read_data_key(path)
+
+    def offer(self) -> dict:
+        """Request fields offering to encrypt a transfer's data, if there is a key."""
+        if self.key is None:
+            return {}
+        return {"data_encryption": [DATA_ENCRYPTION], "data_key_id": data_key_id(self.key),
+                "data_nonce": get_random_bytes(TRANSFER_NONCE_SIZE).hex()}
+
+    def choose(self, request_data: dict) -> Optional[bytes]:
+        """
+        The key to encrypt the requested transfer with, or None if the client did not offer encryption.
+
+        Raises:
+            DataKeyError: If the client offered encryption this side cannot provide
+        """
+        if not (request_data or {}).get("data_encryption"):
+            return None
+        if self.key is None or DATA_ENCRYPTION not in request_data["data_encryption"]:
+            raise DataKeyError("The server does not encrypt file data")
+        if request_data.get("data_key_id") != data_key_id(self.key):
+            raise DataKeyError("The data key does not match the server's")
+        try:
+            nonce = bytes.fromhex(request_data.get("data_nonce"))
+        except (TypeError, ValueError):
+            nonce = b""
+        if len(nonce) != TRANSFER_NONCE_SIZE:
+            raise DataKeyError("The transfer offers encryption without a valid nonce")
+        return transfer_key(self.key, nonce)
+
+    @staticmethod
+    def reply(key: Optional[bytes]) -> dict:
+        """Reply fields telling the client whether its transfer is encrypted."""
+        return {"data_encryption": DATA_ENCRYPTION} if key else {}
+
+    def agreed(self, response_data: dict, request_data: dict) -> Optional[bytes]:
+        """The key for a transfer the server agreed to encrypt, or None; ``request_data`` holds this side's offer."""
+        if (response_data or {}).get("data_encryption") == DATA_ENCRYPTION:
+            return transfer_key(self.key, bytes.fromhex(request_data["data_nonce"]))
+        return None
+
+
+data_encryption = DataEncryption()
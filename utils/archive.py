@@ -0,0 +1,243 @@
+import io
+import logging
+import os
+import socket
+import tarfile
+from typing import Optional, Tuple
+
+from tqdm import tqdm
+
+from utils.AES_handler import SEAL_TAG_SIZE, StreamCipher, recv_sealed, seal_stream, unseal_stream
+from utils.data_channel import (FLAG_END, DataDialer, linger, recv_chunk_header, recv_exact, send_chunk,
+                                send_end)
+from utils.hashing import DEFAULT_HASH_ALGORITHM, new_hasher
+
+ARCHIVE_BLOCK = 1024 * 1024  # Bytes tarfile hands to the data connection at a time, and reads back
+
+# Compression of a directory's tar stream, named as offered by the client, mapped to the tarfile
+# stream mode suffix. zstd is only offered where tarfile supports it (Python 3.14+).
+ARCHIVE_COMPRESSIONS = {
+    "none": "",
+    "gz": "gz",
+    "xz": "xz",
+}
+if "zst" in tarfile.TarFile.OPEN_METH:
+    ARCHIVE_COMPRESSIONS["zst"] = "zst"
+DEFAULT_ARCHIVE_COMPRESSION = "none"
+
+
+def choose_archive_compression(offered: list[str]) -> str:
+    """Pick the first archive compression in the peer's preference list that this side supports."""
+    for name in offered or []:
+        if name in ARCHIVE_COMPRESSIONS:
+            return name
+    return DEFAULT_ARCHIVE_COMPRESSION
+
+
+class ChunkWriter(io.RawIOBase):
+    """
+    The sending end of an archive stream, as the file object tarfile writes to.
+
+    Every write goes out as one data chunk, encrypted with ``cipher`` if
+    given, and is hashed on the way; ``finish`` ends the stream with the
+    digest as its trailer, so the receiver can tell a complete archive
+    from one cut short.
+    """
+
+    def __init__(self, connection, hasher, progress=None, cipher: Optional[StreamCipher] = None):
+        super().__init__()
+        self.connection = connection
+        self.hasher = hasher
+        self.progress = progress
+        self.cipher = cipher
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        # tarfile writes ARCHIVE_BLOCK at a time, except for whatever the compressor flushes at the end.
+        for start in range(0, len(view), ARCHIVE_BLOCK):
+            block = view[start:start + ARCHIVE_BLOCK]
+            send_chunk(self.connection, self.cipher.seal(block) if self.cipher else bytes(block))
+        self.hasher.update(view)
+        if self.progress is not None:
+            self.progress.update(len(view))
+        return len(view)
+
+    def finish(self):
+        trailer = self.hasher.hexdigest().encode("ascii")
+        if self.cipher:
+            send_chunk(self.connection, self.cipher.seal(trailer, FLAG_END), FLAG_END)
+        else:
+            send_end(self.connection, trailer)
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    The receiving end of an archive stream, as the file object tarfile reads from.
+
+    Yields the payload of the data chunks, hashed as it is read, until the
+    end chunk, whose trailer is kept in ``trailer``. With a ``cipher`` each
+    chunk is received whole and authenticated before any of it is read.
+    """
+
+    def __init__(self, connection, hasher, progress=None, cipher: Optional[StreamCipher] = None):
+        super().__init__()
+        self.connection = connection
+        self.hasher = hasher
+        self.progress = progress
+        self.cipher = cipher
+        self.plaintext = None  # What is left of the current chunk, decrypted
+        self.remaining = 0  # Bytes left of the current chunk
+        self.trailer = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.remaining:
+            if self.trailer is not None:
+                return 0
+            length, flags = recv_chunk_header(self.connection)
+            if self.cipher and length > ARCHIVE_BLOCK + SEAL_TAG_SIZE:
+                raise ConnectionError("Invalid encrypted chunk")
+            if flags & FLAG_END:
+                if self.cipher:
+                    self.trailer = bytes(recv_sealed(self.connection, self.cipher, length, flags))
+                else:
+                    self.trailer = recv_exact(self.connection, length)
+                return 0
+            if self.cipher:
+                self.plaintext = recv_sealed(self.connection, self.cipher, length, flags)
+                length = len(self.plaintext)
+            self.remaining = length
+        view = memoryview(buffer).cast("B")[:self.remaining]
+        if self.cipher:
+            count = len(view)
+            view[:] = self.plaintext[:count]
+            self.plaintext = self.plaintext[count:]
+        else:
+            count = self.connection.recv_into(view, len(view))
+            if not count:
+                raise ConnectionError("Connection closed unexpectedly")
+        self.remaining -= count
+        self.hasher.update(view[:count])
+        if self.progress is not None:
+            self.progress.update(count)
+        return count
+
+
+def send_archive(
+        dir_path: str,
+        transmit_socket,
+        compression: str = DEFAULT_ARCHIVE_COMPRESSION,
+        progress_bar: bool = True,
+        timeout: float = 30.0,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        key: Optional[bytes] = None
+) -> bool:
+    """
+    Send the directory ``dir_path`` and everything below it as a tar stream.
+
+    The archive is produced with tarfile in stream mode straight into the
+    data connection as chunks, optionally compressed, and never exists as a
+    whole on either side. Its members are named below the directory's own
+    name. ``transmit_socket`` is where the data connection is accepted, as
+    in ``send_file``. With a data ``key`` the stream is encrypted.
+
+    Returns:
+        bool: Whether the whole archive was sent
+    """
+    progress = None
+    try:
+        transmit_socket.settimeout(timeout)
+        connection, addr = transmit_socket.accept()
+        connection.settimeout(timeout)
+        name = os.path.basename(os.path.normpath(dir_path))
+        if progress_bar:
+            progress = tqdm(desc=f"Sending {name}", unit="B", unit_scale=True, unit_divisor=1024)
+        with connection:
+            writer = ChunkWriter(connection, new_hasher(hash_algorithm), progress, seal_stream(connection, key))
+            with tarfile.open(fileobj=writer, mode=f"w|{ARCHIVE_COMPRESSIONS[compression]}",
+                              bufsize=ARCHIVE_BLOCK) as tar:
+                tar.add(dir_path, arcname=name)
+            writer.finish()
+            linger(connection)
+        return True
+
+    except (socket.timeout, ConnectionError) as e:
+        logging.error(f"Network error during archive send: {e}")
+        return False
+    except Exception as e:
+        logging.error(f"Unexpected error during archive send: {e}")
+        return False
+    finally:
+        if progress is not None:
+            progress.close()
+        transmit_socket.close()
+
+
+def receive_archive(
+        socket_addr: str,
+        directory: str,
+        transmit_port: int,
+        compression: str = DEFAULT_ARCHIVE_COMPRESSION,
+        progress_bar: bool = True,
+        timeout: float = 30.0,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        token: Optional[bytes] = None,
+        listener=None,
+        key: Optional[bytes] = None
+) -> Tuple[bool, Optional[str]]:
+    """
+    Extract a tar stream sent with ``send_archive`` into ``directory`` as it arrives.
+
+    Members are extracted with tarfile's "data" filter, so nothing can be
+    written outside ``directory`` or get special permissions. The stream's
+    trailer is checked against the hash of everything received; members
+    already extracted from an archive that turns out broken are left in
+    place. The data connection is made or accepted as in ``retrieve_file``,
+    and decrypted with the data ``key`` if one is given.
+
+    Returns:
+        Tuple of (success status, error message if any)
+    """
+    transmit_socket = None
+    progress = None
+    endpoint = listener or DataDialer(socket_addr, transmit_port, token)
+    try:
+        endpoint.settimeout(timeout)
+        transmit_socket, addr = endpoint.accept()
+        if progress_bar:
+            progress = tqdm(desc="Receiving archive", unit="B", unit_scale=True, unit_divisor=1024)
+        hasher = new_hasher(hash_algorithm)
+        reader = ChunkReader(transmit_socket, hasher, progress, unseal_stream(transmit_socket, key))
+        with tarfile.open(fileobj=reader, mode=f"r|{ARCHIVE_COMPRESSIONS[compression]}",
+                          bufsize=ARCHIVE_BLOCK) as tar:
+            tar.extractall(directory, filter="data")
+        # Whatever follows the last member (padding, the end of the compressed stream) up to the trailer.
+        while reader.read(ARCHIVE_BLOCK):
+            pass
+        if reader.trailer.decode("ascii") != hasher.hexdigest():
+            return False, "Checksum verification failed"
+        return True, None
+
+    except socket.timeout:
+        return False, "Socket connection timed out"
+    except ConnectionError as e:
+        return False, str(e)
+    except tarfile.TarError as e:
+        return False, f"Invalid archive: {e}"
+    except PermissionError:
+        return False, "Permission denied when writing file"
+    except OSError as e:
+        return False, f"OS error occurred: {e}"
+    except Exception as e:
+        return False, f"Unexpected error: {e}"
+    finally:
+        if transmit_socket:
+            transmit_socket.close()
+        endpoint.close()
+        if progress is not None:
+            progress.close()
@@ -2,15 +2,13 @@ import hashlib
 
 import bcrypt
 
-from utils.request_parser import response_parser
 from utils.standard_query import StandardQuery
 
 
-def authorize(username, password, control_socket):
-    StandardQuery(auth_token="", command="login", current_dir="", command_args=[f"{username}@{password}"],
-                  data="").serialize_and_send(control_socket)
-    resp = control_socket.recv(1024)
-    parsed_response = response_parser(resp)
+def authorize(username, password, control_channel):
+    request_id = StandardQuery(auth_token="", command="login", current_dir="", command_args=[f"{username}@{password}"],
+                               data="").serialize_and_send(control_channel)
+    parsed_response = control_channel.recv_response(request_id)
     if parsed_response["accept"]:
         return parsed_response["data"]
     else:
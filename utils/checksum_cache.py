@@ -0,0 +1,127 @@
+import os
+import sqlite3 as sql3
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from utils.hashing import DEFAULT_HASH_ALGORITHM
+
+DEFAULT_MAX_ENTRIES = 4096
+
+FileKey = Tuple[int, int, int, int]
+
+
+def file_key(path: str) -> FileKey:
+    """Identify the current contents of ``path`` by (device, inode, size, mtime_ns)."""
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class ChecksumCache:
+    """
+    Checksums of files that were already hashed, so they need not be hashed again.
+
+    Entries are keyed by ``file_key`` and the hash algorithm: rewriting,
+    truncating or replacing a file changes its key, so a stale checksum is
+    simply never found again. The most recently used ``max_entries`` are
+    kept in memory; with ``persist`` the cache is also written through to
+    an SQLite file, which survives restarts and is shared by worker
+    processes.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[FileKey, str], str]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.db_path = None
+        self._db = None
+        self._db_pid = None
+
+    def persist(self, db_path: str):
+        """Write entries through to the SQLite file at ``db_path``."""
+        self.db_path = db_path
+        with self.lock:
+            self._connection()
+
+    def _connection(self):
+        # A connection must not cross a fork; each worker opens its own.
+        if self.db_path is None:
+            return None
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sql3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("""
+            CREATE TABLE IF NOT EXISTS Checksums(
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                algorithm VARCHAR(16) NOT NULL,
+                checksum VARCHAR(128) NOT NULL,
+                PRIMARY KEY (device, inode, size, mtime_ns, algorithm)
+            )""")
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _remember(self, key: Tuple[FileKey, str], checksum: str):
+        self.entries[key] = checksum
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, path: str, algorithm: str = DEFAULT_HASH_ALGORITHM) -> Optional[str]:
+        """Return the ``algorithm`` checksum of ``path`` if its current contents were hashed with it before."""
+        try:
+            key = (file_key(path), algorithm)
+        except OSError:
+            return None
+        with self.lock:
+            checksum = self.entries.get(key)
+            if checksum is not None:
+                self.entries.move_to_end(key)
+                return checksum
+            db = self._connection()
+            if db is None:
+                return None
+            try:
+                row = db.execute("SELECT checksum FROM Checksums WHERE device=? AND inode=? AND size=? "
+                                 "AND mtime_ns=? AND algorithm=?", (*key[0], algorithm)).fetchone()
+            except sql3.Error:
+                return None
+            if row is None:
+                return None
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, path: str, checksum: str, key: Optional[FileKey] = None,
+            algorithm: str = DEFAULT_HASH_ALGORITHM):
+        """
+        Record ``checksum`` for the current contents of ``path``.
+
+        Pass the ``key`` taken before the file was hashed: if the file changed
+        in the meantime the checksum describes neither version and is dropped.
+        """
+        try:
+            current = file_key(path)
+        except OSError:
+            return
+        if key is not None and key != current:
+            return
+        with self.lock:
+            self._remember((current, algorithm), checksum)
+            db = self._connection()
+            if db is None:
+                return
+            try:
+                # Older versions of the same file can never match again.
+                db.execute("DELETE FROM Checksums WHERE device=? AND inode=? AND (size!=? OR mtime_ns!=?)",
+                           current)
+                db.execute("INSERT OR REPLACE INTO Checksums VALUES (?, ?, ?, ?, ?, ?)",
+                           (*current, algorithm, checksum))
+                db.commit()
+            except sql3.Error:
+                db.rollback()
+
+
+# Shared by every transfer in the process.
+checksum_cache = ChecksumCache()
@@ -1,5 +1,5 @@
 commands_code_dict = {"login": 1, "upload": 2, "download": 3, "mkdir": 4, "rmdir": 5,
                       "cd": 6, "resume": 7, "rename": 8, "list": 9, "ls": 9, "help.txt": 10, "quit": 11,
-                      "exit": 12, "pwd": 13, "rm": 14}
+                      "exit": 12, "pwd": 13, "rm": 14, "negotiate": 15, "mput": 16, "mget": 17}
 
 code_command_dict = {value: key for key, value in commands_code_dict.items()}
@@ -0,0 +1,209 @@
+import lzma
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from utils.framing import MAX_FRAME_SIZE
+
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+
+# The low two bits of a frame's flags byte name the codec its payload was compressed with.
+CODEC_MASK = 0x03
+COMPRESSION_THRESHOLD = 1024  # Payloads smaller than this are sent raw whatever the codec
+
+CODECS = {
+    "none": 0,
+    "zlib": 1,
+    "lzma": 2,
+}
+if zstd is not None:
+    CODECS["zstd"] = 3
+CODEC_NAMES = {codec_id: name for name, codec_id in CODECS.items()}
+DEFAULT_CODEC = "none"
+
+_compressors = {
+    "zlib": lambda payload: zlib.compress(payload, 6),
+    "lzma": lambda payload: lzma.compress(payload, preset=1),
+}
+# Frames and data chunks alike are inflated incrementally, so their output can be capped.
+_decompressors = {
+    "zlib": zlib.decompressobj,
+    "lzma": lzma.LZMADecompressor,
+}
+_decompress_errors = (zlib.error, lzma.LZMAError)
+if zstd is not None:
+    _compressors["zstd"] = lambda payload: zstd.compress(payload, 3)
+    _decompressors["zstd"] = zstd.ZstdDecompressor
+    _decompress_errors += (zstd.ZstdError,)
+
+# File data is compressed chunk by chunk at the fastest levels, so compression keeps up with the network.
+# Bits 1-2 of a data chunk's flags name the codec of its payload (bit 0 is the END flag); the payload of a
+# compressed chunk starts with the length of the data it holds.
+CHUNK_CODEC_SHIFT = 1
+RAW_LENGTH = struct.Struct("!I")
+COMPRESSED_CHUNK_SIZE = 1024 * 1024  # File bytes per chunk of a compressed stream
+MIN_CHUNK_SAVING = 0.1  # A stream whose chunk shrinks less than this is sent raw from then on
+COMPRESSION_THREADS = min(4, os.cpu_count() or 1)
+
+_chunk_compressors = {
+    "zlib": lambda payload: zlib.compress(payload, 1),
+    "lzma": lambda payload: lzma.compress(payload, preset=0),
+}
+if zstd is not None:
+    _chunk_compressors["zstd"] = lambda payload: zstd.compress(payload, 1)
+
+# Formats that are compressed already, by extension and by the magic bytes they start with.
+COMPRESSED_EXTENSIONS = {
+    ".gz", ".tgz", ".bz2", ".xz", ".txz", ".zst", ".lz4", ".zip", ".jar", ".7z", ".rar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp3", ".aac", ".ogg", ".opus", ".flac", ".mp4", ".m4a", ".m4v", ".mkv", ".webm", ".mov", ".avi",
+    ".docx", ".xlsx", ".pptx", ".odt", ".epub", ".apk", ".whl",
+}
+COMPRESSED_MAGIC = (
+    b"\x1f\x8b",  # gzip
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"PK\x03\x04",  # zip and everything built on it
+    b"7z\xbc\xaf\x27\x1c",  # 7-Zip
+    b"Rar!",  # RAR
+    b"\xff\xd8\xff",  # JPEG
+    b"\x89PNG",  # PNG
+    b"GIF8",  # GIF
+    b"OggS",  # Ogg
+    b"fLaC",  # FLAC
+    b"\x1a\x45\xdf\xa3",  # Matroska/WebM
+)
+MAGIC_SIZE = 12
+
+# Chunks of every compressed transfer in the process are compressed here; zlib and lzma release the GIL.
+_chunk_pool = None
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _chunk_pool
+    if _chunk_pool is None:
+        _chunk_pool = ThreadPoolExecutor(max_workers=COMPRESSION_THREADS, thread_name_prefix="ftp-compress")
+    return _chunk_pool
+
+
+def choose_codec(offered: list[str]) -> str:
+    """Pick the first codec in the peer's preference list that this side supports."""
+    for name in offered or []:
+        if name in CODECS:
+            return name
+    return DEFAULT_CODEC
+
+
+def compress(payload: bytes, codec: str, threshold: int = COMPRESSION_THRESHOLD) -> Tuple[int, bytes]:
+    """
+    Compress ``payload`` with ``codec`` unless it is too small to be worth it.
+
+    Returns:
+        Tuple of (frame flags naming the codec actually used, payload)
+    """
+    if codec == "none" or len(payload) < threshold:
+        return CODECS["none"], payload
+    compressed = _compressors[codec](payload)
+    if len(compressed) >= len(payload):
+        return CODECS["none"], payload
+    return CODECS[codec], compressed
+
+
+def decompress(flags: int, payload: bytes, accepted: str = DEFAULT_CODEC, max_length: int = MAX_FRAME_SIZE) -> bytes:
+    """
+    Undo ``compress`` using the codec recorded in the frame flags.
+
+    Only raw frames and those compressed with the ``accepted`` codec are
+    taken, and no frame inflates to more than ``max_length`` bytes.
+
+    Raises:
+        ValueError: If the codec is unknown or not accepted, or the payload is corrupt or too large
+    """
+    codec = CODEC_NAMES.get(flags & CODEC_MASK)
+    if codec is None:
+        raise ValueError(f"Unknown codec id {flags & CODEC_MASK} in frame flags")
+    if codec == "none":
+        return payload
+    if codec != accepted:
+        raise ValueError(f"Frame compressed with {codec}, which was not agreed for this connection")
+    decompressor = _decompressors[codec]()
+    try:
+        data = decompressor.decompress(payload, max_length)
+    except _decompress_errors as e:
+        raise ValueError(f"Corrupt {codec} frame: {e}") from e
+    # A stream that did not end within max_length bytes is either cut short or too large.
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError(f"Corrupt or oversized {codec} frame")
+    return data
+
+
+def is_compressed_format(name: str, head: bytes) -> bool:
+    """True for a file that is compressed already, going by its extension or its first MAGIC_SIZE bytes."""
+    if os.path.splitext(name or "")[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    if head[4:8] == b"ftyp" or (head[:4] == b"RIFF" and head[8:12] in (b"WEBP", b"AVI ")):  # MP4/MOV, WebP, AVI
+        return True
+    return head.startswith(COMPRESSED_MAGIC)
+
+
+def compress_chunk(payload: bytes, codec: str) -> Tuple[int, bytes]:
+    """
+    Compress one data chunk with ``codec``.
+
+    Returns:
+        Tuple of (chunk flags naming the codec actually used, payload); the payload is sent raw if
+        compressing did not make it smaller
+    """
+    if codec == "none" or not payload:
+        return 0, payload
+    compressed = _chunk_compressors[codec](payload)
+    if RAW_LENGTH.size + len(compressed) >= len(payload):
+        return 0, payload
+    return CODECS[codec] << CHUNK_CODEC_SHIFT, RAW_LENGTH.pack(len(payload)) + compressed
+
+
+def submit_chunk(payload: bytes, codec: str):
+    """Compress a data chunk on the compression threads; the future's result is ``compress_chunk``'s."""
+    return _pool().submit(compress_chunk, payload, codec)
+
+
+def chunk_codec(flags: int) -> Optional[str]:
+    """The codec a data chunk's payload is compressed with, or None for a raw chunk."""
+    codec_id = (flags >> CHUNK_CODEC_SHIFT) & CODEC_MASK
+    if not codec_id:
+        return None
+    if codec_id not in CODEC_NAMES:
+        raise ValueError(f"Unknown codec id {codec_id} in chunk flags")
+    return CODEC_NAMES[codec_id]
+
+
+def chunk_raw_length(payload) -> int:
+    """How many bytes of data a compressed chunk's payload holds."""
+    return RAW_LENGTH.unpack_from(payload)[0]
+
+
+def decompress_chunk(payload, codec: str) -> bytes:
+    """
+    Undo ``compress_chunk``; never produces more than the length the chunk announces.
+
+    Raises:
+        ValueError: If the announced length exceeds COMPRESSED_CHUNK_SIZE, or the payload does not
+                    decompress to exactly that length
+    """
+    raw_length = chunk_raw_length(payload)
+    if raw_length > COMPRESSED_CHUNK_SIZE:
+        raise ValueError(f"Compressed chunk announces {raw_length} bytes, more than a chunk holds")
+    decompressor = _decompressors[codec]()
+    try:
+        data = decompressor.decompress(memoryview(payload)[RAW_LENGTH.size:], raw_length + 1)
+    except _decompress_errors as e:
+        raise ValueError(f"Corrupt {codec} chunk: {e}") from e
+    if len(data) != raw_length or not decompressor.eof:
+        raise ValueError(f"Corrupt {codec} chunk: expected {raw_length} bytes, got {len(data)}")
+    return data
@@ -0,0 +1,180 @@
+import itertools
+import threading
+from collections import defaultdict, deque
+
+from utils.compression import DEFAULT_CODEC, compress, decompress
+from utils.framing import recv_frame, send_frame
+from utils.mux import Multiplexer
+from utils.request_parser import response_parser
+from utils.serializers import DEFAULT_ENCODING, SERIALIZERS
+
+
+class ReplyChannel:
+    """
+    The control connection as seen by a server command handler.
+
+    Frames sent through it carry the id of the request being answered. Every
+    other attribute (``getsockname`` and friends) is looked up on the
+    underlying socket, so handlers keep treating it as their connection.
+    """
+
+    def __init__(self, channel: "ControlChannel", request_id: int):
+        self.channel = channel
+        self.request_id = request_id
+
+    @property
+    def serializer(self):
+        return self.channel.serializer
+
+    def send_message(self, payload: bytes, flags: int = 0) -> int:
+        self.channel.send_compressed(payload, self.request_id, flags)
+        return self.request_id
+
+    def __getattr__(self, name):
+        return getattr(self.channel.connection, name)
+
+
+class ControlChannel:
+    """
+    Framed control connection shared by the client and the server.
+
+    The client may send any number of queries before reading a reply;
+    replies are matched to queries by request id, and replies that arrive
+    while waiting for a different id are kept until asked for. A request may
+    be answered more than once (an upload is accepted, then confirmed), so
+    replies to the same id are queued in arrival order.
+
+    Messages are encoded with the serializer and compressed with the codec
+    negotiated at connect time. Each frame records both in its flags; a
+    frame compressed with anything but the agreed codec is refused, so
+    nothing is inflated before negotiate.
+
+    File data of multiplexed transfers shares the connection as stream
+    frames (see ``utils.mux``); every reader hands frames to ``mux`` first.
+    A client with such transfers starts a reader thread, so stream data
+    keeps flowing while it is not waiting for a reply.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.recv_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.pending = defaultdict(deque)
+        self.replies = threading.Condition()
+        self.reader = None
+        self.closed = False
+        self.codec = DEFAULT_CODEC
+        self.accepted_codec = DEFAULT_CODEC  # What the peer may compress its frames with, once agreed
+        self.serializer = SERIALIZERS[DEFAULT_ENCODING]
+        self.mux = Multiplexer(self)
+
+    def send_frame(self, payload: bytes, request_id: int, flags: int = 0):
+        with self.send_lock:
+            send_frame(self.connection, payload, request_id, flags)
+
+    def send_compressed(self, payload: bytes, request_id: int, flags: int = 0):
+        codec_flags, payload = compress(payload, self.codec)
+        self.send_frame(payload, request_id, flags | codec_flags)
+
+    def send_message(self, payload: bytes, flags: int = 0, stream: bool = False) -> int:
+        """
+        Send a new query and return the request id its reply will carry.
+
+        A query asking for a multiplexed transfer (``stream``) opens its
+        stream first, so data that follows the reply is never refused.
+        """
+        request_id = next(self.request_ids)
+        if stream:
+            self.mux.expect(request_id)
+        self.send_compressed(payload, request_id, flags)
+        return request_id
+
+    def decode(self, frame):
+        """
+        Return ``frame`` with its payload decompressed.
+
+        Raises:
+            ValueError: If it uses a codec this connection did not agree on, or inflates past MAX_FRAME_SIZE
+        """
+        request_id, flags, payload = frame
+        return request_id, flags, decompress(flags, payload, self.accepted_codec)
+
+    def recv_response(self, request_id: int) -> dict:
+        """Block until the reply to ``request_id`` arrives and return it parsed."""
+        if self.reader is not None:
+            with self.replies:
+                self.replies.wait_for(lambda: self.pending.get(request_id) or self.closed)
+                flags, payload = self.pop_reply(request_id)
+        else:
+            flags, payload = self.receive_reply(request_id)
+        response = response_parser(payload, flags)
+        self.mux.settle(request_id, response)
+        return response
+
+    def receive_reply(self, request_id: int):
+        """Read the connection on this thread until a reply to ``request_id`` is queued, and take it."""
+        with self.recv_lock:
+            while not self.pending.get(request_id):
+                frame = recv_frame(self.connection)
+                if frame is None:
+                    self.mux.close()
+                    raise ConnectionError("Control connection closed by the server")
+                if self.mux.dispatch(frame):
+                    continue
+                reply_id, flags, payload = self.decode(frame)
+                self.pending[reply_id].append((flags, payload))
+            return self.pop_reply(request_id)
+
+    def pop_reply(self, request_id: int):
+        replies = self.pending.get(request_id)
+        if not replies:
+            raise ConnectionError("Control connection closed by the server")
+        flags, payload = replies.popleft()
+        if not replies:
+            del self.pending[request_id]
+        return flags, payload
+
+    def start_reader(self):
+        """Read the connection on a background thread from now on; replies are handed over to ``recv_response``."""
+        with self.recv_lock:
+            if self.reader is None:
+                self.reader = threading.Thread(target=self.read_forever, name="ftp-control-reader", daemon=True)
+                self.reader.start()
+
+    def read_forever(self):
+        try:
+            while True:
+                frame = recv_frame(self.connection)
+                if frame is None:
+                    break
+                if self.mux.dispatch(frame):
+                    continue
+                reply_id, flags, payload = self.decode(frame)
+                with self.replies:
+                    self.pending[reply_id].append((flags, payload))
+                    self.replies.notify_all()
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.mux.close()
+            with self.replies:
+                self.closed = True
+                self.replies.notify_all()
+
+    def pipeline(self, queries: list) -> list[dict]:
+        """Send every query before reading any reply, so a batch costs a single round trip."""
+        request_ids = [query.serialize_and_send(self) for query in queries]
+        return [self.recv_response(request_id) for request_id in request_ids]
+
+    def recv_request(self):
+        """Server side: read the next request frame, or None when the client disconnected."""
+        while True:
+            frame = recv_frame(self.connection)
+            if frame is None:
+                return None
+            if not self.mux.dispatch(frame):
+                return self.decode(frame)
+
+    def reply_to(self, request_id: int) -> ReplyChannel:
+        return ReplyChannel(self, request_id)
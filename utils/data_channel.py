@@ -0,0 +1,121 @@
+import socket
+import ssl
+import struct
+from typing import Optional, Tuple
+
+from utils.tls import tls
+from utils.tuning import tune_data_socket
+
+# Every piece of a data stream is preceded by a chunk header: payload length and flags.
+CHUNK_HEADER = struct.Struct("!IB")
+
+FLAG_END = 0x01  # Last chunk of the stream; its payload is the trailer
+
+# A segmented transfer opens every data connection with the byte range (offset, length) it carries.
+SEGMENT_HEADER = struct.Struct("!QQ")
+
+# Data connections to a server data port open with the one-time token of the transfer they belong to.
+TOKEN_SIZE = 16
+
+
+def pack_chunk_header(length: int, flags: int = 0) -> bytes:
+    return CHUNK_HEADER.pack(length, flags)
+
+
+def send_chunk(connection, payload: bytes, flags: int = 0):
+    connection.sendall(pack_chunk_header(len(payload), flags) + payload)
+
+
+def send_end(connection, trailer: bytes = b""):
+    """Close the stream; the receiver stops reading after the trailer."""
+    send_chunk(connection, trailer, FLAG_END)
+
+
+def recv_into_exact(connection, view: memoryview, size: int):
+    """Fill the first ``size`` bytes of ``view`` from the connection."""
+    received = 0
+    while received < size:
+        count = connection.recv_into(view[received:size], size - received)
+        if not count:
+            raise ConnectionError("Connection closed unexpectedly")
+        received += count
+
+
+def recv_exact(connection, size: int) -> bytes:
+    buffer = bytearray(size)
+    recv_into_exact(connection, memoryview(buffer), size)
+    return bytes(buffer)
+
+
+def recv_chunk_header(connection) -> Tuple[int, int]:
+    """Return the (length, flags) of the next chunk."""
+    return CHUNK_HEADER.unpack(recv_exact(connection, CHUNK_HEADER.size))
+
+
+def send_segment_header(connection, offset: int, length: int):
+    connection.sendall(SEGMENT_HEADER.pack(offset, length))
+
+
+def recv_segment_header(connection) -> Tuple[int, int]:
+    """Return the (offset, length) of the byte range a segment connection carries."""
+    return SEGMENT_HEADER.unpack(recv_exact(connection, SEGMENT_HEADER.size))
+
+
+def send_token(connection, token: bytes):
+    connection.sendall(token)
+
+
+def linger(connection):
+    """
+    Before the client closes a TLS data connection it sent a stream on, wait for the receiver to close it.
+
+    A TLS 1.3 server sends its session tickets after the handshake, and a
+    connection that only sends never reads them. Closing a socket with
+    unread bytes makes the kernel reset the connection, which throws away
+    whatever the receiver has not read yet; reading to the end consumes the
+    tickets, and the receiver closes as soon as it has read the END chunk.
+    """
+    if not isinstance(connection, ssl.SSLSocket) or connection.server_side:
+        return
+    try:
+        while connection.recv(4096):
+            pass
+    except OSError:
+        # Everything was sent; whether it arrived is the receiver's to report.
+        pass
+
+
+class DataDialer:
+    """
+    Connects to a peer's data port, with the interface of the listening socket it replaces.
+
+    Transfer code calls ``accept`` to get each data connection, whether it
+    waits for the peer or, as here, dials the peer's leased port and
+    presents the transfer's token.
+    """
+
+    def __init__(self, address: str, port: int, token: Optional[bytes] = None):
+        self.address = address
+        self.port = port
+        self.token = token
+        self.timeout = None
+
+    def settimeout(self, timeout: Optional[float]):
+        self.timeout = timeout
+
+    def accept(self) -> Tuple[socket.socket, Tuple[str, int]]:
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            tune_data_socket(connection)
+            connection.settimeout(self.timeout)
+            connection.connect((self.address, self.port))
+            connection = tls.wrap_client(connection, self.address)
+            if self.token:
+                send_token(connection, self.token)
+        except OSError:
+            connection.close()
+            raise
+        return connection, (self.address, self.port)
+
+    def close(self):
+        pass
@@ -0,0 +1,83 @@
+import asyncio
+import struct
+from typing import Optional, Tuple
+
+# Every control message travels as: payload length, request id, flags, payload.
+FRAME_HEADER = struct.Struct("!IIB")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+RECV_PIECE = 64 * 1024  # First read of a frame's payload; later reads grow with what has already arrived
+
+Frame = Tuple[int, int, bytes]  # (request id, flags, payload)
+
+
+def pack_frame(payload: bytes, request_id: int, flags: int = 0) -> bytes:
+    """Prefix ``payload`` with a frame header."""
+    return FRAME_HEADER.pack(len(payload), request_id, flags) + payload
+
+
+def send_frame(connection, payload: bytes, request_id: int, flags: int = 0):
+    """Send one frame with a single ``sendall`` so concurrent writers never interleave partial frames."""
+    connection.sendall(pack_frame(payload, request_id, flags))
+
+
+def recv_exact(connection, size: int) -> Optional[bytes]:
+    """
+    Read exactly ``size`` bytes from a blocking socket.
+
+    The length comes from a header the peer wrote, so memory is only taken
+    as bytes arrive: each read asks for at most as much as has arrived
+    already (or RECV_PIECE), and a payload that came in one read is
+    returned without a copy.
+
+    Returns:
+        The bytes read, or None if the peer closed before sending anything.
+
+    Raises:
+        ConnectionError: If the peer closed in the middle of the data.
+    """
+    pieces = []
+    received = 0
+    while received < size:
+        piece = connection.recv(min(size - received, max(RECV_PIECE, received)))
+        if not piece:
+            if received == 0:
+                return None
+            raise ConnectionError("Connection closed in the middle of a frame")
+        pieces.append(piece)
+        received += len(piece)
+    return pieces[0] if len(pieces) == 1 else b"".join(pieces)
+
+
+def parse_header(header: bytes) -> Tuple[int, int, int]:
+    length, request_id, flags = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ConnectionError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return length, request_id, flags
+
+
+def recv_frame(connection) -> Optional[Frame]:
+    """Read one frame from a blocking socket, or return None when the peer closed the connection."""
+    header = recv_exact(connection, FRAME_HEADER.size)
+    if header is None:
+        return None
+    length, request_id, flags = parse_header(header)
+    payload = recv_exact(connection, length) if length else b""
+    if payload is None:
+        raise ConnectionError("Connection closed in the middle of a frame")
+    return request_id, flags, payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Frame]:
+    """Read one frame from an asyncio stream, or return None when the peer closed the connection."""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed in the middle of a frame")
+    length, request_id, flags = parse_header(header)
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed in the middle of a frame")
+    return request_id, flags, payload
@@ -0,0 +1,145 @@
+import hashlib
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_HASH_ALGORITHM = "md5"  # What peers that do not negotiate use
+TREE_BLOCK_SIZE = 4 * 1024 * 1024  # Leaf size of the tree hash
+TREE_DIGEST_SIZE = 32
+TREE_THREADS = min(8, os.cpu_count() or 1)
+HASH_READ_SIZE = 1024 * 1024  # Bytes read per hash update when hashing straight from a file
+
+# Leaves of every tree hash in the process are hashed here; hashlib releases the GIL while hashing.
+_leaf_pool = None
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _leaf_pool
+    if _leaf_pool is None:
+        _leaf_pool = ThreadPoolExecutor(max_workers=TREE_THREADS, thread_name_prefix="ftp-hash")
+    return _leaf_pool
+
+
+def _leaf_digest(block: bytearray, index: int, last: bool) -> bytes:
+    return hashlib.blake2b(block, digest_size=TREE_DIGEST_SIZE, fanout=0, depth=2, leaf_size=TREE_BLOCK_SIZE,
+                           node_offset=index, node_depth=0, inner_size=TREE_DIGEST_SIZE, last_node=last).digest()
+
+
+class TreeHash:
+    """
+    BLAKE2b in tree mode: fixed-size blocks are hashed in parallel, then their digests once more.
+
+    The file is cut into TREE_BLOCK_SIZE leaves, each hashed on the shared
+    pool while the caller keeps feeding data; the root hashes the leaf
+    digests in order. Only a few blocks are in flight at a time, so memory
+    use does not grow with the file. Has the ``update``/``hexdigest``
+    interface of a hashlib object.
+    """
+    name = "tree-blake2b"
+
+    def __init__(self):
+        self.block = bytearray()
+        self.index = 0
+        self.in_flight = deque()
+        self.leaves = []
+        self.digest_value = None
+
+    def _submit(self, last: bool):
+        self.in_flight.append(_pool().submit(_leaf_digest, self.block, self.index, last))
+        self.block = bytearray()
+        self.index += 1
+        while len(self.in_flight) > TREE_THREADS * 2:
+            self.leaves.append(self.in_flight.popleft().result())
+
+    def update(self, data):
+        # The caller may reuse its buffer as soon as this returns, so data is copied into the block.
+        data = memoryview(data).cast("B")
+        while len(data):
+            if len(self.block) == TREE_BLOCK_SIZE:
+                # Only submitted once more data follows, so the last leaf can be marked as such.
+                self._submit(last=False)
+            take = min(TREE_BLOCK_SIZE - len(self.block), len(data))
+            self.block += data[:take]
+            data = data[take:]
+
+    def digest(self) -> bytes:
+        if self.digest_value is None:
+            self._submit(last=True)
+            self.leaves.extend(future.result() for future in self.in_flight)
+            self.in_flight.clear()
+            root = hashlib.blake2b(digest_size=TREE_DIGEST_SIZE, fanout=0, depth=2, leaf_size=TREE_BLOCK_SIZE,
+                                   node_offset=0, node_depth=1, inner_size=TREE_DIGEST_SIZE, last_node=True)
+            for leaf in self.leaves:
+                root.update(leaf)
+            self.digest_value = root.digest()
+        return self.digest_value
+
+    def hexdigest(self) -> str:
+        return self.digest().hex()
+
+    def copy(self) -> "TreeHash":
+        """Return an independent hasher with the same state, e.g. to digest a prefix and keep going."""
+        self.leaves.extend(future.result() for future in self.in_flight)
+        self.in_flight.clear()
+        other = TreeHash()
+        other.block = bytearray(self.block)
+        other.index = self.index
+        other.leaves = list(self.leaves)
+        other.digest_value = self.digest_value
+        return other
+
+
+HASH_ALGORITHMS = {
+    "md5": hashlib.md5,
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+    TreeHash.name: TreeHash,
+}
+
+
+def choose_hash_algorithm(offered: list[str]) -> str:
+    """Pick the first hash algorithm in the peer's preference list that this side supports."""
+    for name in offered or []:
+        if name in HASH_ALGORITHMS:
+            return name
+    return DEFAULT_HASH_ALGORITHM
+
+
+def new_hasher(name: str = DEFAULT_HASH_ALGORITHM):
+    """Return a fresh hash object for ``name``."""
+    try:
+        return HASH_ALGORITHMS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown hash algorithm {name}")
+
+
+def hash_region(file, hasher, offset: int, count: int, buffer: memoryview = None):
+    """Feed ``count`` bytes of ``file`` starting at ``offset`` to ``hasher`` without moving the file position."""
+    if buffer is None:
+        buffer = memoryview(bytearray(HASH_READ_SIZE))
+    fd = file.fileno()
+    end = offset + count
+    while offset < end:
+        size = min(len(buffer), end - offset)
+        if hasattr(os, "preadv"):
+            read = os.preadv(fd, [buffer[:size]], offset)
+            data = buffer[:read]
+        else:
+            data = os.pread(fd, size, offset)
+            read = len(data)
+        if not read:
+            raise ConnectionError("File changed size while it was being read")
+        hasher.update(data)
+        offset += read
+
+
+def hash_prefix(file, name: str, length: int):
+    """
+    Return a new ``name`` hasher fed with the first ``length`` bytes of ``file``.
+
+    Resumed transfers digest a copy of it to compare the prefix both sides
+    hold, then keep feeding it the rest of the file.
+    """
+    hasher = new_hasher(name)
+    hash_region(file, hasher, 0, length)
+    return hasher
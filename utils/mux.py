@@ -0,0 +1,257 @@
+import socket
+import struct
+import threading
+from collections import deque
+from typing import Optional
+
+# Bits 4-7 of a frame's flags byte name the frame kind; plain control messages leave them clear.
+FRAME_KIND_MASK = 0xF0
+FRAME_DATA = 0x10  # Stream bytes; the request id field is the stream id, an empty payload ends the stream
+FRAME_WINDOW = 0x20  # Flow-control credit for a stream, as a WINDOW_UPDATE payload
+
+WINDOW_UPDATE = struct.Struct("!I")
+MUX_TRANSPORT = "mux"  # Value of a transfer's "transport" field when its data travels on the control connection
+STREAM_WINDOW = 4 * 1024 * 1024  # Bytes a sender may have in flight per stream before the receiver grants more
+MAX_DATA_FRAME = 256 * 1024  # Largest DATA payload, so other streams and replies get a turn on the connection
+
+
+class MuxStream:
+    """
+    One transfer's data stream carried as DATA frames on a control connection.
+
+    Behaves like a connected socket (``sendall``, ``recv_into``,
+    ``settimeout``, ``close``) and, through ``accept``, like the listening
+    socket it replaces, so the chunked stream code runs on it unchanged.
+    A sender may have STREAM_WINDOW bytes in flight; the receiver grants
+    more with WINDOW frames as the data is consumed, so one slow stream
+    never holds up the others or the replies on the same connection. A
+    peer that sends more than it was granted breaks the protocol, and its
+    connection is dropped rather than buffered.
+
+    The stream id is the id of the request that started the transfer.
+    Closing sends an empty DATA frame; the stream is forgotten once both
+    sides have closed.
+    """
+
+    def __init__(self, mux: "Multiplexer", stream_id: int):
+        self.mux = mux
+        self.stream_id = stream_id
+        self.condition = threading.Condition()
+        self.inbound = deque()
+        self.send_credit = STREAM_WINDOW
+        self.receive_credit = STREAM_WINDOW  # Bytes the peer may still send before it is granted more
+        self.consumed = 0  # Bytes read since the last WINDOW frame
+        self.timeout = None
+        self.remote_closed = False
+        self.local_closed = False
+        self.error = None
+
+    # Called by the connection's reader.
+
+    def feed(self, payload: bytes):
+        """
+        Take the next DATA payload from the peer; an empty one ends the stream.
+
+        Raises:
+            ConnectionError: If the payload exceeds the credit the peer was granted
+        """
+        with self.condition:
+            self.receive_credit -= len(payload)
+            if self.receive_credit < 0:
+                raise ConnectionError(f"Stream {self.stream_id} sent past its flow-control window")
+            if not payload:
+                self.remote_closed = True
+            elif not self.local_closed:
+                self.inbound.append(memoryview(payload))
+            self.condition.notify_all()
+        if not payload and self.local_closed:
+            self.mux.forget(self)
+
+    def grant(self, increment: int):
+        with self.condition:
+            self.send_credit += increment
+            self.condition.notify_all()
+
+    def fail(self, error: str):
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    # Socket interface used by the transfer.
+
+    def settimeout(self, timeout: Optional[float]):
+        self.timeout = timeout
+
+    def accept(self):
+        return self, self.getpeername()
+
+    def _wait(self, ready):
+        if not self.condition.wait_for(lambda: ready() or self.error, self.timeout):
+            raise socket.timeout("Timed out waiting on the multiplexed stream")
+        if self.error and not ready():
+            raise ConnectionError(self.error)
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        view = memoryview(buffer).cast("B")
+        nbytes = nbytes or len(view)
+        with self.condition:
+            self._wait(lambda: self.inbound or self.remote_closed)
+            if not self.inbound:
+                return 0
+            head = self.inbound[0]
+            count = min(nbytes, len(head))
+            view[:count] = head[:count]
+            if count == len(head):
+                self.inbound.popleft()
+            else:
+                self.inbound[0] = head[count:]
+            self.consumed += count
+            increment = 0
+            if self.consumed >= STREAM_WINDOW // 2:
+                increment, self.consumed = self.consumed, 0
+                self.receive_credit += increment
+        if increment:
+            self.mux.send_window(self.stream_id, increment)
+        return count
+
+    def recv(self, bufsize: int) -> bytes:
+        buffer = bytearray(bufsize)
+        return bytes(buffer[:self.recv_into(buffer)])
+
+    def sendall(self, data):
+        view = memoryview(data).cast("B")
+        while len(view):
+            with self.condition:
+                self._wait(lambda: self.send_credit > 0 or self.remote_closed)
+                if self.remote_closed:
+                    raise ConnectionError("Stream closed by the peer")
+                count = min(self.send_credit, len(view), MAX_DATA_FRAME)
+                self.send_credit -= count
+            self.mux.send_data(self.stream_id, view[:count])
+            view = view[count:]
+
+    def close(self):
+        with self.condition:
+            if self.local_closed:
+                return
+            self.local_closed = True
+            self.inbound.clear()
+            forget = self.remote_closed or self.error
+        if not self.error:
+            try:
+                self.mux.send_data(self.stream_id, b"")
+            except OSError:
+                pass
+        if forget:
+            self.mux.forget(self)
+
+    def getsockname(self):
+        return self.mux.channel.connection.getsockname()
+
+    def getpeername(self):
+        return self.mux.channel.connection.getpeername()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Multiplexer:
+    """
+    The data streams open on one control connection.
+
+    Whoever reads the connection hands every frame to ``dispatch`` first;
+    stream frames are delivered here and everything else is left for the
+    control channel. Only a transfer opens a stream: the server once it
+    accepts the transfer, before replying, and the client with ``expect``
+    before it sends the request, since the data may follow the reply before
+    the client has read it. A DATA frame for any other stream breaks the
+    protocol and drops the connection, so nothing is buffered for a
+    transfer that was never accepted.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.streams = {}
+        self.expected = set()  # Streams opened by ``expect`` whose request has not been answered yet
+        self.lock = threading.Lock()
+        self.error = None
+
+    def open(self, stream_id: int) -> MuxStream:
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                stream = self.streams[stream_id] = MuxStream(self, stream_id)
+                if self.error:
+                    stream.fail(self.error)
+            return stream
+
+    def expect(self, stream_id: int) -> MuxStream:
+        """Open the stream of a transfer about to be requested as ``stream_id``; ``settle`` it with the reply."""
+        with self.lock:
+            self.expected.add(stream_id)
+        return self.open(stream_id)
+
+    def settle(self, stream_id: int, response: dict):
+        """Keep an expected stream if ``response`` accepted its transfer as multiplexed, otherwise drop it."""
+        data = response.get("data")
+        accepted = response.get("accept") and isinstance(data, dict) and data.get("transport") == MUX_TRANSPORT
+        with self.lock:
+            if stream_id not in self.expected:
+                return
+            self.expected.discard(stream_id)
+            if not accepted:
+                self.streams.pop(stream_id, None)
+
+    def forget(self, stream: MuxStream):
+        with self.lock:
+            if self.streams.get(stream.stream_id) is stream:
+                del self.streams[stream.stream_id]
+
+    def dispatch(self, frame) -> bool:
+        """
+        Deliver ``frame`` if it belongs to a stream; return False for a control message.
+
+        Raises:
+            ConnectionError: If it carries data for a stream no transfer opened, or past the stream's window
+        """
+        stream_id, flags, payload = frame
+        kind = flags & FRAME_KIND_MASK
+        if kind == FRAME_DATA:
+            with self.lock:
+                stream = self.streams.get(stream_id)
+            if stream is not None:
+                stream.feed(payload)
+            elif payload:
+                raise ConnectionError(f"Data for stream {stream_id}, which no accepted transfer opened")
+            # The end of a stream that was already forgotten needs no delivery.
+            return True
+        if kind == FRAME_WINDOW:
+            with self.lock:
+                stream = self.streams.get(stream_id)
+            if stream is not None:
+                stream.grant(WINDOW_UPDATE.unpack(payload)[0])
+            return True
+        return False
+
+    def send_data(self, stream_id: int, payload):
+        self.channel.send_frame(payload, stream_id, FRAME_DATA)
+
+    def send_window(self, stream_id: int, increment: int):
+        try:
+            self.channel.send_frame(WINDOW_UPDATE.pack(increment), stream_id, FRAME_WINDOW)
+        except OSError:
+            pass
+
+    def close(self, error: str = "Control connection closed"):
+        """Fail every open stream, e.g. when the control connection is gone."""
+        with self.lock:
+            self.error = error
+            streams = list(self.streams.values())
+            self.streams.clear()
+            self.expected.clear()
+        for stream in streams:
+            stream.fail(error)
+
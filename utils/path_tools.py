@@ -80,6 +80,40 @@ def validate_path(processed_path, dir_check=False, file_check=False, check_exist
         return False
 
 
+def is_relative_inside(relative_path) -> bool:
+    """True if ``relative_path`` stays inside whatever directory it is joined to: not absolute, no '..' parts."""
+    if not isinstance(relative_path, str) or not relative_path or os.path.isabs(relative_path):
+        return False
+    parts = pathlib.PurePath(relative_path).parts
+    return ".." not in parts and "" not in parts
+
+
+def walk_tree(root):
+    """
+    Every directory and file below ``root``, in one pass of os.scandir per directory.
+
+    Symbolic links to directories are not followed, so a link loop cannot
+    make the walk endless. Paths are relative to ``root`` and use '/',
+    and a directory always comes before anything inside it.
+
+    Returns:
+        Tuple of (directory paths, [file path, size] pairs)
+    """
+    dirs, files = [], []
+    pending = [""]
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(root, relative_dir)) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(relative_path)
+                    pending.append(relative_path)
+                elif entry.is_file():
+                    files.append([relative_path, entry.stat().st_size])
+    return dirs, files
+
+
 class PathAccessController:
     def __init__(self,
                  public_base_dir='/Public',
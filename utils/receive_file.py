@@ -1,11 +1,269 @@
-import hashlib
 import os
+import queue
 import socket
-from typing import Optional, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 from tqdm import tqdm
 
+from utils.AES_handler import SEAL_TAG_SIZE, SEALED_CHUNK_SIZE, recv_sealed, stream_key, unseal_stream
+from utils.compression import COMPRESSED_CHUNK_SIZE, RAW_LENGTH, chunk_codec, chunk_raw_length, decompress_chunk
+from utils.data_channel import (FLAG_END, DataDialer, recv_chunk_header, recv_exact, recv_into_exact,
+                                recv_segment_header)
+from utils.hashing import DEFAULT_HASH_ALGORITHM, new_hasher
+from utils.path_tools import is_relative_inside
+from utils.transfer_journal import CHECKPOINT_INTERVAL, remove_journal, write_journal
+from utils.tuning import tuning
+
 DELIMITER = '<SEPARATOR>'
+WRITE_BEHIND_BUFFERS = 8  # Buffers that can be waiting for the disk while the next one is received
+
+# Read once at import, while only one thread runs: os.umask can only be read by setting it.
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+class WriteBehind:
+    """
+    A ring of reusable receive buffers drained to disk by a background thread.
+
+    The receive loop fills a free buffer with ``recv_into`` and submits it;
+    the writer thread writes it and hands it back. Network and disk I/O
+    overlap, and no bytes objects are allocated per chunk. The optional
+    ``hasher`` is fed on the writer thread too, in stream order, and so
+    are compressed chunks decompressed.
+
+    With a ``position`` the data is written there with pwrite instead of
+    at the file's current position, so several writers can fill different
+    ranges of one file.
+    """
+
+    def __init__(self, file, buffer_size: int, buffers: int = WRITE_BEHIND_BUFFERS, hasher=None,
+                 position: Optional[int] = None):
+        self.file = file
+        self.hasher = hasher
+        self.position = position
+        self.free = queue.Queue()
+        self.filled = queue.Queue()
+        self.error = None
+        self.buffer_size = buffer_size
+        self.written = 0  # Bytes already handed to the file
+        for _ in range(buffers):
+            self.free.put(memoryview(bytearray(buffer_size)))
+        self.thread = threading.Thread(target=self._drain, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def get_buffer(self) -> memoryview:
+        buffer = self.free.get()
+        if self.error:
+            raise self.error
+        return buffer
+
+    def submit(self, buffer: memoryview, length: int):
+        self.filled.put((buffer, buffer[:length], None))
+
+    def submit_compressed(self, buffer: memoryview, payload: memoryview, codec: str):
+        """Queue the compressed chunk ``payload`` received into ``buffer``, to be decompressed and written."""
+        self.filled.put((buffer, payload, codec))
+
+    def release(self, buffer: memoryview):
+        """Return a buffer that was taken but not filled."""
+        self.free.put(buffer)
+
+    def _drain(self):
+        while True:
+            item = self.filled.get()
+            if item is None:
+                return
+            buffer, data, codec = item
+            try:
+                if self.error is None:
+                    if codec:
+                        data = memoryview(decompress_chunk(data, codec))
+                    if self.position is None:
+                        self.file.write(data)
+                    else:
+                        pwrite_all(self.file.fileno(), data, self.position + self.written)
+                    self.written += len(data)
+                    if self.hasher:
+                        self.hasher.update(data)
+            except ValueError as e:
+                self.error = ConnectionError(str(e))
+            except OSError as e:
+                self.error = e
+            finally:
+                self.free.put(buffer)
+
+    def close(self):
+        """Wait until every submitted buffer is on disk, re-raising any write error."""
+        self.filled.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+
+def pwrite_all(fd: int, data: memoryview, offset: int):
+    while len(data):
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+def permission_bits(mode) -> Optional[int]:
+    """
+    The permission bits of a peer's file ``mode`` that may be applied here, or None if it is not a number.
+
+    Setuid, setgid and sticky bits are never taken, nor bits this process's umask clears.
+    """
+    if not isinstance(mode, int) or isinstance(mode, bool):
+        return None
+    return mode & 0o777 & ~UMASK
+
+
+def remove_partial(path: str):
+    """Delete a file whose transfer failed, so it is not mistaken for a complete one."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def preallocate(file, file_size: int):
+    """Reserve the file's blocks up front so the filesystem can lay them out contiguously."""
+    if file_size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, file_size)
+    except OSError:
+        # Not supported by every filesystem; the writes will allocate as they go.
+        pass
+
+
+def receive_stream(connection, file, file_size: int, buffer_size: int, progress=None,
+                   hasher=None, checkpoint=None, position: Optional[int] = None,
+                   key: Optional[bytes] = None) -> Tuple[int, bytes]:
+    """
+    Receive a chunked data stream from a connected socket into ``file``, at ``position`` or else its current one.
+
+    Chunk headers give exact byte counts, so payload bytes are never
+    inspected; compressed chunks are decompressed on the writer thread.
+    The stream ends at the END chunk. ``file_size`` is what the
+    stream may carry at most. ``checkpoint`` is called with the number of
+    bytes on disk every CHECKPOINT_INTERVAL bytes. If the stream breaks,
+    the file is cut right after the last byte written, so the transfer can
+    be resumed from there; with a ``position`` it is left alone, since
+    other streams may be writing to the rest of it.
+
+    With a data ``key`` the stream is encrypted: every chunk is
+    authenticated and decrypted in place in a write-behind buffer, which
+    then holds a whole chunk, before any of it is written. Compressed
+    chunks are received into the buffers the same way, so the buffers hold
+    at least one compressed chunk of COMPRESSED_CHUNK_SIZE bytes.
+
+    Returns:
+        Tuple of (number of bytes written, trailer sent with the END chunk)
+
+    Raises:
+        ConnectionError: If the sender closed the connection early, sent more than ``file_size``
+                         or sent a chunk that fails authentication
+    """
+    cipher = unseal_stream(connection, key)
+    overhead = SEAL_TAG_SIZE if cipher else 0
+    if cipher:
+        buffer_size = min(SEALED_CHUNK_SIZE, file_size) + SEAL_TAG_SIZE
+    else:
+        # A small file needs no more buffer than its own size.
+        buffer_size = max(1, min(max(buffer_size, COMPRESSED_CHUNK_SIZE), file_size))
+    writer = WriteBehind(file, buffer_size, hasher=hasher, position=position)
+    total_received = 0
+    checkpointed = 0
+    try:
+        while True:
+            length, flags = recv_chunk_header(connection)
+            if flags & FLAG_END:
+                if cipher:
+                    trailer = bytes(recv_sealed(connection, cipher, length, flags))
+                else:
+                    trailer = recv_exact(connection, length)
+                break
+            try:
+                codec = chunk_codec(flags)
+            except ValueError as e:
+                raise ConnectionError(str(e))
+            if codec:
+                # Decompressed on the writer thread; the chunk says up front how much data it holds.
+                # compress_chunk only sends a payload smaller than that, and no chunk holds more than
+                # COMPRESSED_CHUNK_SIZE bytes.
+                if not RAW_LENGTH.size < length - overhead <= COMPRESSED_CHUNK_SIZE or length > writer.buffer_size:
+                    raise ConnectionError("Invalid compressed chunk")
+                buffer = writer.get_buffer()
+                try:
+                    recv_into_exact(connection, buffer, length)
+                    payload = cipher.open(buffer[:length], flags) if cipher else buffer[:length]
+                    count = chunk_raw_length(payload)
+                    if not len(payload) < count <= COMPRESSED_CHUNK_SIZE:
+                        raise ValueError("Invalid compressed chunk")
+                    if total_received + count > file_size:
+                        raise ValueError("Sender exceeded the announced file size")
+                except ValueError as e:
+                    writer.release(buffer)
+                    raise ConnectionError(str(e))
+                except BaseException:
+                    writer.release(buffer)
+                    raise
+                writer.submit_compressed(buffer, payload, codec)
+                total_received += count
+                if progress:
+                    progress.update(count)
+            elif total_received + length - overhead > file_size:
+                raise ConnectionError("Sender exceeded the announced file size")
+            elif cipher:
+                if not overhead < length <= writer.buffer_size:
+                    raise ConnectionError("Invalid encrypted chunk")
+                buffer = writer.get_buffer()
+                try:
+                    recv_into_exact(connection, buffer, length)
+                    count = len(cipher.open(buffer[:length], flags))
+                except ValueError as e:
+                    writer.release(buffer)
+                    raise ConnectionError(str(e))
+                except BaseException:
+                    writer.release(buffer)
+                    raise
+                writer.submit(buffer, count)
+                total_received += count
+                if progress:
+                    progress.update(count)
+            else:
+                while length:
+                    buffer = writer.get_buffer()
+                    count = min(length, len(buffer))
+                    try:
+                        recv_into_exact(connection, buffer, count)
+                    except BaseException:
+                        writer.release(buffer)
+                        raise
+                    writer.submit(buffer, count)
+                    total_received += count
+                    length -= count
+
+                    if progress:
+                        progress.update(count)
+
+            if checkpoint and writer.written - checkpointed >= CHECKPOINT_INTERVAL:
+                checkpointed = writer.written
+                checkpoint(checkpointed)
+    except BaseException:
+        try:
+            writer.close()
+        except OSError:
+            pass
+        if position is None:
+            file.truncate()
+        raise
+    writer.close()
+    return total_received, trailer
 
 
 def retrieve_file(
@@ -15,9 +273,16 @@ def retrieve_file(
         file_name: str,
         file_size: int,
         buffer_size: int,
-        checksum: str,
+        checksum: Optional[str] = None,
         progress_bar: bool = True,
-        timeout: float = 30.0
+        timeout: float = 30.0,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        hasher=None,
+        offset: int = 0,
+        journal: Optional[dict] = None,
+        token: Optional[bytes] = None,
+        listener=None,
+        key: Optional[bytes] = None
 ) -> Tuple[bool, Optional[str]]:
     """
     Retrieve and decrypt a file from a socket connection.
@@ -27,10 +292,21 @@ def retrieve_file(
         transmit_port (int): Port to connect to
         file_name (str): Name of the file to save
         file_size (int): Expected file size
-        buffer_size (int): Size of data chunks to receive
-        checksum (str): Expected MD5 checksum
+        buffer_size (int): Largest chunk the sender will write
+        checksum (str): Expected checksum, if known before the transfer; the
+                        sender's trailer is always checked
         progress_bar (bool): Whether to show progress
         timeout (float): Socket timeout in seconds
+        hash_algorithm (str): Hash algorithm agreed for this transfer
+        hasher: Hash object fed with the received bytes (default: a new ``hash_algorithm`` one); after a
+                successful transfer its digest is the verified checksum of the file
+        offset (int): Bytes of the file already on disk to resume after; ``hasher`` must already hold them
+        journal (dict): Keep a sidecar journal with these details while the file is incomplete, so the
+                        transfer can be resumed even after a restart
+        token (bytes): One-time token to present on the sender's data port
+        listener: Accept the data connection here instead of connecting to ``transmit_port``, e.g. a
+                  leased server data port; it is closed afterwards
+        key (bytes): Data key the stream is encrypted with, if encryption was agreed
 
     Returns:
         Tuple[bool, Optional[str]]:
@@ -40,57 +316,176 @@ def retrieve_file(
     transmit_socket = None
     progress = None
     full_file_path = os.path.join(file_path, file_name)
+    hasher = hasher or new_hasher(hash_algorithm)
+    endpoint = listener or DataDialer(socket_addr, transmit_port, token)
+
+    checkpoint = None
+    if journal is not None:
+        journal = dict(journal, file_size=file_size, hash_algorithm=hash_algorithm, received=offset)
+        write_journal(full_file_path, journal)
+
+        def checkpoint(written):
+            journal["received"] = offset + written
+            write_journal(full_file_path, journal)
 
     try:
-        # Create socket with timeout
-        transmit_socket = socket.create_connection((socket_addr, transmit_port), timeout=timeout)
+        endpoint.settimeout(timeout)
+        transmit_socket, addr = endpoint.accept()
         print(transmit_socket.getsockname())
         # Create progress bar if requested
         if progress_bar:
             progress = tqdm(
                 range(file_size),
                 f"Receiving {file_name}",
+                initial=offset,
                 unit="B",
                 unit_scale=True,
                 unit_divisor=1024
             )
 
-        with open(full_file_path, "wb") as f:
-            total_received = 0
-            while total_received < file_size:
-                # Receive data chunk
-                bytes_read = transmit_socket.recv(buffer_size)
+        with open(full_file_path, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            preallocate(f, file_size)
+            total_received, trailer = receive_stream(transmit_socket, f, file_size - offset,
+                                                     min(buffer_size, tuning.receive_buffer), progress, hasher,
+                                                     checkpoint, key=key)
+            if offset + total_received < file_size:
+                # Drop the preallocated tail the sender never filled.
+                f.truncate()
+                return False, f"Transfer ended after {offset + total_received} of {file_size} bytes"
+
+        # Verify the checksum computed while writing against the sender's trailer
+        new_checksum = hasher.hexdigest()
+        if journal is not None:
+            # The file is complete; whether or not it verifies there is nothing left to resume.
+            remove_journal(full_file_path)
+            journal = None
+        if trailer.decode("ascii") != new_checksum or (checksum and checksum != new_checksum):
+            return False, "Checksum verification failed"
+
+        return True, None
+
+    except socket.timeout:
+        return False, "Socket connection timed out"
+    except ConnectionError as e:
+        return False, str(e)
+    except PermissionError:
+        return False, "Permission denied when writing file"
+    except OSError as e:
+        return False, f"OS error occurred: {e}"
+    except Exception as e:
+        return False, f"Unexpected error: {e}"
+    finally:
+        # Ensure socket is closed
+        if transmit_socket:
+            transmit_socket.close()
+        endpoint.close()
+
+        # Close progress bar
+        if progress_bar and progress:
+            progress.close()
 
-                if not bytes_read:
-                    return False, "Connection closed unexpectedly"
+        if journal is not None:
+            # Record what reached the disk; after a crash the last checkpoint stands in for it.
+            try:
+                journal["received"] = os.path.getsize(full_file_path)
+                write_journal(full_file_path, journal)
+            except OSError:
+                pass
 
-                if bytes_read == b"EOF":
-                    break
 
-                # Handle last chunk
-                if bytes_read[-3:] == b"EOF":
-                    f.write(bytes_read[:-3])
-                    total_received += len(bytes_read)
-                    break
+def retrieve_segments(
+        socket_addr: str,
+        file_path: str,
+        transmit_port: int,
+        file_name: str,
+        file_size: int,
+        buffer_size: int,
+        segments: int,
+        progress_bar: bool = True,
+        timeout: float = 30.0,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        token: Optional[bytes] = None,
+        listener=None,
+        key: Optional[bytes] = None
+) -> Tuple[bool, Optional[str]]:
+    """
+    Retrieve a file sent with ``send_segments`` over ``segments`` parallel data connections.
 
-                # Decrypt and write data
-                f.write(bytes_read)
-                total_received += len(bytes_read)
+    Every connection learns its byte range from the segment header and
+    writes it in place with pwrite; each range is verified against the
+    digest in its own trailer. The ranges must lie within the file without
+    overlapping, and together cover all of it. Segmented transfers keep no
+    journal, so a file that fails part way is deleted rather than left
+    looking complete. The connections are made to ``transmit_port``
+    with ``token``, or accepted on ``listener`` as in ``retrieve_file``.
+    With a data ``key`` every segment is decrypted as a stream of its own.
 
-                # Update progress bar
-                if progress_bar and progress:
-                    progress.update(len(bytes_read))
+    Returns:
+        Tuple[bool, Optional[str]]:
+        - First value: Success of file retrieval and verification
+        - Second value: Error message if failed, None if successful
+    """
+    progress = None
+    full_file_path = os.path.join(file_path, file_name)
+    endpoint = listener or DataDialer(socket_addr, transmit_port, token)
+    endpoint.settimeout(timeout)
+    ranges = []  # (offset, length) of every segment received so far
+    ranges_lock = threading.Lock()
+    created = complete = False
+
+    def claim_range(offset: int, length: int):
+        # split_ranges gives the surplus segments of a small file empty ranges, which write nothing.
+        if not (0 <= offset and 0 <= length and offset + length <= file_size):
+            raise ConnectionError(f"Segment at byte {offset} of {length} bytes lies outside the file")
+        with ranges_lock:
+            if length and any(offset < start + size and start < offset + length for start, size in ranges):
+                raise ConnectionError(f"Segment at byte {offset} overlaps another segment")
+            ranges.append((offset, length))
+
+    def receive_range(file):
+        transmit_socket, addr = endpoint.accept()
+        with transmit_socket:
+            offset, length = recv_segment_header(transmit_socket)
+            claim_range(offset, length)
+            hasher = new_hasher(hash_algorithm)
+            # Under a key bound to the range, a segment whose header was swapped fails authentication.
+            received, trailer = receive_stream(transmit_socket, file, length,
+                                               min(buffer_size, tuning.receive_buffer), progress, hasher,
+                                               position=offset, key=stream_key(key, offset, length))
+            if received < length:
+                raise ConnectionError(f"Segment at byte {offset} ended after {received} of {length} bytes")
+            if trailer.decode("ascii") != hasher.hexdigest():
+                raise ConnectionError(f"Checksum verification failed for the segment at byte {offset}")
+            return length
 
-        # Verify file checksum
-        with open(full_file_path, "rb") as file:
-            new_checksum = hashlib.file_digest(file, "md5").hexdigest()
-            if checksum != new_checksum:
-                return False, "Checksum verification failed"
+    try:
+        if progress_bar:
+            progress = tqdm(
+                range(file_size),
+                f"Receiving {file_name}",
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024
+            )
+
+        with open(full_file_path, "wb") as f:
+            created = True
+            preallocate(f, file_size)
+            f.truncate(file_size)
+            with ThreadPoolExecutor(max_workers=segments, thread_name_prefix="ftp-segment") as pool:
+                total_received = sum(pool.map(receive_range, [f] * segments))
 
+        # The ranges do not overlap, so they cover the whole file exactly when their lengths add up to it.
+        if total_received != file_size:
+            return False, f"Segments covered {total_received} of {file_size} bytes"
+        complete = True
         return True, None
 
     except socket.timeout:
         return False, "Socket connection timed out"
+    except ConnectionError as e:
+        return False, str(e)
     except PermissionError:
         return False, "Permission denied when writing file"
     except OSError as e:
@@ -98,10 +493,123 @@ def retrieve_file(
     except Exception as e:
         return False, f"Unexpected error: {e}"
     finally:
-        # Ensure socket is closed
+        endpoint.close()
+        if progress_bar and progress:
+            progress.close()
+        if created and not complete:
+            remove_partial(full_file_path)
+
+
+def retrieve_batch(
+        socket_addr: str,
+        directory: str,
+        transmit_port: int,
+        manifest: List[dict],
+        buffer_size: int,
+        progress_bar: bool = True,
+        timeout: float = 30.0,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        token: Optional[bytes] = None,
+        listener=None,
+        progress=None,
+        key: Optional[bytes] = None
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Retrieve the files of a batch sent with ``send_batch`` into ``directory``.
+
+    Every file is written as its stream arrives and verified against its
+    own trailer and the manifest checksum, if any; it keeps the permission
+    bits of the manifest that ``permission_bits`` allows. A file that fails
+    is deleted and does not stop the batch, but a broken data connection
+    fails every file not yet received. The data
+    connection is made or accepted as in ``retrieve_file``. ``progress``,
+    if given, is a bar shared with other transfers to advance instead of
+    creating one. With a data ``key`` every file's stream is decrypted.
+
+    Returns:
+        Tuple of (checksum of every verified file, error of every failed file), both keyed by manifest path
+    """
+    checksums, errors = {}, {}
+    unsafe = [entry["path"] for entry in manifest if not is_relative_inside(entry.get("path"))]
+    if unsafe:
+        if listener:
+            listener.close()
+        return checksums, {path: "Path leaves the target directory" for path in unsafe}
+
+    transmit_socket = None
+    own_progress = None
+    endpoint = listener or DataDialer(socket_addr, transmit_port, token)
+    pending = list(manifest)
+    partial = None  # File of the stream being received, until it is verified
+    try:
+        endpoint.settimeout(timeout)
+        transmit_socket, addr = endpoint.accept()
+        if progress is None and progress_bar:
+            progress = own_progress = tqdm(
+                range(sum(entry["size"] for entry in manifest)),
+                f"Receiving {len(manifest)} files",
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024
+            )
+        while pending:
+            entry = pending[0]
+            path, file_size = entry["path"], entry["size"]
+            hasher = new_hasher(hash_algorithm)
+            target = os.path.join(directory, path)
+            try:
+                f = open(target, "wb")
+            except OSError as e:
+                # Its data still has to be read past to get to the next file.
+                errors[path] = f"Cannot write file: {e.strerror}"
+                target = None
+                f = open(os.devnull, "wb")
+            partial = target
+            with f:
+                if target:
+                    preallocate(f, file_size)
+                received, trailer = receive_stream(transmit_socket, f, file_size,
+                                                   min(buffer_size, tuning.receive_buffer), progress, hasher,
+                                                   key=stream_key(key, len(manifest) - len(pending)))
+            pending.pop(0)
+            checksum = hasher.hexdigest()
+            if target is None:
+                continue
+            if received < file_size:
+                errors[path] = f"Transfer ended after {received} of {file_size} bytes"
+            elif trailer.decode("ascii") != checksum or entry.get("checksum", checksum) != checksum:
+                errors[path] = "Checksum verification failed"
+            else:
+                checksums[path] = checksum
+                partial = None
+                mode = permission_bits(entry.get("mode"))
+                if mode is not None:
+                    os.chmod(target, mode)
+                continue
+            remove_partial(target)
+            partial = None
+
+    except socket.timeout:
+        error = "Socket connection timed out"
+    except ConnectionError as e:
+        error = str(e)
+    except PermissionError:
+        error = "Permission denied when writing file"
+    except OSError as e:
+        error = f"OS error occurred: {e}"
+    except Exception as e:
+        error = f"Unexpected error: {e}"
+    else:
+        error = None
+    finally:
         if transmit_socket:
             transmit_socket.close()
+        endpoint.close()
+        if own_progress:
+            own_progress.close()
+        if partial:
+            remove_partial(partial)
 
-        # Close progress bar
-        if progress_bar and progress:
-            progress.close()
+    for entry in pending:
+        errors[entry["path"]] = error
+    return checksums, errors
@@ -1,11 +1,9 @@
-import bz2
-import json
+from utils.serializers import serializer_for_flags
 
 
-def response_parser(response):
-    decompressed = bz2.decompress(response)
-    return json.loads(decompressed)
+def response_parser(response, flags=0):
+    return serializer_for_flags(flags).decode_response(response)
 
 
-def request_parser(response):
-    return json.loads(response.decode('utf-8'))
+def request_parser(response, flags=0):
+    return serializer_for_flags(flags).decode_query(response)
@@ -1,51 +1,39 @@
-import hashlib
+import io
 import logging
+import os
 import pathlib
 import socket
-from random import randint
-from typing import Dict, Tuple
+import ssl
+import stat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 from tqdm import tqdm
 
-BUFFER_SIZE = 4096
-MAX_PORT_ATTEMPTS = 100  # Limit port binding attempts
+from utils.AES_handler import SEALED_CHUNK_SIZE, StreamCipher, seal_stream, stream_key
+from utils.checksum_cache import checksum_cache, file_key
+from utils.compression import (COMPRESSED_CHUNK_SIZE, MAGIC_SIZE, MIN_CHUNK_SAVING, is_compressed_format,
+                               submit_chunk)
+from utils.data_channel import FLAG_END, linger, pack_chunk_header, send_chunk, send_end, send_segment_header
+from utils.hashing import DEFAULT_HASH_ALGORITHM, HASH_READ_SIZE, hash_region, new_hasher
+from utils.tuning import AdaptiveChunkSize, corked, tuning
 
+SEGMENT_ALIGNMENT = 1024 * 1024  # Segment boundaries fall on multiples of this
+COMPRESS_AHEAD = 4  # Chunks being compressed while the ones before them are sent
 
-def create_transmit_socket(server_addr: str, max_attempts: int = MAX_PORT_ATTEMPTS) -> Tuple[socket.socket, int]:
-    """
-    Create a socket and bind to a random available port.
-
-    Args:
-        max_attempts (int): Maximum number of attempts to find an available port
 
-    Returns:
-        Tuple of (socket, port number)
-
-    Raises:
-        OSError: If unable to bind to a port after max attempts
+def get_file_info(file_path: str, hash_algorithm: str = DEFAULT_HASH_ALGORITHM) -> Dict[str, any]:
     """
-    transmit_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    transmit_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-    for attempt in range(max_attempts):
-        try:
-            port = randint(1024, 65535)
-            transmit_socket.bind((server_addr, port))
-            transmit_socket.listen(1)
-            return transmit_socket, port
-        except OSError:
-            if attempt == max_attempts - 1:
-                raise OSError(f"Could not bind to a port after {max_attempts} attempts")
-
-    raise OSError("Unexpected error in port binding")
+    Retrieve file metadata.
 
-
-def get_file_info(file_path: str) -> Dict[str, any]:
-    """
-    Retrieve comprehensive file information.
+    Only the file's metadata is read. The checksum is included when the
+    checksum cache knows the file's current contents; otherwise it is
+    computed while the data is sent and travels in the stream trailer.
 
     Args:
         file_path (str): Path to the file
+        hash_algorithm (str): Hash algorithm the transfer is verified with
 
     Returns:
         Dictionary with file metadata
@@ -62,38 +50,304 @@ def get_file_info(file_path: str) -> Dict[str, any]:
 
         filesize = file_path_object.stat().st_size
 
-        with open(file_path_object, "rb") as file:
-            checksum = hashlib.file_digest(file, "md5").hexdigest()
-
-        return {
+        file_info = {
             "file_path": str(file_path_object),
             "file_size": filesize,
-            "buffer_size": BUFFER_SIZE,
-            "checksum": checksum
+            "buffer_size": tuning.max_chunk_size,
+            "hash_algorithm": hash_algorithm,
         }
+        checksum = checksum_cache.get(str(file_path_object), hash_algorithm)
+        if checksum:
+            file_info["checksum"] = checksum
+        return file_info
     except (FileNotFoundError, PermissionError) as e:
         logging.error(f"File access error: {e}")
         raise
 
 
+def manifest_entry(file_path: str, name: str, hash_algorithm: str = DEFAULT_HASH_ALGORITHM) -> Dict[str, any]:
+    """
+    Describe one file of a batch transfer: its ``name`` at the receiver, size, permission bits and known checksum.
+
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If path is not a regular file
+    """
+    stat_result = os.stat(file_path)
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise ValueError(f"Path {file_path} is not a file")
+    entry = {"path": name, "size": stat_result.st_size, "mode": stat.S_IMODE(stat_result.st_mode)}
+    checksum = checksum_cache.get(file_path, hash_algorithm)
+    if checksum:
+        entry["checksum"] = checksum
+    return entry
+
+
+def is_plain_socket(connection) -> bool:
+    """True when bytes written to ``connection`` go to the kernel untouched, so os.sendfile can be used."""
+    return isinstance(connection, socket.socket) and not isinstance(connection, ssl.SSLSocket)
+
+
+def sendfile_stream(connection: socket.socket, file, filesize: int, progress=None,
+                    sizer: AdaptiveChunkSize = None, hasher=None, offset: int = 0) -> int:
+    """
+    Send ``file`` from ``offset`` up to ``filesize`` with the kernel's sendfile, without copying it through Python.
+
+    Each chunk is announced by a chunk header and sent with one sendfile
+    call; the file offset is tracked explicitly. When a ``hasher`` is given,
+    every chunk is hashed right after it is sent, while its pages are
+    still in the page cache.
+
+    Returns:
+        int: Number of bytes sent
+
+    Raises:
+        ConnectionError: If the file shrank below an already announced chunk
+    """
+    sizer = sizer or tuning.chunk_sizer()
+    hash_buffer = memoryview(bytearray(HASH_READ_SIZE)) if hasher else None
+    start = offset
+    while offset < filesize:
+        count = min(sizer.size, filesize - offset)
+        sizer.start()
+        connection.sendall(pack_chunk_header(count))
+        sent = connection.sendfile(file, offset, count)
+        if sent < count:
+            # The header promised more bytes than the file still holds; the stream cannot be continued.
+            raise ConnectionError("File changed size while it was being sent")
+        if hasher:
+            hash_region(file, hasher, offset, count, hash_buffer)
+        sizer.record(sent)
+        offset += sent
+        if progress:
+            progress.update(sent)
+    return offset - start
+
+
+def copy_stream(connection, file, filesize: int, progress=None, transform=None,
+                sizer: AdaptiveChunkSize = None, hasher=None, offset: int = 0) -> int:
+    """
+    Read/send loop for streams that must pass through Python, e.g. encrypted or compressed ones.
+
+    Returns:
+        int: Number of file bytes sent
+    """
+    sizer = sizer or tuning.chunk_sizer()
+    file.seek(offset)
+    total_sent = 0
+    while total_sent < filesize - offset:
+        sizer.start()
+        bytes_read = file.read(min(sizer.size, filesize - offset - total_sent))
+        if not bytes_read:
+            break
+        if hasher:
+            hasher.update(bytes_read)
+        send_chunk(connection, transform(bytes_read) if transform else bytes_read)
+        sizer.record(len(bytes_read))
+        total_sent += len(bytes_read)
+        if progress:
+            progress.update(len(bytes_read))
+    return total_sent
+
+
+def compressed_stream(connection, file, filesize: int, codec: str, progress=None, hasher=None,
+                      offset: int = 0, cipher: Optional[StreamCipher] = None) -> int:
+    """
+    Read/send loop that compresses every chunk with ``codec`` on the compression threads.
+
+    Up to COMPRESS_AHEAD chunks are compressed while the ones before them
+    are sent, so the connection never waits on the compressor. Once a
+    chunk shrinks by less than MIN_CHUNK_SAVING the data is taken not to
+    compress, and the rest of the stream is sent raw. With a ``cipher``
+    every chunk is encrypted after it is compressed, in stream order.
+
+    Returns:
+        int: Number of file bytes sent
+    """
+    file.seek(offset)
+    pending = deque()  # (file bytes, future) of the chunks being compressed, in stream order
+    position = offset
+    total_sent = 0
+    compressing = True
+    exhausted = False
+    while not exhausted or pending:
+        while not exhausted and (len(pending) < COMPRESS_AHEAD if compressing else not pending):
+            data = file.read(min(COMPRESSED_CHUNK_SIZE, filesize - position))
+            if not data:
+                exhausted = True
+                break
+            if hasher:
+                hasher.update(data)
+            position += len(data)
+            if compressing:
+                pending.append((len(data), submit_chunk(data, codec)))
+            else:
+                send_chunk(connection, cipher.seal(data) if cipher else data)
+                total_sent += len(data)
+                if progress:
+                    progress.update(len(data))
+        if pending:
+            length, future = pending.popleft()
+            flags, payload = future.result()
+            if len(payload) > length * (1 - MIN_CHUNK_SAVING):
+                compressing = False
+            send_chunk(connection, cipher.seal(payload, flags) if cipher else payload, flags)
+            total_sent += length
+            if progress:
+                progress.update(length)
+    return total_sent
+
+
+def send_stream(connection, file, filesize: int, progress=None, transform=None, hasher=None,
+                checksum: str = None, offset: int = 0, codec: str = "none", key: Optional[bytes] = None) -> int:
+    """
+    Send a file over a connected socket as a chunked data stream.
+
+    The bytes go zero-copy whenever they are neither transformed nor
+    compressed. Chunks are compressed with ``codec`` unless the file is in
+    a compressed format already. The stream always ends with an END chunk
+    carrying the hex digest of the whole file: the known ``checksum`` if
+    one is given, in which case nothing is hashed, otherwise the
+    ``hasher``'s (empty without either). A resumed transfer starts at
+    ``offset`` with a hasher already fed the bytes before it. If the file
+    shrank, the receiver sees it arrive before ``filesize`` bytes. With a
+    data ``key`` the stream is encrypted, in chunks of SEALED_CHUNK_SIZE.
+    """
+    if checksum:
+        hasher = None
+    if codec != "none" and transform is None:
+        file.seek(0)
+        if is_compressed_format(getattr(file, "name", ""), file.read(MAGIC_SIZE)):
+            codec = "none"
+    with corked(connection):
+        cipher = seal_stream(connection, key)
+        if codec != "none" and transform is None:
+            total_sent = compressed_stream(connection, file, filesize, codec, progress, hasher, offset, cipher)
+        elif cipher:
+            sizer = AdaptiveChunkSize(SEALED_CHUNK_SIZE, SEALED_CHUNK_SIZE, SEALED_CHUNK_SIZE)
+            total_sent = copy_stream(connection, file, filesize, progress, cipher.seal, sizer, hasher, offset)
+        elif transform is None and is_plain_socket(connection):
+            total_sent = sendfile_stream(connection, file, filesize, progress, hasher=hasher, offset=offset)
+        else:
+            total_sent = copy_stream(connection, file, filesize, progress, transform, hasher=hasher, offset=offset)
+        trailer = (checksum or (hasher.hexdigest() if hasher else "")).encode("ascii")
+        if cipher:
+            send_chunk(connection, cipher.seal(trailer, FLAG_END), FLAG_END)
+        else:
+            send_end(connection, trailer)
+    return total_sent
+
+
+def split_ranges(file_size: int, segments: int) -> List[Tuple[int, int]]:
+    """
+    Cut a file into exactly ``segments`` contiguous (offset, length) ranges.
+
+    Boundaries are aligned to SEGMENT_ALIGNMENT; the last range takes the
+    remainder, and ranges of a very small file may be empty.
+    """
+    step = -(-file_size // segments)
+    step = -(-step // SEGMENT_ALIGNMENT) * SEGMENT_ALIGNMENT
+    ranges = []
+    for index in range(segments):
+        offset = min(index * step, file_size)
+        ranges.append((offset, min(step, file_size - offset)))
+    return ranges
+
+
+def send_segments(
+        file_path: str,
+        transmit_socket: socket.socket,
+        filesize: int,
+        filename: str,
+        segments: int,
+        progress_bar: bool = True,
+        timeout: float = 30.0,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        codec: str = "none",
+        key: Optional[bytes] = None
+) -> bool:
+    """
+    Send a file as ``segments`` byte ranges over as many data connections at once.
+
+    ``segments`` data connections are taken from ``transmit_socket``, as in
+    ``send_file``; each one is told the range it carries with a segment header, followed by an
+    ordinary chunked stream of that range. Each stream's trailer is the
+    digest of its range alone, so the receiver verifies every segment on
+    its own. With a data ``key`` every segment is encrypted as a stream of
+    its own, under a key bound to its range.
+
+    Returns:
+        bool: Whether every segment was successfully sent
+    """
+    progress = None
+    try:
+        transmit_socket.settimeout(timeout)
+        if progress_bar:
+            progress = tqdm(
+                range(filesize),
+                f"Sending {filename}",
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024
+            )
+
+        def send_range(segment):
+            offset, length = segment
+            connection, addr = transmit_socket.accept()
+            connection.settimeout(timeout)
+            with connection, open(file_path, "rb") as f:
+                send_segment_header(connection, offset, length)
+                send_stream(connection, f, offset + length, progress, hasher=new_hasher(hash_algorithm),
+                            offset=offset, codec=codec, key=stream_key(key, offset, length))
+                linger(connection)
+
+        with ThreadPoolExecutor(max_workers=segments, thread_name_prefix="ftp-segment") as pool:
+            list(pool.map(send_range, split_ranges(filesize, segments)))
+        return True
+
+    except (socket.timeout, ConnectionError) as e:
+        logging.error(f"Network error during segmented file send: {e}")
+        return False
+    except Exception as e:
+        logging.error(f"Unexpected error during segmented file send: {e}")
+        return False
+    finally:
+        if progress:
+            progress.close()
+        transmit_socket.close()
+
+
 def send_file(
         file_path: str,
         transmit_socket: socket.socket,
         filesize: int,
         filename: str,
         progress_bar: bool = True,
-        timeout: float = 30.0
+        timeout: float = 30.0,
+        hasher=None,
+        checksum: str = None,
+        offset: int = 0,
+        codec: str = "none",
+        key: Optional[bytes] = None
 ) -> bool:
     """
-    Send an encrypted file over a socket connection.
+    Send a file over a socket connection.
 
     Args:
         file_path (str): Path to the file to send
-        transmit_socket (socket.socket): Established socket
+        transmit_socket (socket.socket): Where the data connection comes from: a listening socket or leased
+                                         data port the receiver connects to, or a ``DataDialer`` for the
+                                         receiver's data port
         filesize (int): Size of the file
         filename (str): Name of the file
         progress_bar (bool): Whether to show progress
         timeout (float): Socket operation timeout
+        hasher: Hash object fed with the file's bytes as they are sent (default: a new MD5);
+                its digest is the stream trailer
+        checksum (str): Already known checksum of the file; when given the data is not hashed
+        offset (int): Where to resume sending; ``hasher`` must already hold the bytes before it
+        codec (str): Compression agreed for the data chunks
+        key (bytes): Data key to encrypt the stream with, if encryption was agreed
 
     Returns:
         bool: Whether file was successfully sent
@@ -104,6 +358,7 @@ def send_file(
 
         # Accept connection
         transmit_connection, addr = transmit_socket.accept()
+        transmit_connection.settimeout(timeout)
 
         # Optional progress bar
         progress = None
@@ -111,6 +366,7 @@ def send_file(
             progress = tqdm(
                 range(filesize),
                 f"Sending {filename}",
+                initial=offset,
                 unit="B",
                 unit_scale=True,
                 unit_divisor=1024
@@ -118,18 +374,9 @@ def send_file(
 
         try:
             with transmit_connection, open(file_path, "rb") as f:
-                total_sent = 0
-                while total_sent < filesize:
-                    bytes_read = f.read(BUFFER_SIZE)
-                    if not bytes_read:
-                        transmit_connection.send(b"EOF")
-                        break
-                    transmit_connection.send(bytes_read)
-
-                    total_sent += len(bytes_read)
-
-                    if progress_bar and progress:
-                        progress.update(len(bytes_read))
+                send_stream(transmit_connection, f, filesize, progress, hasher=hasher or new_hasher(),
+                            checksum=checksum, offset=offset, codec=codec, key=key)
+                linger(transmit_connection)
 
         finally:
             # Ensure progress bar is closed
@@ -147,3 +394,75 @@ def send_file(
     finally:
         # Ensure socket is closed
         transmit_socket.close()
+
+
+def send_batch(
+        file_paths: List[str],
+        manifest: List[Dict[str, any]],
+        transmit_socket: socket.socket,
+        progress_bar: bool = True,
+        timeout: float = 30.0,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        progress=None,
+        codec: str = "none",
+        key: Optional[bytes] = None
+) -> bool:
+    """
+    Send many files back to back over a single data connection.
+
+    ``manifest`` holds the ``manifest_entry`` of every file in
+    ``file_paths``, in the same order, and was already sent to the
+    receiver. Each file then follows as an ordinary chunked stream of its
+    announced size, ending with its own trailer, so the receiver can write
+    and verify the files one by one as they arrive. A file that can no
+    longer be read is sent empty; the receiver sees it come up short and
+    the files after it are unaffected. ``progress``, if given, is a bar
+    shared with other transfers to advance instead of creating one. With a
+    data ``key`` every file's stream is encrypted, under a key bound to its position in the batch.
+
+    Returns:
+        bool: Whether the data connection lasted to the end of the batch
+    """
+    own_progress = None
+    try:
+        transmit_socket.settimeout(timeout)
+        connection, addr = transmit_socket.accept()
+        connection.settimeout(timeout)
+        if progress is None and progress_bar:
+            progress = own_progress = tqdm(
+                range(sum(entry["size"] for entry in manifest)),
+                f"Sending {len(manifest)} files",
+                unit="B",
+                unit_scale=True,
+                unit_divisor=1024
+            )
+        with connection:
+            for index, (file_path, entry) in enumerate(zip(file_paths, manifest)):
+                checksum = entry.get("checksum")
+                file_stream_key = stream_key(key, index)
+                try:
+                    cache_key = file_key(file_path)
+                    f = open(file_path, "rb")
+                except OSError as e:
+                    logging.error(f"Skipping {file_path} in batch: {e}")
+                    send_stream(connection, io.BytesIO(), 0, key=file_stream_key)
+                    continue
+                with f:
+                    hasher = None if checksum else new_hasher(hash_algorithm)
+                    send_stream(connection, f, entry["size"], progress, hasher=hasher, checksum=checksum,
+                                codec=codec, key=file_stream_key)
+                if hasher:
+                    checksum_cache.put(file_path, hasher.hexdigest(), cache_key, hash_algorithm)
+            linger(connection)
+        return True
+
+    except (socket.timeout, ConnectionError) as e:
+        logging.error(f"Network error during batch send: {e}")
+        return False
+    except Exception as e:
+        logging.error(f"Unexpected error during batch send: {e}")
+        return False
+    finally:
+        if own_progress:
+            own_progress.close()
+        transmit_socket.close()
@@ -0,0 +1,132 @@
+import json
+import struct
+
+
+# Bits 2-3 of a frame's flags byte name the encoding of its payload.
+ENCODING_SHIFT = 2
+ENCODING_MASK = 0x03 << ENCODING_SHIFT
+
+
+class JSONSerializer:
+    """The original encoding: one JSON object per message."""
+    name = "json"
+    encoding_id = 0
+
+    @property
+    def flags(self) -> int:
+        return self.encoding_id << ENCODING_SHIFT
+
+    def encode_query(self, query) -> bytes:
+        return query.serialize().encode("utf-8")
+
+    def decode_query(self, payload: bytes) -> dict:
+        return json.loads(payload.decode("utf-8"))
+
+    def encode_response(self, response) -> bytes:
+        return response.serialize().encode("utf-8")
+
+    def decode_response(self, payload: bytes) -> dict:
+        return json.loads(payload.decode("utf-8"))
+
+
+class BinarySerializer(JSONSerializer):
+    """
+    Compact struct-based encoding.
+
+    Query:    header (command code, argument count, has current_dir, token length,
+              current_dir length, data tag, data length), token, current_dir,
+              then every argument prefixed with its 16-bit length, then data.
+    Response: header (accept, status code, data tag, data length), then data.
+
+    ``data`` is stored raw when it is a string (large ``list`` bodies) and as
+    JSON otherwise. Decoded messages have exactly the shape the JSON encoding
+    produces, so the command handlers cannot tell the two apart.
+    """
+    name = "binary"
+    encoding_id = 1
+
+    QUERY_HEADER = struct.Struct("!HB?HHBI")
+    RESPONSE_HEADER = struct.Struct("!?HBI")
+    ARG_LENGTH = struct.Struct("!H")
+
+    DATA_NONE = 0
+    DATA_STR = 1
+    DATA_JSON = 2
+
+    def encode_data(self, data) -> tuple[int, bytes]:
+        if data is None:
+            return self.DATA_NONE, b""
+        if isinstance(data, str):
+            return self.DATA_STR, data.encode("utf-8")
+        return self.DATA_JSON, json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+    def decode_data(self, tag: int, raw: bytes):
+        if tag == self.DATA_NONE:
+            return None
+        if tag == self.DATA_STR:
+            return raw.decode("utf-8")
+        return json.loads(raw.decode("utf-8"))
+
+    def encode_query(self, query) -> bytes:
+        command = query.command_code()
+        args = [str(arg).encode("utf-8") for arg in query.command_args or []]
+        token = (query.auth_token or "").encode("utf-8")
+        current_dir = (query.current_dir or "").encode("utf-8")
+        data_tag, data = self.encode_data(query.data)
+        parts = [self.QUERY_HEADER.pack(command, len(args), query.current_dir is not None, len(token),
+                                        len(current_dir), data_tag, len(data)), token, current_dir]
+        for arg in args:
+            parts.append(self.ARG_LENGTH.pack(len(arg)))
+            parts.append(arg)
+        parts.append(data)
+        return b"".join(parts)
+
+    def decode_query(self, payload: bytes) -> dict:
+        command, arg_count, has_dir, token_length, dir_length, data_tag, data_length = \
+            self.QUERY_HEADER.unpack_from(payload)
+        offset = self.QUERY_HEADER.size
+        auth_token = payload[offset:offset + token_length].decode("utf-8")
+        offset += token_length
+        current_dir = payload[offset:offset + dir_length].decode("utf-8") if has_dir else None
+        offset += dir_length
+        command_args = {}
+        for num in range(arg_count):
+            (length,) = self.ARG_LENGTH.unpack_from(payload, offset)
+            offset += self.ARG_LENGTH.size
+            command_args[str(num)] = payload[offset:offset + length].decode("utf-8")
+            offset += length
+        data = self.decode_data(data_tag, payload[offset:offset + data_length])
+        return {"auth_token": auth_token, "command": command, "command_args": command_args,
+                "current_dir": current_dir, "data": data}
+
+    def encode_response(self, response) -> bytes:
+        data_tag, data = self.encode_data(response.data)
+        return self.RESPONSE_HEADER.pack(response.accept, response.status_code, data_tag, len(data)) + data
+
+    def decode_response(self, payload: bytes) -> dict:
+        accept, status_code, data_tag, data_length = self.RESPONSE_HEADER.unpack_from(payload)
+        offset = self.RESPONSE_HEADER.size
+        return {"accept": accept, "status_code": status_code,
+                "data": self.decode_data(data_tag, payload[offset:offset + data_length])}
+
+
+SERIALIZERS = {serializer.name: serializer for serializer in (JSONSerializer(), BinarySerializer())}
+_by_id = {serializer.encoding_id: serializer for serializer in SERIALIZERS.values()}
+DEFAULT_ENCODING = "json"
+
+
+def choose_encoding(offered: list[str]) -> str:
+    """Pick the first encoding in the peer's preference list that this side supports."""
+    for name in offered or []:
+        if name in SERIALIZERS:
+            return name
+    return DEFAULT_ENCODING
+
+
+def serializer_for_flags(flags: int):
+    """Return the serializer a frame was encoded with."""
+    encoding_id = (flags & ENCODING_MASK) >> ENCODING_SHIFT
+    try:
+        return _by_id[encoding_id]
+    except KeyError:
+        raise ValueError(f"Unknown encoding id {encoding_id} in frame flags")
@@ -1,6 +1,7 @@
 import json
 
 from utils.command_codes import commands_code_dict
+from utils.mux import MUX_TRANSPORT
 
 
 class StandardQuery:
@@ -12,11 +13,15 @@ class StandardQuery:
         self.data = data
         self.current_dir = current_dir
 
+    def command_code(self) -> int:
+        if isinstance(self.command, str) and not self.command.isnumeric():
+            return commands_code_dict[self.command]
+        return int(self.command)
+
     def serialize(self):
         query_dict = {"auth_token": self.auth_token}
         try:
-            if not self.command.isnumeric():
-                self.command = commands_code_dict[self.command]
+            self.command = self.command_code()
             query_dict["command"] = self.command
         except KeyError:
             print("Invalid command")
@@ -28,6 +33,8 @@ class StandardQuery:
         query_dict["data"] = self.data
         return json.dumps(query_dict, ensure_ascii=False)
 
-    def serialize_and_send(self, connection):
-        serialized = self.serialize()
-        connection.sendall(serialized.encode("utf-8"))
+    def serialize_and_send(self, connection) -> int:
+        """Send the query as one frame on a ControlChannel and return its request id."""
+        serializer = connection.serializer
+        stream = isinstance(self.data, dict) and self.data.get("transport") == MUX_TRANSPORT
+        return connection.send_message(serializer.encode_query(self), serializer.flags, stream)
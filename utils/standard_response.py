@@ -1,4 +1,3 @@
-import bz2
 import json
 
 
@@ -13,6 +12,6 @@ class StandardResponse:
         return json.dumps(query_data, ensure_ascii=False)
 
     def serialize_and_send(self, connection):
-        serialized = self.serialize()
-        compressed = bz2.compress(serialized.encode("utf-8"), compresslevel=6)
-        connection.sendall(compressed)
+        """Send the response as one frame tagged with the id of the request it answers."""
+        serializer = connection.serializer
+        connection.send_message(serializer.encode_response(self), serializer.flags)
@@ -0,0 +1,86 @@
+import socket
+import ssl
+import threading
+from typing import Optional
+
+
+class TLSSettings:
+    """
+    This process's TLS setup, configured once from the command line; without it connections are plain TCP.
+
+    A server with a certificate wraps every control and data connection it
+    accepts. A client wraps every connection it opens, verifying the
+    server's certificate, and offers the TLS session of its control
+    connection when it opens another one, so data connections and extra
+    control connections get an abbreviated handshake instead of a full one.
+    """
+
+    def __init__(self):
+        self.context = None
+        self.session = None  # Last resumable session seen by the client
+        self.session_source = None  # Client control connection whose newest session ticket is reused
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.context is not None
+
+    def configure_server(self, certfile: str, keyfile: Optional[str] = None):
+        """
+        Serve TLS with the certificate chain in ``certfile`` (and its key, unless the file holds it too).
+
+        Must happen before worker processes are forked, so they all share the
+        context's session ticket keys.
+
+        Raises:
+            OSError: If a file cannot be read
+            ssl.SSLError: If they do not hold a certificate and its key
+        """
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(certfile, keyfile)
+        self.context = context
+
+    def configure_client(self, cafile: Optional[str] = None):
+        """Connect with TLS, trusting the certificates in ``cafile`` or else the system's."""
+        context = ssl.create_default_context(cafile=cafile)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.context = context
+
+    def wrap_server(self, sock: socket.socket) -> socket.socket:
+        """Complete the server side of the handshake on an accepted connection, within its timeout."""
+        if self.context is None:
+            return sock
+        return self.context.wrap_socket(sock, server_side=True)
+
+    def wrap_client(self, sock: socket.socket, server_hostname: str, control: bool = False) -> socket.socket:
+        """
+        Complete the client side of the handshake on a connected socket, resuming the last session if possible.
+
+        The session tickets of a ``control`` connection are offered by every
+        connection opened after it; TLS 1.3 servers send them after the
+        handshake, so they are only known once the connection has read a reply.
+        """
+        if self.context is None:
+            return sock
+        wrapped = self.context.wrap_socket(sock, server_hostname=server_hostname, session=self.resumable_session())
+        if control:
+            with self.lock:
+                self.session_source = wrapped
+        return wrapped
+
+    def resumable_session(self) -> Optional[ssl.SSLSession]:
+        with self.lock:
+            source = self.session_source
+            if source is not None:
+                try:
+                    session = source.session
+                except (OSError, ValueError, AttributeError):
+                    session = None
+                # A closed connection has no session left; keep offering the last one it had.
+                if session is not None and session.has_ticket:
+                    self.session = session
+            return self.session
+
+
+tls = TLSSettings()
@@ -0,0 +1,53 @@
+import json
+import os
+from typing import Optional
+
+JOURNAL_SUFFIX = ".resume"
+CHECKPOINT_INTERVAL = 64 * 1024 * 1024  # Bytes received between journal updates
+
+
+def journal_path(file_path: str) -> str:
+    """The sidecar journal of ``file_path``: a hidden file next to it."""
+    directory, name = os.path.split(file_path)
+    return os.path.join(directory, f".{name}{JOURNAL_SUFFIX}")
+
+
+def write_journal(file_path: str, entry: dict):
+    """Atomically replace the journal of ``file_path`` with ``entry``."""
+    path = journal_path(file_path)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(temp_path, path)
+
+
+def read_journal(file_path: str) -> Optional[dict]:
+    """Return the journal of ``file_path``, or None if there is no interrupted transfer to resume."""
+    try:
+        with open(journal_path(file_path), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+def remove_journal(file_path: str):
+    try:
+        os.remove(journal_path(file_path))
+    except FileNotFoundError:
+        pass
+
+
+def resume_offset(file_path: str, journal: dict) -> int:
+    """
+    Bytes of a partially received file that a transfer can continue after.
+
+    The journal records how much had reached the disk at the last
+    checkpoint. The file itself may be longer (it is preallocated, and a
+    crash skips the final update) or shorter (it was truncated since), so
+    the smaller of the two is trusted; the peer still verifies the prefix.
+    """
+    try:
+        size = os.path.getsize(file_path)
+    except OSError:
+        return 0
+    return min(int(journal.get("received", 0)), size)
@@ -0,0 +1,182 @@
+import socket
+import time
+from contextlib import contextmanager
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_RECEIVE_BUFFER = 1024 * 1024  # Size of each write-behind buffer on the receiving side
+DEFAULT_SOCKET_BUFFER = 4 * 1024 * 1024  # SO_SNDBUF/SO_RCVBUF for data connections
+MAX_SEGMENTS = 8  # Most data connections a single file is split over
+SEGMENT_SIZE = 64 * 1024 * 1024  # "auto" opens one more connection per this many bytes of file
+DEFAULT_TRANSFERS = 4  # Batches of a directory transfer in flight at once
+
+
+class TransferTuning:
+    """
+    Process-wide transfer settings, set once from the command line.
+
+    ``chunk_size`` is either a fixed number of bytes per chunk or "auto",
+    in which case every transfer ramps its chunk size with observed
+    throughput between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE. ``segments`` is
+    the number of data connections a file is split over, or "auto" to
+    scale it with the file size; it is one unless asked for, since
+    segmented transfers cannot be resumed. ``transfers`` is the number of batches a
+    directory transfer runs at once, and ``large_first`` sends its largest
+    files first so one big file does not finish long after the rest.
+    """
+
+    def __init__(self, chunk_size="auto", receive_buffer=DEFAULT_RECEIVE_BUFFER,
+                 socket_buffer=DEFAULT_SOCKET_BUFFER, segments=1, transfers=DEFAULT_TRANSFERS,
+                 large_first=False):
+        self.chunk_size = chunk_size
+        self.receive_buffer = receive_buffer
+        self.socket_buffer = socket_buffer
+        self.segments = segments
+        self.transfers = transfers
+        self.large_first = large_first
+
+    @property
+    def max_chunk_size(self) -> int:
+        """The largest chunk a sender will write; announced to the peer as ``buffer_size``."""
+        return MAX_CHUNK_SIZE if self.chunk_size == "auto" else self.chunk_size
+
+    def chunk_sizer(self) -> "AdaptiveChunkSize":
+        if self.chunk_size == "auto":
+            return AdaptiveChunkSize()
+        return AdaptiveChunkSize(initial=self.chunk_size, maximum=self.chunk_size, minimum=self.chunk_size)
+
+
+tuning = TransferTuning()
+
+
+def configure(chunk_size=None, receive_buffer=None, socket_buffer=None, segments=None, transfers=None,
+              large_first=None):
+    """Override the process-wide transfer settings; None keeps the current value."""
+    if chunk_size is not None:
+        tuning.chunk_size = chunk_size
+    if receive_buffer is not None:
+        tuning.receive_buffer = receive_buffer
+    if socket_buffer is not None:
+        tuning.socket_buffer = socket_buffer
+    if segments is not None:
+        tuning.segments = segments
+    if transfers is not None:
+        tuning.transfers = transfers
+    if large_first is not None:
+        tuning.large_first = large_first
+
+
+def parse_size(value: str):
+    """Parse '65536', '256K', '4M' or 'auto' from the command line."""
+    value = str(value).strip().lower()
+    if value == "auto":
+        return value
+    return parse_bytes(value)
+
+
+def parse_bytes(value: str) -> int:
+    """Parse '65536', '256K' or '4M' from the command line, for sizes that have no 'auto'."""
+    value = str(value).strip().lower()
+    multipliers = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    if value and value[-1] in multipliers:
+        return int(value[:-1]) * multipliers[value[-1]]
+    return int(value)
+
+
+def parse_count(value: str):
+    """Parse '4' or 'auto' from the command line."""
+    value = str(value).strip().lower()
+    return value if value == "auto" else int(value)
+
+
+def suggest_segments(file_size: int) -> int:
+    """One data connection per SEGMENT_SIZE bytes, up to MAX_SEGMENTS."""
+    return max(1, min(MAX_SEGMENTS, file_size // SEGMENT_SIZE))
+
+
+def choose_segments(file_size: int, offered=1) -> int:
+    """
+    Number of data connections for a transfer of ``file_size`` bytes.
+
+    ``offered`` is what the peer asked for, a number or "auto"; this side's
+    own ``segments`` setting caps it. Peers that predate segmented
+    transfers ask for nothing and get a single connection.
+    """
+    wanted = suggest_segments(file_size) if offered == "auto" else int(offered)
+    limit = MAX_SEGMENTS if tuning.segments == "auto" else tuning.segments
+    return max(1, min(wanted, limit, MAX_SEGMENTS))
+
+
+class AdaptiveChunkSize:
+    """
+    Grow the chunk size while throughput keeps up, back off when it drops.
+
+    The size doubles after every chunk that moved at least 90% of the best
+    throughput seen so far, and halves after one that did not.
+    """
+
+    def __init__(self, initial: int = MIN_CHUNK_SIZE, maximum: int = MAX_CHUNK_SIZE, minimum: int = MIN_CHUNK_SIZE):
+        self.size = initial
+        self.maximum = maximum
+        self.minimum = minimum
+        self.best_throughput = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def record(self, nbytes: int):
+        """Account for ``nbytes`` sent since ``start`` and pick the next size."""
+        elapsed = max(time.perf_counter() - self.started, 1e-6)
+        throughput = nbytes / elapsed
+        if throughput >= self.best_throughput * 0.9:
+            self.best_throughput = max(self.best_throughput, throughput)
+            self.size = min(self.size * 2, self.maximum)
+        else:
+            self.size = max(self.size // 2, self.minimum)
+
+
+def tune_control_socket(sock: socket.socket):
+    """Control messages are small and latency bound: never let Nagle hold them back."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def tune_data_socket(sock: socket.socket):
+    """
+    Size the kernel buffers of a data socket for bulk transfer.
+
+    Call it before ``listen``/``connect`` so the TCP window scale is
+    negotiated with the larger receive buffer. Streams are corked while
+    they are sent, so Nagle would only hold back the small writes around
+    them, such as the token that follows a TLS handshake.
+    """
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, tuning.socket_buffer)
+        except OSError:
+            pass
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+@contextmanager
+def corked(sock):
+    """Hold back partial segments (TCP_CORK) so chunk headers and data leave in full packets."""
+    cork = getattr(socket, "TCP_CORK", None)
+    if cork is None or not isinstance(sock, socket.socket):
+        yield
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, cork, 1)
+    try:
+        yield
+    finally:
+        # Uncorking flushes whatever is still queued.
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, cork, 0)
+        except OSError:
+            pass